@@ -0,0 +1,39 @@
+# backfill_stats.py
+# One-off script to rebuild user and variant counters from the comparisons collection
+
+import asyncio
+import logging
+
+from database import create_database
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+
+async def backfill_stats() -> bool:
+    """Recompute user counters, seen images and per-variant counters"""
+    try:
+        db = create_database()
+        await db.connect()
+        print("Scanning comparisons collection...")
+        updated = await db.backfill_stats()
+        print(f"Updated {updated} users")
+        await db.close()
+        return True
+
+    except Exception as e:
+        logging.error(f"Error backfilling stats: {e}")
+        print(f"Error: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    print("\n===== STATS BACKFILL =====\n")
+    print("   Stop the bot before running: counters are overwritten.\n")
+    if asyncio.run(backfill_stats()):
+        print("\n✅ Stats backfilled successfully!\n")
+    else:
+        print("\n❌ Failed to backfill stats.\n")
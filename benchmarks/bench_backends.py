@@ -0,0 +1,87 @@
+# benchmarks/bench_backends.py
+# Одна и та же нагрузка голосования на двух хранилищах: Firestore (заглушка с задержкой
+# запроса) и встроенный SQLite во временном файле
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_backends --voters 200 --votes 20 --latency 0.005
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from typing import List
+
+import config
+from benchmarks.bench_database import create_database, percentile, simulate_voter
+from benchmarks.fake_firestore import FakeFirestore
+from experiments import ExperimentRegistry
+from sqlite_database import SQLiteDatabase
+
+
+async def create_sqlite_database(path: str) -> SQLiteDatabase:
+    """SQLite с тем же экспериментом и каталогом, что и в bench_database.create_database"""
+    experiments = ExperimentRegistry.single(
+        config.IMAGES_FOLDER,
+        os.path.basename(config.FIXED_IMAGE_PATH),
+        os.path.join(os.path.dirname(path), 'catalog.json')
+    )
+    await experiments.ensure_loaded()
+    db = SQLiteDatabase(path, experiments=experiments)
+    await db.connect()
+    experiment = experiments.experiments()[0]
+    await db.add_images([experiment.fixed_key] + experiment.variant_keys())
+    return db
+
+
+async def run(db, voters: int, votes: int) -> dict:
+    latencies: List[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_voter(db, 1000 + i, votes, latencies) for i in range(voters)))
+    elapsed = time.perf_counter() - started
+
+    stats_started = time.perf_counter()
+    await db.get_variant_stats()
+    stats_elapsed = time.perf_counter() - stats_started
+    return {
+        'calls': len(latencies),
+        'elapsed': elapsed,
+        'throughput': voters * votes / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'stats': stats_elapsed * 1000,
+    }
+
+
+def report(label: str, result: dict):
+    print(f"{label:>24}: calls={result['calls']} total={result['elapsed']:.2f}s "
+          f"{result['throughput']:.0f} votes/s p50={result['p50']:.2f}ms p99={result['p99']:.2f}ms "
+          f"variant stats={result['stats']:.1f}ms")
+
+
+async def main_async(voters: int, votes: int, latency: float):
+    client = FakeFirestore(latency=latency)
+    report(f"firestore ({latency * 1000:g} ms)", await run(await create_database(client), voters, votes))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = await create_sqlite_database(os.path.join(tmp, 'bench.sqlite3'))
+        try:
+            report("sqlite (WAL)", await run(db, voters, votes))
+        finally:
+            await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the same vote workload against the Firestore and SQLite backends")
+    parser.add_argument('--voters', type=int, default=200)
+    parser.add_argument('--votes', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.005, help="задержка одного запроса Firestore, сек")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    asyncio.run(main_async(args.voters, args.votes, args.latency))
+
+
+if __name__ == "__main__":
+    main()
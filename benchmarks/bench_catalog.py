@@ -0,0 +1,81 @@
+# benchmarks/bench_catalog.py
+# Индекс каталога изображений: запуск с манифестом против полного сканирования и
+# стоимость получения списка изображений в обработчике (os.listdir + isfile против индекса)
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_catalog --images 5000
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from catalog import IMAGE_EXTENSIONS, ImageCatalog
+from benchmarks.bench_database import percentile
+
+
+def list_images_from_disk(folder: str):
+    """Прежний способ: обход папки при каждом запросе"""
+    images = []
+    for filename in os.listdir(folder):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            if os.path.isfile(os.path.join(folder, filename)):
+                images.append(filename)
+    return images
+
+
+async def run(count: int, size: int, calls: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, 'images')
+        os.makedirs(folder)
+        payload = os.urandom(size)
+        for i in range(count):
+            with open(os.path.join(folder, f'img_{i}.jpg'), 'wb') as f:
+                f.write(payload + i.to_bytes(4, 'little'))
+        manifest = os.path.join(tmp, 'catalog.json')
+
+        started = time.perf_counter()
+        await ImageCatalog(folder, manifest).load()
+        cold = time.perf_counter() - started
+
+        catalog = ImageCatalog(folder, manifest)
+        started = time.perf_counter()
+        await catalog.load()
+        warm = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await catalog.refresh()
+        poll = time.perf_counter() - started
+
+        disk_times, index_times = [], []
+        for _ in range(calls):
+            started = time.perf_counter()
+            list_images_from_disk(folder)
+            disk_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            [name for name in catalog.names() if name != 'img_0.jpg']
+            index_times.append(time.perf_counter() - started)
+
+    print(f"{count} images of {size // 1024} KiB")
+    print(f"  startup, full scan:     {cold * 1000:8.1f} ms")
+    print(f"  startup, from manifest: {warm * 1000:8.1f} ms")
+    print(f"  poll without changes:   {poll * 1000:8.1f} ms (background task)")
+    print(f"  listdir+isfile per request: p50 {percentile(disk_times, 50) * 1000:.2f} ms")
+    print(f"  catalog index per request:  p50 {percentile(index_times, 50) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image catalog index")
+    parser.add_argument('--images', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=64 * 1024, help="размер файла, байт")
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args.images, args.size, args.calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# benchmarks/bench_comparison_modes.py
+# Число запросов к Bot API и длительность сессии в режимах media_group и edit
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_comparison_modes --sessions 50 --api-latency 0.05
+
+import argparse
+import asyncio
+import logging
+
+from benchmarks.harness import SessionDriver, load_bot, start_services, stop_services
+from benchmarks.bench_database import percentile
+
+import config
+
+
+async def run(sessions: int, api_latency: float, rate_limit: bool):
+    bot_module, session = load_bot(api_latency=api_latency, rate_limit=rate_limit)
+    await start_services(bot_module)
+    driver = SessionDriver(bot_module, session)
+    try:
+        for mode in ("media_group", "edit"):
+            config.COMPARISON_MODE = mode
+            # Прогрев: все склейки построены, кэш file_id заполнен первыми сессиями
+            for experiment in bot_module.experiments.experiments():
+                await bot_module.composite_cache.prebuild(experiment.fixed_path, experiment.catalog.paths())
+            for user_id in range(1, 4):
+                await driver.run_session(user_id)
+            session.reset()
+
+            durations = await asyncio.gather(*(driver.run_session(1000 + i) for i in range(sessions)))
+            calls = sum(session.calls.values())
+            print(f"{mode:>11}: {calls / sessions:5.1f} API calls/session  uploads={session.uploads}  "
+                  f"session p50={percentile(durations, 50):.2f}s p99={percentile(durations, 99):.2f}s  "
+                  f"calls={dict(session.calls)}")
+    finally:
+        await stop_services(bot_module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare media_group and edit comparison modes")
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка одного запроса к Bot API, сек")
+    parser.add_argument('--no-rate-limit', action='store_true', help="отключить ограничитель исходящих запросов")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    asyncio.run(run(args.sessions, args.api_latency, not args.no_rate_limit))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# benchmarks/bench_composites.py
+# Построение склеек: последовательно против пула процессов, и цена одного сравнения
+# в горячем пути (поиск готовой склейки против отрисовки по запросу)
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_composites --workers 4
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import config
+from render import CompositeCache, compose_side_by_side
+from benchmarks.bench_database import percentile
+
+
+async def run(workers: int, lookups: int):
+    fixed = config.FIXED_IMAGE_PATH
+    variants = [os.path.join(config.IMAGES_FOLDER, name) for name in sorted(os.listdir(config.IMAGES_FOLDER))
+                if os.path.join(config.IMAGES_FOLDER, name) != fixed]
+    panel_size = (config.COMPOSITE_PANEL_WIDTH, config.COMPOSITE_PANEL_HEIGHT)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Отрисовка по запросу: каждое сравнение декодирует и масштабирует обе картинки
+        render_times = []
+        for i, variant in enumerate(variants):
+            started = time.perf_counter()
+            compose_side_by_side(fixed, variant, os.path.join(tmp, 'serial', f'{i}.jpg'), panel_size)
+            render_times.append(time.perf_counter() - started)
+        serial_total = sum(render_times)
+
+        cache = CompositeCache(os.path.join(tmp, 'cache'), panel_size=panel_size, workers=workers)
+        started = time.perf_counter()
+        rendered = await cache.prebuild(fixed, variants)
+        pool_total = time.perf_counter() - started
+
+        # Повторный prebuild (перезапуск, каталог не менялся) только проверяет хэши
+        restarted = CompositeCache(os.path.join(tmp, 'cache'), panel_size=panel_size, workers=workers)
+        started = time.perf_counter()
+        await restarted.prebuild(fixed, variants)
+        warm_total = time.perf_counter() - started
+
+        lookup_times = []
+        for i in range(lookups):
+            variant = variants[i % len(variants)]
+            started = time.perf_counter()
+            await cache.get(fixed, variant)
+            lookup_times.append(time.perf_counter() - started)
+
+        sizes = [os.path.getsize(cache.lookup(fixed, v)) for v in variants]
+
+    print(f"{len(variants)} pairs, panel {panel_size[0]}x{panel_size[1]}, avg composite {sum(sizes) / len(sizes) / 1024:.0f} KiB")
+    print(f"  serial render:   {serial_total:.2f}s total, p50 {percentile(render_times, 50) * 1000:.1f} ms/pair")
+    print(f"  pool prebuild:   {pool_total:.2f}s total ({rendered} rendered, workers={workers or os.cpu_count()})")
+    print(f"  warm prebuild:   {warm_total * 1000:.1f} ms (hash check only)")
+    print(f"  hot path lookup: p50 {percentile(lookup_times, 50) * 1e6:.1f} us, p99 {percentile(lookup_times, 99) * 1e6:.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark composite prebuild and lookup")
+    parser.add_argument('--workers', type=int, default=0, help="число процессов (0 - по числу ядер)")
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args.workers or None, args.lookups))
+
+
+if __name__ == "__main__":
+    main()
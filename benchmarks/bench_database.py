@@ -0,0 +1,127 @@
+# benchmarks/bench_database.py
+# Задержка обработчиков при параллельных голосованиях: синхронный клиент против асинхронного
+#
+# Затем несколько экземпляров бота одновременно добавляют новые изображения: порядковые
+# номера изображений должны остаться уникальными, иначе скрипт завершается с ошибкой.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_database --voters 200 --votes 5 --latency 0.005
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+from collections import Counter
+import time
+from typing import List
+
+import config
+from database import BaseDatabase, FirestoreDatabase
+from experiments import ExperimentRegistry
+from benchmarks.fake_firestore import FakeFirestore
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) по отсортированной выборке"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def create_database(client) -> FirestoreDatabase:
+    """База с одним экспериментом из config.IMAGES_FOLDER и загруженным каталогом, как в main()"""
+    experiments = ExperimentRegistry.single(
+        config.IMAGES_FOLDER,
+        os.path.basename(config.FIXED_IMAGE_PATH),
+        os.path.join(tempfile.mkdtemp(prefix='bench-catalog-'), 'catalog.json')
+    )
+    await experiments.ensure_loaded()
+    db = FirestoreDatabase(client=client, experiments=experiments)
+    experiment = experiments.experiments()[0]
+    await db.add_images([experiment.fixed_key] + experiment.variant_keys())
+    client.round_trips = 0
+    return db
+
+
+async def simulate_voter(db: BaseDatabase, user_id: int, votes: int, latencies: List[float]):
+    """Один пользователь: /start, начало сессии и серия голосов"""
+    started = time.perf_counter()
+    await db.save_user(user_id, f"user{user_id}", "Bench", None)
+    latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    images = await db.get_random_images(votes, exclude_for_user_id=user_id)
+    latencies.append(time.perf_counter() - started)
+
+    for index, image in enumerate(images):
+        started = time.perf_counter()
+        await db.save_comparison_result(
+            user_id=user_id,
+            fixed_image_path=config.FIXED_IMAGE_PATH,
+            variable_image_path=os.path.join(config.IMAGES_FOLDER, image),
+            selected_original=index % 2 == 0
+        )
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(voters: int, votes: int, latency: float, blocking: bool) -> dict:
+    """Запускает voters пользователей одновременно и собирает задержки вызовов"""
+    client = FakeFirestore(latency=latency, blocking=blocking)
+    db = await create_database(client)
+
+    latencies: List[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_voter(db, 1000 + i, votes, latencies) for i in range(voters)))
+    elapsed = time.perf_counter() - started
+    return {
+        'calls': len(latencies),
+        'round_trips': client.round_trips,
+        'elapsed': elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'mean': statistics.mean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+async def check_concurrent_ordinals(replicas: int, images: int, latency: float) -> bool:
+    """Экземпляры с одним каталогом одновременно добавляют свои изображения; номера не повторяются"""
+    client = FakeFirestore(latency=latency)
+    db = await create_database(client)
+    instances = [FirestoreDatabase(client=client, experiments=db.experiments) for _ in range(replicas)]
+    for instance in instances:
+        await instance.load_image_index()
+    await asyncio.gather(*(
+        instance.add_images([f"replica{r}_{i:04d}.jpg" for i in range(images)])
+        for r, instance in enumerate(instances)
+    ))
+    ordinals = Counter(doc.get('ordinal') for doc in client._docs(config.IMAGES_COLLECTION).values())
+    duplicates = sum(count - 1 for count in ordinals.values())
+    print(f"{replicas} instances adding {images} images each: {len(ordinals)} ordinals, {duplicates} duplicates")
+    return duplicates == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Database handler latency against a fake Firestore")
+    parser.add_argument('--voters', type=int, default=200)
+    parser.add_argument('--votes', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.005, help="задержка одного запроса, сек")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    for blocking in (True, False):
+        result = asyncio.run(run(args.voters, args.votes, args.latency, blocking))
+        mode = "blocking (sync client)" if blocking else "async client"
+        print(f"{mode:>24}: calls={result['calls']} round_trips={result['round_trips']} "
+              f"total={result['elapsed']:.2f}s p50={result['p50']:.1f}ms p99={result['p99']:.1f}ms "
+              f"mean={result['mean']:.1f}ms")
+    if not asyncio.run(check_concurrent_ordinals(4, 50, args.latency)):
+        sys.exit("Concurrent add_images assigned the same image ordinal twice")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# benchmarks/bench_experiments.py
+# Масштабирование на много экспериментов: запуск без манифестов и с манифестами,
+# выбор эксперимента для сессии и запись в кэш file_id с десятками тысяч записей
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_experiments --experiments 200 --images 100
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from experiments import ExperimentRegistry, create_allocator
+from file_id_cache import FileIdCache
+from benchmarks.bench_database import percentile
+
+
+def make_tree(root: str, experiments: int, images: int, size: int):
+    payload = os.urandom(size)
+    for e in range(experiments):
+        folder = os.path.join(root, f'img_{e}')
+        os.makedirs(folder)
+        for i in range(images):
+            name = 'afro.jpg' if i == 0 else f'variant_{i}.jpg'
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(payload + e.to_bytes(4, 'little') + i.to_bytes(4, 'little'))
+
+
+async def run(experiments: int, images: int, size: int, sessions: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'images')
+        manifests = os.path.join(tmp, 'catalogs')
+        make_tree(root, experiments, images, size)
+        total = experiments * images
+
+        # Первый запуск: манифестов нет, каталоги сканируются в фоне
+        registry = ExperimentRegistry(root, manifests, poll_interval=3600)
+        started = time.perf_counter()
+        await registry.start()
+        cold_start = time.perf_counter() - started
+        await registry.refresh()
+        cold_ready = time.perf_counter() - started
+        await registry.stop()
+
+        # Повторный запуск: все каталоги загружаются из манифестов
+        registry = ExperimentRegistry(root, manifests, poll_interval=3600, allocator=create_allocator('least_served'))
+        started = time.perf_counter()
+        await registry.start()
+        warm_start = time.perf_counter() - started
+        ready = len(registry.experiments())
+
+        # Выбор эксперимента для сессии пользователя, уже видевшего часть вариантов
+        seen = {key for e in registry.experiments()[:experiments // 2] for key in e.variant_keys()[:images // 2]}
+        allocate_times = []
+        for user_id in range(sessions):
+            started = time.perf_counter()
+            experiment = registry.allocate(user_id, seen)
+            [key for key in experiment.variant_keys() if key not in seen]
+            allocate_times.append(time.perf_counter() - started)
+        await registry.stop()
+
+        # Кэш file_id на все изображения: сохранение при каждой записи против отложенного
+        paths = [e.path(name) for e in registry.experiments() for name in e.catalog.names()]
+        put_results = {}
+        for label, interval in (('save on every put', 0.0), ('debounced save', 5.0)):
+            cache = FileIdCache(os.path.join(tmp, f'file_ids_{interval}.json'), bot_id=1, catalog=registry, save_interval=interval)
+            for i, path in enumerate(paths):
+                cache.put(path, f'file_{i}')
+            put_times = []
+            for i, path in enumerate(paths[:500]):
+                started = time.perf_counter()
+                cache.put(path, f'new_file_{i}')
+                put_times.append(time.perf_counter() - started)
+            cache.flush()
+            put_results[label] = put_times
+
+        started = time.perf_counter()
+        cache = FileIdCache(os.path.join(tmp, 'file_ids_5.0.json'), bot_id=1, catalog=registry)
+        load_time = time.perf_counter() - started
+        get_times = []
+        for path in paths[:5000]:
+            started = time.perf_counter()
+            cache.get(path)
+            get_times.append(time.perf_counter() - started)
+
+    print(f"{experiments} experiments x {images} images = {total} files, {ready} ready")
+    print(f"  first start (no manifests): start() {cold_start * 1000:.1f} ms, all catalogs scanned after {cold_ready * 1000:.0f} ms")
+    print(f"  restart (manifests):        start() {warm_start * 1000:.1f} ms")
+    print(f"  allocate session:           p50 {percentile(allocate_times, 50) * 1000:.2f} ms, p99 {percentile(allocate_times, 99) * 1000:.2f} ms")
+    for label, times in put_results.items():
+        print(f"  file_id put, {label:17}: p50 {percentile(times, 50) * 1000:.3f} ms, p99 {percentile(times, 99) * 1000:.3f} ms")
+    print(f"  file_id cache load {load_time * 1000:.1f} ms, get p50 {percentile(get_times, 50) * 1e6:.1f} us (no hashing)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark experiment catalogs at scale")
+    parser.add_argument('--experiments', type=int, default=200)
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--size', type=int, default=16 * 1024, help="размер файла, байт")
+    parser.add_argument('--sessions', type=int, default=2000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args.experiments, args.images, args.size, args.sessions))
+
+
+if __name__ == "__main__":
+    main()
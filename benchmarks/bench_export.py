@@ -0,0 +1,167 @@
+# benchmarks/bench_export.py
+# Выгрузка сравнений: загрузка всей коллекции в память против постраничного потока с
+# записью CSV порциями, и инкрементальная выгрузка от отметки времени записи written_at
+# (среди новых сравнений есть голоса из журнала, поданные до отметки)
+#
+# Затем проверяются инкрементальные выгрузки с нуля, как в ночном задании: часть сравнений
+# записана до появления written_at, часть записана уже после отметки первой выгрузки.
+# Вместе две выгрузки должны содержать каждое сравнение ровно один раз, иначе скрипт
+# завершается с ошибкой.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_export --comparisons 100000
+
+import argparse
+import asyncio
+import csv
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from typing import List
+
+import config
+from benchmarks.bench_database import create_database
+from benchmarks.fake_firestore import FakeFirestore
+from export_comparisons import FIELDS, export_comparisons, export_incremental
+
+
+def insert_comparisons(client: FakeFirestore, db, count: int, start: datetime.datetime,
+                       late: int = 0, step: float = 1.0, legacy: bool = False) -> datetime.datetime:
+    """Добавляет сравнения напрямую в заглушку, по одному в step секунд начиная со start
+
+    Первые late сравнений поданы за час до записи, как голоса, воспроизведенные из журнала.
+    legacy - сравнения, записанные до появления written_at (поля нет).
+    """
+    experiment = db.experiments.experiments()[0]
+    fixed_id = db._image_ids[experiment.fixed_key]
+    variant_ids = [db._image_ids[key] for key in experiment.variant_keys()]
+    comparisons = client._docs(config.COMPARISONS_COLLECTION)
+    for i in range(count):
+        data = {
+            'user_id': random.randrange(1, 10_000),
+            'fixed_image_id': fixed_id,
+            'variable_image_id': random.choice(variant_ids),
+            'selected_original': random.random() < 0.5,
+            'created_at': start + datetime.timedelta(seconds=i * step - (3600 if i < late else 0)),
+        }
+        if not legacy:
+            data['written_at'] = start + datetime.timedelta(seconds=i * step)
+        comparisons[uuid.uuid4().hex[:20]] = data
+    client._changed(config.COMPARISONS_COLLECTION)
+    # Индексы заглушки строятся заранее, чтобы не попасть в замер выгрузки
+    client._ordered(config.COMPARISONS_COLLECTION, 'created_at')
+    client._ordered(config.COMPARISONS_COLLECTION, 'written_at')
+    return start + datetime.timedelta(seconds=count * step)
+
+
+def exported_ids(path: str) -> List[str]:
+    with open(path, newline='', encoding='utf-8') as f:
+        return [row['id'] for row in csv.DictReader(f)]
+
+
+async def check_incremental(comparisons: int, new_comparisons: int, page_size: int, chunk_rows: int) -> bool:
+    """Две ночные выгрузки с нуля: прежние сравнения без written_at, затем новые и поданные до отметки"""
+    client = FakeFirestore()
+    db = await create_database(client)
+    settle = 60.0
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Половина сравнений записана до появления written_at
+    insert_comparisons(client, db, comparisons // 2, now - datetime.timedelta(days=30), step=0.01, legacy=True)
+    insert_comparisons(client, db, comparisons - comparisons // 2, now - datetime.timedelta(days=1), step=0.01)
+    # Голоса, поданные до отметки первой выгрузки, но записанные уже после нее (воспроизведены из журнала)
+    insert_comparisons(client, db, new_comparisons, now - datetime.timedelta(seconds=settle / 2),
+                       late=new_comparisons, step=settle / 4 / new_comparisons)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        watermark = os.path.join(tmp, 'watermark.json')
+        first = os.path.join(tmp, 'first.csv')
+        second = os.path.join(tmp, 'second.csv')
+        await export_incremental(first, 'csv', watermark, settle, page_size, chunk_rows, db=db)
+        await export_incremental(second, 'csv', watermark, 0.0, page_size, chunk_rows, db=db)
+        ids = exported_ids(first) + exported_ids(second)
+
+    expected = set(client._docs(config.COMPARISONS_COLLECTION))
+    missing = len(expected - set(ids))
+    duplicates = len(ids) - len(set(ids))
+    print(f"  incremental from scratch: {comparisons // 2} without written_at, "
+          f"{len(ids)} of {len(expected)} exported, {missing} missing, {duplicates} duplicates")
+    return missing == 0 and duplicates == 0
+
+
+async def export_all_in_memory(db, output_path: str) -> int:
+    """Прежний способ: вся коллекция читается в список, имена изображений ищутся по каждому ID"""
+    docs = [doc.to_dict() async for doc in db.db.collection(config.COMPARISONS_COLLECTION).stream()]
+    names = {}
+    rows = []
+    for data in docs:
+        for field in ('fixed_image_id', 'variable_image_id'):
+            if data[field] not in names:
+                image = await db.db.collection(config.IMAGES_COLLECTION).document(data[field]).get()
+                names[data[field]] = image.to_dict()['filename']
+        rows.append({
+            'id': '', 'experiment': '', 'user_id': data['user_id'],
+            'fixed_image': names[data['fixed_image_id']], 'variable_image': names[data['variable_image_id']],
+            'selected_original': data['selected_original'], 'created_at': data['created_at'].isoformat()
+        })
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+async def measure(label: str, client: FakeFirestore, coro):
+    client.round_trips = 0
+    client.reads = 0
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = await coro
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {label:28} {count:>8} rows  {elapsed:6.2f} s  peak {peak / 1e6:7.1f} MB"
+          f"  {client.reads:>8} docs read  {client.round_trips:>5} requests")
+
+
+async def run(comparisons: int, new_comparisons: int, page_size: int, chunk_rows: int):
+    client = FakeFirestore()
+    db = await create_database(client)
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    watermark = insert_comparisons(client, db, comparisons, start)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{comparisons} comparisons, page {page_size}, chunk {chunk_rows} rows")
+        await measure("load all, then write", client, export_all_in_memory(db, os.path.join(tmp, 'all.csv')))
+        await measure("paginated, chunked CSV", client, export_comparisons(
+            os.path.join(tmp, 'full.csv'), 'csv', None, watermark, page_size, chunk_rows, db=db))
+
+        insert_comparisons(client, db, new_comparisons, watermark, late=new_comparisons // 10)
+        await measure(f"incremental (+{new_comparisons})", client, export_comparisons(
+            os.path.join(tmp, 'nightly.csv'), 'csv', watermark, None, page_size, chunk_rows, db=db,
+            time_field='written_at'))
+
+    return await check_incremental(comparisons, new_comparisons, page_size, chunk_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the comparisons export")
+    parser.add_argument('--comparisons', type=int, default=100_000)
+    parser.add_argument('--new-comparisons', type=int, default=2_000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--chunk-rows', type=int, default=10_000)
+    args = parser.parse_args()
+
+    # export_comparisons при импорте настраивает логирование на INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    if not asyncio.run(run(args.comparisons, args.new_comparisons, args.page_size, args.chunk_rows)):
+        sys.exit("Incremental exports lost or duplicated comparisons")
+
+
+if __name__ == "__main__":
+    main()
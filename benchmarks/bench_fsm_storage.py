@@ -0,0 +1,67 @@
+# benchmarks/bench_fsm_storage.py
+# Задержка одного обновления FSM: MemoryStorage против SQLiteStorage
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_fsm_storage --sessions 2000 --updates 10
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from typing import List
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from fsm_storage import SQLiteStorage
+from benchmarks.bench_database import percentile
+
+IMAGES = [f"fs_glasses_{i}.jpg" for i in range(40)]
+
+
+async def simulate_update(storage: BaseStorage, key: StorageKey, index: int):
+    """Одно нажатие кнопки: чтение данных, обновление индекса и выборов, смена состояния"""
+    data = await storage.get_data(key)
+    selections = data.get("selections", {})
+    selections[f"afro.jpg_{IMAGES[index % len(IMAGES)]}"] = index % 2 == 0
+    shown = data.get("shown_comparisons", [])
+    shown.append(["afro.jpg", IMAGES[index % len(IMAGES)]])
+    await storage.update_data(key, {"current_index": index + 1, "selections": selections, "shown_comparisons": shown})
+    await storage.set_state(key, "RatingStates:showing_comparisons")
+
+
+async def run(storage: BaseStorage, sessions: int, updates: int) -> List[float]:
+    keys = [StorageKey(bot_id=1, chat_id=i, user_id=i) for i in range(sessions)]
+    for key in keys:
+        await storage.set_data(key, {"variable_images": random.sample(IMAGES, 10), "current_index": 0, "selections": {}})
+    latencies = []
+    for index in range(updates):
+        for key in keys:
+            started = time.perf_counter()
+            await simulate_update(storage, key, index)
+            latencies.append(time.perf_counter() - started)
+    await storage.close()
+    return latencies
+
+
+def report(name: str, latencies: List[float]):
+    print(f"{name:>8}: updates={len(latencies)} p50={percentile(latencies, 50) * 1e6:.0f}us "
+          f"p99={percentile(latencies, 99) * 1e6:.0f}us total={sum(latencies):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-update FSM storage latency")
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=10)
+    args = parser.parse_args()
+
+    report("memory", asyncio.run(run(MemoryStorage(), args.sessions, args.updates)))
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(os.path.join(tmp, 'fsm.sqlite3'), ttl=3600)
+        report("sqlite", asyncio.run(run(storage, args.sessions, args.updates)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# benchmarks/bench_image_cache.py
+# Загрузка изображений без file_id (новые варианты, новый токен бота): чтение файла
+# через FSInputFile при каждой отправке против кэша содержимого ImageBytesCache
+#
+# Популярность вариантов неравномерная (распределение Ципфа), как у лучших вариантов.
+# Сначала замеряется только получение содержимого файла, затем - загрузка sendPhoto
+# на локальный mock Bot API с несколькими одновременными отправками.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_image_cache --folder images --images 200 --uploads 2000 --max-mb 8
+
+import argparse
+import asyncio
+import glob
+import os
+import random
+import time
+from typing import Callable, List
+
+from benchmarks.bench_database import percentile
+from benchmarks.mock_bot_api import MockBotApiServer
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import FSInputFile
+
+import config
+from image_cache import ImageBytesCache
+
+
+def zipf_sample(paths: List[str], count: int, exponent: float) -> List[str]:
+    weights = [1 / (rank + 1) ** exponent for rank in range(len(paths))]
+    return random.choices(paths, weights=weights, k=count)
+
+
+async def read_fs(bot: Bot, path: str) -> int:
+    return sum([len(chunk) async for chunk in FSInputFile(path).read(bot)])
+
+
+async def read_path(sample: List[str], read: Callable) -> float:
+    started = time.perf_counter()
+    for path in sample:
+        await read(path)
+    return (time.perf_counter() - started) / len(sample)
+
+
+async def upload(bot: Bot, sample: List[str], make_file: Callable, concurrency: int) -> List[float]:
+    latencies = []
+    queue = list(reversed(sample))
+
+    async def worker(chat_id: int):
+        while queue:
+            path = queue.pop()
+            started = time.perf_counter()
+            await bot.send_photo(chat_id=chat_id, photo=await make_file(path))
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker(i + 1) for i in range(concurrency)))
+    return latencies
+
+
+async def run(args):
+    paths = sorted(glob.glob(os.path.join(args.folder, '**', '*.jpg'), recursive=True))[:args.images]
+    random.shuffle(paths)
+    sample = zipf_sample(paths, args.uploads, args.zipf)
+    total_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+
+    server = MockBotApiServer(latency=args.api_latency)
+    url = await server.start()
+    bot = Bot(token='123456:bench', session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    max_bytes = int(args.max_mb * 1024 * 1024)
+    try:
+        print(f"{len(paths)} images ({total_mb:.1f} MiB), {args.uploads} uploads, zipf {args.zipf}, "
+              f"cache {args.max_mb:g} MiB")
+
+        fs = await read_path(sample, lambda path: read_fs(bot, path))
+        cache = ImageBytesCache(max_bytes)
+        cached = await read_path(sample, cache.read)
+        print(f"  read, FSInputFile          {fs * 1e6:8.1f} us/upload")
+        print(f"  read, ImageBytesCache      {cached * 1e6:8.1f} us/upload  hits {cache.hits}  misses {cache.misses}  "
+              f"({cache.hits / len(sample) * 100:.1f}% hit rate, {cache.size / 1024 / 1024:.1f} MiB held)")
+
+        for name, make_file in (
+                ("FSInputFile", lambda path: asyncio.sleep(0, FSInputFile(path))),
+                ("ImageBytesCache", ImageBytesCache(max_bytes).input_file)):
+            started = time.perf_counter()
+            latencies = await upload(bot, sample, make_file, args.concurrency)
+            elapsed = time.perf_counter() - started
+            print(f"  sendPhoto, {name:<16} {len(sample) / elapsed:7.0f} uploads/s  "
+                  f"p50 {percentile(latencies, 50) * 1000:6.1f} ms  p99 {percentile(latencies, 99) * 1000:6.1f} ms")
+    finally:
+        await bot.session.close()
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark uploads from disk against the in-memory image cache")
+    parser.add_argument('--folder', default=config.IMAGES_FOLDER, help="папка с изображениями (с подпапками)")
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--uploads', type=int, default=2000)
+    parser.add_argument('--zipf', type=float, default=1.1, help="показатель распределения популярности")
+    parser.add_argument('--max-mb', type=float, default=8.0, help="размер кэша, МиБ")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--api-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# benchmarks/bench_load.py
+# Нагрузочный тест одного процесса bot.py: N пользователей проходят /start -> "Начать" ->
+# голоса и тайм-ауты через настоящие обработчики dp
+#
+# Бот работает в режиме polling с обычной aiohttp-сессией против локального HTTP-сервера
+# Bot API (mock_bot_api), база данных - Firestore-заглушка с задержкой запросов. Отчет:
+# пропускная способность, перцентили задержки обработчиков и ответа на нажатие,
+# задержка цикла событий и память на сессию.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_load --users 200 --think-time 0.5 --db-latency 0.005
+
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List
+
+from benchmarks.harness import load_bot, start_services, stop_services
+from benchmarks.bench_database import percentile
+from benchmarks.mock_bot_api import MockBotApiServer
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import config
+from metrics import LoopLagMonitor
+
+
+class HandlerTimer:
+    """Middleware обработчиков dp: время выполнения каждого обработчика по имени"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.latencies[data['handler'].callback.__name__].append(time.perf_counter() - started)
+
+
+def memory_usage(traced: bool) -> int:
+    """Байты кучи Python (tracemalloc) или резидентной памяти процесса"""
+    gc.collect()
+    if traced:
+        return tracemalloc.get_traced_memory()[0]
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class LoadDriver:
+    """Пользователи, которые пишут боту через mock-сервер и ждут его ответов"""
+
+    def __init__(self, server: MockBotApiServer, think_time: float, timeout_rate: float, step_timeout: float):
+        self.server = server
+        self.think_time = think_time
+        self.timeout_rate = timeout_rate
+        self.step_timeout = step_timeout
+        self.tap_latencies: List[float] = []
+        self.votes = 0
+        self.timeouts = 0
+        self.failed = 0
+
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    async def _step(self, user_id: int, update: Dict):
+        """Отправляет обновление и ждет следующего сообщения бота с клавиатурой"""
+        version = self.server.keyboard_version(user_id)
+        await self.server.emit(update)
+        return await self.server.next_keyboard(user_id, version, self.step_timeout)
+
+    async def _press(self, user_id: int, message: Dict, data: str):
+        return await self._step(user_id, {'callback_query': {
+            'id': f'{user_id}-{time.monotonic_ns()}',
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': message
+        }})
+
+    async def run_user(self, user_id: int, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            _, message = await self._step(user_id, {'message': {
+                'message_id': 0,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self._user(user_id),
+                'text': '/start',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+            }})
+            version, message = await self._press(user_id, message, 'start_comparison')
+            while message['reply_markup']['inline_keyboard'][0][0]['callback_data'].startswith('select_original'):
+                if random.random() < self.timeout_rate:
+                    # Пользователь не отвечает: следующее сравнение придет по тайм-ауту
+                    version, message = await self.server.next_keyboard(user_id, version, self.step_timeout)
+                    self.timeouts += 1
+                    continue
+                if self.think_time:
+                    await asyncio.sleep(random.expovariate(1 / self.think_time))
+                    if self.server.keyboard_version(user_id) > version:
+                        # Пока пользователь думал, время вышло и бот показал следующий шаг
+                        version, message = self.server.keyboard(user_id)
+                        self.timeouts += 1
+                        continue
+                started = time.perf_counter()
+                version, message = await self._press(
+                    user_id, message, random.choice(message['reply_markup']['inline_keyboard'][0])['callback_data'])
+                self.tap_latencies.append(time.perf_counter() - started)
+                self.votes += 1
+        except asyncio.TimeoutError:
+            self.failed += 1
+
+
+async def run(args):
+    config.RESPONSE_TIMEOUT = args.response_timeout
+    config.COMPARISON_MODE = args.mode
+
+    server = MockBotApiServer(latency=args.api_latency)
+    url = await server.start()
+    bot_module, _ = load_bot(db_latency=args.db_latency, rate_limit=args.rate_limit,
+                             session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    timer = HandlerTimer()
+    bot_module.dp.message.middleware(timer)
+    bot_module.dp.callback_query.middleware(timer)
+    await start_services(bot_module)
+    for experiment in bot_module.experiments.experiments():
+        await bot_module.composite_cache.prebuild(experiment.fixed_path, experiment.catalog.paths())
+
+    polling = asyncio.create_task(bot_module.dp.start_polling(
+        bot_module.bot, handle_signals=False, close_bot_session=False, polling_timeout=1))
+    driver = LoadDriver(server, args.think_time, args.timeout_rate, args.step_timeout)
+    lags: List[float] = []
+    monitor = LoopLagMonitor(interval=0.01, observe=lags.append)
+    try:
+        # Прогрев: кэш file_id заполнен, соединения с сервером открыты
+        await asyncio.gather(*(driver.run_user(i, 0) for i in range(1, 4)))
+        server.reset()
+        timer.latencies.clear()
+        driver.tap_latencies.clear()
+        driver.votes = driver.timeouts = driver.failed = 0
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        baseline = memory_usage(args.tracemalloc)
+        monitor.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(driver.run_user(1000 + i, random.uniform(0, args.ramp))
+                               for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        await monitor.stop()
+        # Состояние завершенных сессий остается в хранилище FSM до следующего /start
+        retained = memory_usage(args.tracemalloc) - baseline
+        if args.tracemalloc:
+            tracemalloc.stop()
+    finally:
+        await bot_module.dp.stop_polling()
+        await polling
+        await stop_services(bot_module)
+        await bot_module.bot.session.close()
+        await server.stop()
+
+    updates = sum(len(values) for values in timer.latencies.values())
+    print(f"{args.users} users, mode {args.mode}, think {args.think_time}s, timeouts {args.timeout_rate:.0%}, "
+          f"db latency {args.db_latency * 1000:g} ms, api latency {args.api_latency * 1000:g} ms")
+    print(f"  elapsed {elapsed:.2f}s  votes {driver.votes} ({driver.votes / elapsed:.0f}/s)  "
+          f"updates {updates} ({updates / elapsed:.0f}/s)  timeouts {driver.timeouts}  stalled users {driver.failed}")
+    print(f"  API calls {sum(server.calls.values())} ({sum(server.calls.values()) / elapsed:.0f}/s)  uploads {server.uploads}")
+    print(f"  tap -> next comparison  p50 {percentile(driver.tap_latencies, 50) * 1000:7.1f} ms  "
+          f"p95 {percentile(driver.tap_latencies, 95) * 1000:7.1f} ms  p99 {percentile(driver.tap_latencies, 99) * 1000:7.1f} ms")
+    for name, values in sorted(timer.latencies.items()):
+        print(f"  {name:22} n={len(values):<6} p50 {percentile(values, 50) * 1000:7.1f} ms  "
+              f"p95 {percentile(values, 95) * 1000:7.1f} ms  p99 {percentile(values, 99) * 1000:7.1f} ms")
+    print(f"  event loop lag  p50 {percentile(lags, 50) * 1000:.1f} ms  "
+          f"p99 {percentile(lags, 99) * 1000:.1f} ms  max {max(lags, default=0) * 1000:.1f} ms")
+    kind = "python heap" if args.tracemalloc else "RSS"
+    print(f"  memory per session ({kind}): {retained / args.users / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test bot.py handlers with a local Bot API server")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ramp', type=float, default=2.0, help="пользователи приходят равномерно за это время, сек")
+    parser.add_argument('--think-time', type=float, default=0.5, help="среднее время на выбор, сек")
+    parser.add_argument('--timeout-rate', type=float, default=0.05, help="доля сравнений без ответа")
+    parser.add_argument('--response-timeout', type=float, default=2.0, help="RESPONSE_TIMEOUT для теста, сек")
+    parser.add_argument('--step-timeout', type=float, default=60.0, help="сколько ждать ответа бота, сек")
+    parser.add_argument('--mode', choices=('media_group', 'edit'), default=config.COMPARISON_MODE)
+    parser.add_argument('--db-latency', type=float, default=0.005, help="задержка запроса к Firestore, сек")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, сек")
+    parser.add_argument('--rate-limit', action='store_true', help="включить ограничитель исходящих запросов")
+    parser.add_argument('--tracemalloc', action='store_true', help="память на сессию по куче Python, а не по RSS")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.disable(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
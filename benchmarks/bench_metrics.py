@@ -0,0 +1,55 @@
+# benchmarks/bench_metrics.py
+# Накладные расходы метрик: запись в гистограмму, вызов метода базы через
+# InstrumentedDatabase против прямого вызова и формирование ответа /metrics
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_metrics --calls 200000
+
+import argparse
+import asyncio
+import time
+
+from metrics import InstrumentedDatabase, MetricsRegistry
+
+
+class NoopDatabase:
+    async def save_user(self, user_id: int):
+        return True
+
+
+async def call_loop(db, calls: int) -> float:
+    started = time.perf_counter()
+    for i in range(calls):
+        await db.save_user(i)
+    return (time.perf_counter() - started) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of the metrics instrumentation")
+    parser.add_argument('--calls', type=int, default=200_000)
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    histogram = registry.histogram('bench_seconds', "Benchmark histogram", ('handler',))
+    started = time.perf_counter()
+    for i in range(args.calls):
+        histogram.labels('on_comparison_selected').observe(i * 1e-6)
+    print(f"  histogram observe          {(time.perf_counter() - started) / args.calls * 1e9:7.0f} ns")
+
+    direct = asyncio.run(call_loop(NoopDatabase(), args.calls))
+    wrapped = asyncio.run(call_loop(InstrumentedDatabase(NoopDatabase()), args.calls))
+    print(f"  database call, direct      {direct * 1e9:7.0f} ns")
+    print(f"  database call, instrumented {wrapped * 1e9:6.0f} ns  (+{(wrapped - direct) * 1e9:.0f} ns)")
+
+    # Типичный набор рядов: десяток обработчиков, методов базы и методов Bot API
+    for name in ('handler', 'database', 'api'):
+        metric = registry.histogram(f'bench_{name}_seconds', "Benchmark histogram", ('label',))
+        for label in range(15):
+            metric.labels(str(label)).observe(0.01)
+    started = time.perf_counter()
+    text = registry.render()
+    print(f"  render /metrics            {(time.perf_counter() - started) * 1000:7.2f} ms  ({len(text)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# benchmarks/bench_races.py
+# Стресс-тест гонок в сессии: двойные нажатия, повторная доставка нажатия и нажатия
+# одновременно с тайм-аутом у многих пользователей сразу
+#
+# FSM-хранилище отвечает с задержкой --storage-latency, как Redis или SQLite в отдельном
+# потоке: между чтением данных сессии и их обновлением обработчик уступает event loop.
+# В MemoryStorage этого не происходит, и без блокировок гонка почти не воспроизводится.
+#
+# Режим unsafe воспроизводит прежнее поведение: без блокировок чатов и с кнопками без
+# номера сравнения. В нем одно сравнение должно получать несколько голосов и отправляться
+# повторно, в обычном режиме дубликатов быть не должно. Скрипт завершается с ошибкой, если
+# в обычном режиме есть дубликаты или если режим unsafe гонку не воспроизвел: тогда
+# тест ничего не доказывает.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_races --users 100
+#
+# Результат с параметрами по умолчанию (100 пользователей, задержка хранилища 1 мс):
+#     serialized: 852 голоса, 0 дубликатов, 0 повторно отправленных сравнений, 0 ошибок
+#     unsafe:     1301 голос, 368 дубликатов, 404 повторно отправленных сравнения, 1 ошибка
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import random
+import sys
+from collections import Counter
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from benchmarks.harness import SessionDriver, load_bot, start_services, stop_services
+
+import config
+
+
+class NoLocks:
+    """Заглушка ChatLocks: прежнее поведение без блокировок"""
+
+    def __len__(self) -> int:
+        return 0
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, chat_id):
+        yield
+
+
+class LatencyStorage(BaseStorage):
+    """FSM-хранилище с задержкой каждого обращения, как у хранилища за сетью"""
+
+    def __init__(self, storage: BaseStorage, latency: float):
+        self.storage = storage
+        self.latency = latency
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await asyncio.sleep(self.latency)
+        await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        await asyncio.sleep(self.latency)
+        return await self.storage.get_state(key)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await asyncio.sleep(self.latency)
+        await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        await asyncio.sleep(self.latency)
+        return await self.storage.get_data(key)
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+class RaceDriver(SessionDriver):
+    """Пользователь, который жмет кнопки дважды, повторяет запросы и отвечает на грани тайм-аута"""
+
+    def __init__(self, bot_module, session, legacy_buttons: bool, rates: Dict[str, float]):
+        super().__init__(bot_module, session)
+        self.legacy_buttons = legacy_buttons
+        self.rates = rates
+        self.actions: Counter = Counter()
+        self.errors = 0
+
+    def _callback(self, user_id: int, data: str) -> Dict:
+        message = self.session.keyboard_messages[user_id]
+        buttons = [button['callback_data'] for row in message['reply_markup']['inline_keyboard'] for button in row]
+        data = next(button for button in buttons if button.split(':')[0] == data)
+        if self.legacy_buttons:
+            data = data.split(':')[0]
+        return {
+            'id': f'{user_id}-{next(self._update_ids)}',
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': message
+        }
+
+    async def tap(self, callback: Dict):
+        try:
+            await self.feed({'callback_query': dict(callback)})
+        except Exception:
+            # Например, IndexError, когда два нажатия проходят за последним сравнением
+            self.errors += 1
+
+    async def run_user(self, user_id: int):
+        await self.command(user_id, '/start')
+        await self.press(user_id, 'start_comparison')
+        finished = self.bot_module.RatingStates.finished.state
+        for _ in range(config.IMAGES_PER_SESSION * 3):
+            if await self.state(user_id) == finished:
+                return
+            callback = self._callback(user_id, random.choice(('select_original', 'select_variant')))
+            action = random.random()
+            if action < self.rates['double_tap']:
+                self.actions['double tap'] += 1
+                await asyncio.gather(self.tap(callback), self.tap({**callback, 'id': callback['id'] + 'b'}))
+            elif action < self.rates['double_tap'] + self.rates['redelivery']:
+                self.actions['redelivered tap'] += 1
+                await asyncio.gather(self.tap(callback), self.tap(callback))
+            elif action < self.rates['double_tap'] + self.rates['redelivery'] + self.rates['timeout_race']:
+                self.actions['tap at timeout'] += 1
+                resolution = self.bot_module.timeout_scheduler.resolution
+                await asyncio.sleep(config.RESPONSE_TIMEOUT + random.uniform(-resolution, resolution))
+                await self.tap(callback)
+            else:
+                self.actions['tap'] += 1
+                await self.tap(callback)
+
+
+async def run_mode(bot_module, session, users: int, first_user: int, unsafe: bool, rates: Dict[str, float]) -> Dict:
+    submitted = []
+    submit = bot_module.comparison_writer.submit
+
+    def counting_submit(**kwargs):
+        submitted.append((kwargs['user_id'], kwargs['variable_image']))
+        if unsafe:
+            # Прежде у каждого голоса был случайный ID
+            kwargs['vote_id'] = None
+        return submit(**kwargs)
+
+    prompts = []
+
+    async def record_prompts(make_request, bot, method):
+        # Сравнение определяется номером в кнопках: текст включает уведомление о прошлом шаге
+        markup = getattr(method, 'reply_markup', None)
+        if markup is not None and markup.inline_keyboard[0][0].callback_data.startswith('select_'):
+            prompts.append((method.chat_id, markup.inline_keyboard[0][0].callback_data))
+        return await make_request(bot, method)
+
+    bot_module.comparison_writer.submit = counting_submit
+    session.middleware(record_prompts)
+    driver = RaceDriver(bot_module, session, legacy_buttons=unsafe, rates=rates)
+    try:
+        await asyncio.gather(*(driver.run_user(first_user + i) for i in range(users)))
+        await bot_module.comparison_writer.flush()
+    finally:
+        bot_module.comparison_writer.submit = submit
+        session.middleware.unregister(record_prompts)
+
+    user_ids = set(range(first_user, first_user + users))
+    comparisons = bot_module.db.db._docs(config.COMPARISONS_COLLECTION).values()
+    rows = Counter((doc['user_id'], doc['variable_image_id']) for doc in comparisons if doc['user_id'] in user_ids)
+    votes = Counter(submitted)
+    shown = Counter(prompts)
+    return {
+        'actions': dict(driver.actions),
+        'errors': driver.errors,
+        'votes': len(submitted),
+        'duplicate_votes': sum(count - 1 for count in votes.values()),
+        'rows': sum(rows.values()),
+        'duplicate_rows': sum(count - 1 for count in rows.values()),
+        'prompts': len(prompts),
+        'duplicate_prompts': sum(count - 1 for count in shown.values()),
+    }
+
+
+async def run(args):
+    config.RESPONSE_TIMEOUT = args.response_timeout
+    bot_module, session = load_bot(db_latency=args.db_latency, api_latency=args.api_latency, rate_limit=False)
+    bot_module.timeout_scheduler.resolution = 0.05
+    bot_module.dp.fsm.storage = LatencyStorage(bot_module.dp.fsm.storage, args.storage_latency)
+    await start_services(bot_module)
+    rates = {'double_tap': args.double_tap, 'redelivery': args.redelivery, 'timeout_race': args.timeout_race}
+    try:
+        results = [('serialized', await run_mode(bot_module, session, args.users, 1000, False, rates))]
+
+        # Прежнее поведение: без middleware и блокировок, кнопки без номера сравнения
+        serializer = next(m for m in bot_module.dp.update.outer_middleware
+                          if type(m).__name__ == 'ChatSerializationMiddleware')
+        bot_module.dp.update.outer_middleware.unregister(serializer)
+        bot_module.chat_locks = NoLocks()
+        results.append(('unsafe', await run_mode(bot_module, session, args.users, 100_000, True, rates)))
+    finally:
+        await stop_services(bot_module)
+
+    print(f"{args.users} users x {config.IMAGES_PER_SESSION} comparisons, response timeout {args.response_timeout}s")
+    for mode, result in results:
+        print(f"{mode:>11}: {result['actions']}")
+        print(f"{'':>11}  votes {result['votes']} (duplicates {result['duplicate_votes']})  "
+              f"rows {result['rows']} (duplicates {result['duplicate_rows']})  "
+              f"comparisons sent {result['prompts']} (duplicates {result['duplicate_prompts']})  "
+              f"handler errors {result['errors']}")
+
+    serialized, unsafe = results[0][1], results[1][1]
+    failures = []
+    if serialized['duplicate_votes'] or serialized['duplicate_rows'] or serialized['duplicate_prompts'] or serialized['errors']:
+        failures.append("serialized mode produced duplicates or handler errors")
+    if not unsafe['duplicate_votes'] or not unsafe['duplicate_prompts']:
+        failures.append("unsafe mode did not reproduce duplicate votes and repeated comparisons")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress-test concurrent taps and timeouts within sessions")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--double-tap', type=float, default=0.3, help="доля двойных нажатий")
+    parser.add_argument('--redelivery', type=float, default=0.1, help="доля повторно доставленных нажатий")
+    parser.add_argument('--timeout-race', type=float, default=0.2, help="доля нажатий на грани тайм-аута")
+    parser.add_argument('--response-timeout', type=float, default=0.5)
+    parser.add_argument('--db-latency', type=float, default=0.005)
+    parser.add_argument('--storage-latency', type=float, default=0.001, help="задержка FSM-хранилища, с")
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.disable(logging.WARNING)
+    failures = asyncio.run(run(args))
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
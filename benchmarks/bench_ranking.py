@@ -0,0 +1,102 @@
+# benchmarks/bench_ranking.py
+# Модель Брэдли-Терри на синтетическом журнале из миллионов голосов: время обучения
+# (Ньютон и MM, со склонностями пользователей и без), дообучение на новых голосах и точность
+#
+# У вариантов есть истинная сила относительно оригинала, у пользователей - склонность выбирать
+# оригинал; голоса генерируются по модели, затем модель восстанавливает силы по журналу.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_ranking --votes 2000000
+
+import argparse
+import time
+
+import numpy as np
+
+from ranking import BradleyTerry, ComparisonLog
+
+
+def spearman(x: np.ndarray, y: np.ndarray) -> float:
+    rx = np.argsort(np.argsort(x))
+    ry = np.argsort(np.argsort(y))
+    return float(np.corrcoef(rx, ry)[0, 1])
+
+
+def generate(rng: np.random.Generator, experiments: int, variants: int, users: int, votes: int, bias_std: float):
+    """Случайные голоса: (фиксированное, вариант, пользователь, выбран оригинал) и истинные параметры"""
+    # Изображения эксперимента e: оригинал e * (variants + 1), варианты следом за ним
+    true_scores = rng.normal(0.0, 1.0, experiments * (variants + 1))
+    true_scores[::variants + 1] = 0.0
+    true_bias = rng.normal(0.0, bias_std, users)
+
+    experiment = rng.integers(0, experiments, votes)
+    fixed = (experiment * (variants + 1)).astype(np.int32)
+    variable = (fixed + rng.integers(1, variants + 1, votes)).astype(np.int32)
+    user = rng.integers(0, users, votes).astype(np.int32)
+    p = 1.0 / (1.0 + np.exp(-(true_scores[fixed] - true_scores[variable] + true_bias[user])))
+    selected_original = rng.random(votes) < p
+    return fixed, variable, user, selected_original, true_scores
+
+
+def make_log(experiments: int, variants: int, users: int) -> ComparisonLog:
+    log = ComparisonLog()
+    log.images.ids([f'img_{e}/{"afro" if k == 0 else f"variant_{k}"}.jpg'
+                    for e in range(experiments) for k in range(variants + 1)])
+    log.users.ids(list(range(users)))
+    return log
+
+
+def accuracy(model: BradleyTerry, true_scores: np.ndarray, variants: int) -> str:
+    fixed_index = np.repeat(np.arange(0, len(true_scores), variants + 1), variants + 1)
+    mask = np.arange(len(true_scores)) % (variants + 1) != 0
+    estimated = (model.scores - model.scores[fixed_index])[mask]
+    truth = true_scores[mask]
+    return f"spearman {spearman(estimated, truth):.4f}, mean abs error {np.mean(np.abs(estimated - truth)):.3f}"
+
+
+def timed(label: str, fn):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:34} {elapsed:7.2f} s  ({result} iterations)" if result is not None else f"  {label:34} {elapsed:7.2f} s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Bradley-Terry ranking model")
+    parser.add_argument('--votes', type=int, default=2_000_000)
+    parser.add_argument('--experiments', type=int, default=50)
+    parser.add_argument('--variants', type=int, default=200)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--bias-std', type=float, default=0.7, help="разброс склонности пользователей к оригиналу")
+    parser.add_argument('--new-votes', type=int, default=10_000, help="размер порции для дообучения")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    fixed, variable, user, selected, true_scores = generate(
+        rng, args.experiments, args.variants, args.users, args.votes + args.new_votes, args.bias_std)
+    old, new = slice(0, args.votes), slice(args.votes, None)
+
+    print(f"{args.votes} votes, {args.experiments} experiments x {args.variants} variants, {args.users} users")
+    log = make_log(args.experiments, args.variants, args.users)
+    timed("append to log", lambda: log.append(fixed[old], variable[old], user[old], selected[old]))
+    nbytes = sum(a.nbytes for a in (log.fixed, log.variable, log.user, log.selected_original))
+    print(f"  log arrays: {nbytes / 1e6:.1f} MB ({nbytes / log.size:.0f} bytes/vote)")
+
+    for label, user_bias, method in (("plain, newton", False, 'newton'), ("plain, mm", False, 'mm'),
+                                     ("user bias, newton", True, 'newton')):
+        model = BradleyTerry(log, user_bias=user_bias)
+        timed(f"fit {label}", lambda: model.fit(method=method, max_iter=50 if method == 'newton' else 1000))
+        print(f"    {accuracy(model, true_scores, args.variants)}")
+        if method == 'newton':
+            def update():
+                model.log.append(fixed[new], variable[new], user[new], selected[new])
+                return model.fit(max_iter=3)
+            timed(f"update +{args.new_votes} votes", update)
+            # Журнал общий: откатываем добавленные голоса для следующей модели
+            log.size = args.votes
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# benchmarks/bench_sampler.py
+# Офлайн-симуляция выбора вариантов: сколько голосов нужно, чтобы с заданной уверенностью
+# определить верх рейтинга, при равномерном выборе и при томпсоновском сэмплировании
+#
+# У каждого варианта есть истинная вероятность победы над оригиналом; пользователи проходят
+# сессии по IMAGES_PER_SESSION вариантов и не видят один вариант дважды. Рейтинг считается
+# установленным, когда верхние --top вариантов по апостериорному среднему отделены от остальных:
+# нижняя граница 95% интервала у каждого из них выше верхней границы у каждого из остальных
+# (с допуском --epsilon на почти равные варианты).
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_sampler --variants 100 --runs 20
+
+import argparse
+import math
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sampling import ThompsonSampler, UniformSampler, VariantSampler
+from benchmarks.bench_database import percentile
+
+Z = 1.96
+
+
+def interval(wins: int, losses: int) -> Tuple[float, float, float]:
+    """Апостериорное среднее Beta(wins + 1, losses + 1) и нормальное приближение 95% интервала"""
+    a, b = wins + 1, losses + 1
+    mean = a / (a + b)
+    std = math.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+    return mean, mean - Z * std, mean + Z * std
+
+
+def top_resolved(counts: Dict[str, List[int]], top: int, epsilon: float) -> Optional[List[str]]:
+    """Верхние top вариантов, если они уверенно отделены от остальных, иначе None"""
+    stats = sorted(((interval(*c), key) for key, c in counts.items()), reverse=True)
+    leaders, rest = stats[:top], stats[top:]
+    if not rest or min(s[0][1] for s in leaders) > max(s[0][2] for s in rest) - epsilon:
+        return [key for _, key in leaders]
+    return None
+
+
+def simulate(sampler: VariantSampler, truth: Dict[str, float], top: int, epsilon: float,
+             session_size: int, sessions_per_user: int, max_votes: int, rng: random.Random) -> Tuple[int, bool]:
+    """Возвращает (число голосов до установленного рейтинга, верен ли этот рейтинг)"""
+    keys = sorted(truth)
+    counts = {key: [0, 0] for key in keys}
+    true_top = set(sorted(keys, key=truth.get, reverse=True)[:top])
+    # Допустимый верх: варианты не хуже top-го с учетом допуска
+    threshold = sorted(truth.values(), reverse=True)[top - 1] - epsilon
+
+    votes = 0
+    user_id = 0
+    while votes < max_votes:
+        user_id += 1
+        seen = set()
+        for _ in range(sessions_per_user):
+            selected = sampler.select(keys, session_size, seen)
+            if not selected:
+                break
+            for key in selected:
+                won = rng.random() < truth[key]
+                counts[key][0 if won else 1] += 1
+                sampler.observe(key, 1 if won else 0, 0 if won else 1)
+                seen.add(key)
+                votes += 1
+            resolved = top_resolved(counts, top, epsilon)
+            if resolved is not None:
+                correct = set(resolved) == true_top or all(truth[key] >= threshold for key in resolved)
+                return votes, correct
+    return votes, False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate adaptive vs uniform variant selection")
+    parser.add_argument('--variants', type=int, default=100)
+    parser.add_argument('--top', type=int, default=10, help="размер верха рейтинга (как в /top)")
+    parser.add_argument('--epsilon', type=float, default=0.05, help="допуск на почти равные варианты")
+    parser.add_argument('--session-size', type=int, default=10)
+    parser.add_argument('--sessions-per-user', type=int, default=3)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-votes', type=int, default=500_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    samplers = {'uniform': UniformSampler, 'thompson': ThompsonSampler}
+    results: Dict[str, List[Tuple[int, bool]]] = {name: [] for name in samplers}
+    for run in range(args.runs):
+        # Истинные доли побед вариантов над оригиналом
+        truth_rng = random.Random(args.seed * 1000 + run)
+        truth = {f'img_0/variant_{i}.jpg': truth_rng.betavariate(2, 3) for i in range(args.variants)}
+        for name, factory in samplers.items():
+            rng = random.Random(args.seed * 1000 + run)
+            sampler = factory(rng=random.Random(rng.random()))
+            results[name].append(simulate(sampler, truth, args.top, args.epsilon, args.session_size,
+                                          args.sessions_per_user, args.max_votes, rng))
+
+    print(f"{args.variants} variants, top {args.top}, epsilon {args.epsilon}, {args.runs} runs")
+    for name, runs in results.items():
+        votes = [v for v, _ in runs]
+        correct = sum(1 for _, ok in runs if ok)
+        print(f"  {name:9} votes to resolve top: p50 {percentile(votes, 50):>8.0f}  p90 {percentile(votes, 90):>8.0f}"
+              f"  correct {correct}/{len(runs)}")
+
+    # Стоимость выбора одной сессии в зависимости от числа вариантов
+    for n in (1_000, 100_000):
+        keys = [f'img_0/variant_{i}.jpg' for i in range(n)]
+        for name, factory in samplers.items():
+            sampler = factory()
+            sampler.select(keys, args.session_size, set())
+            seen = set(random.sample(keys, min(200, n)))
+            times = []
+            for _ in range(2000):
+                started = time.perf_counter()
+                for key in sampler.select(keys, args.session_size, seen):
+                    sampler.observe(key, 1, 0)
+                times.append(time.perf_counter() - started)
+            print(f"  {name:9} select+observe, {n:>7} variants: p50 {percentile(times, 50) * 1e6:8.1f} us")
+
+
+if __name__ == "__main__":
+    main()
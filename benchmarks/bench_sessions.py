@@ -0,0 +1,165 @@
+# benchmarks/bench_sessions.py
+# Память FSM-хранилища на 100 тысяч сессий: прежний формат данных (ключи изображений,
+# словарь selections, растущий список shown_comparisons) в MemoryStorage против
+# компактного формата session_state в MemoryStorage и в TTLMemoryStorage, а также
+# вытеснение неактивных сессий по TTL
+#
+# У каждого пользователя за плечами случайное число прошлых сессий (до --max-history):
+# в прежнем формате они копятся в shown_comparisons, в компактном - в битовом массиве.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_sessions --sessions 100000 --variants 500
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from benchmarks.bench_database import percentile
+
+import config
+from catalog import ImageCatalog, ImageEntry
+from experiments import Experiment
+from fsm_storage import TTLMemoryStorage
+from session_state import add_shown, encode_variants, record_vote
+
+STATE = "RatingStates:showing_comparisons"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_experiment(variants: int) -> Experiment:
+    """Эксперимент с синтетическим каталогом: индекс заполняется без файлов на диске"""
+    folder = os.path.join(tempfile.gettempdir(), 'bench_sessions')
+    catalog = ImageCatalog(folder, os.path.join(folder, 'catalog.json'))
+    names = ['afro.jpg'] + [f'fs_variant_{i:05d}.jpg' for i in range(variants)]
+    catalog._apply({name: ImageEntry(name, 90_000, 0, '0' * 64) for name in names})
+    return Experiment('exp_hair', folder, 'afro.jpg', catalog)
+
+
+def make_session(experiment: Experiment, history: int, rng: random.Random) -> Dict:
+    """Сессия пользователя: прошлые показы, текущие варианты, номер сравнения и ответы"""
+    variant_keys = experiment.variant_keys()
+    shown = rng.sample(variant_keys, min(len(variant_keys), history * config.IMAGES_PER_SESSION))
+    current = rng.sample(variant_keys, config.IMAGES_PER_SESSION)
+    index = rng.randrange(config.IMAGES_PER_SESSION)
+    answers = [rng.random() < 0.5 for _ in range(index)]
+    return {'shown': shown + current[:index], 'current': current, 'index': index, 'answers': answers}
+
+
+def legacy_data(experiment: Experiment, session: Dict) -> Dict:
+    return {
+        'session_id': 'a1b2c3d4e5f60718',
+        'experiment': experiment.id,
+        'variable_images': session['current'],
+        'current_index': session['index'],
+        'shown_comparisons': [[experiment.fixed_key, key] for key in session['shown']],
+        'selections': {f"{experiment.fixed_key}_{key}": answer for key, answer in zip(session['current'], session['answers'])},
+        'comparison_message_id': None
+    }
+
+
+def compact_data(experiment: Experiment, session: Dict) -> Dict:
+    data = {
+        'session_id': 'a1b2c3d4e5f60718',
+        'experiment': experiment.id,
+        'catalog': experiment.catalog.generation,
+        'variants': encode_variants(experiment, session['current']),
+        'current_index': session['index'],
+        'shown': add_shown({}, experiment, [key.rsplit('/', 1)[-1] for key in session['shown']]),
+        'comparison_message_id': None
+    }
+    for index, answer in enumerate(session['answers']):
+        data.update(record_vote(data, index, answer))
+    return data
+
+
+async def fill(storage: BaseStorage, sessions: List[Dict], encode, clock: FakeClock = None) -> float:
+    """Записывает сессии в хранилище; возвращает занятую память в байтах"""
+    tracemalloc.start()
+    for user_id, session in enumerate(sessions):
+        if clock is not None:
+            clock.now = user_id
+        key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+        await storage.set_state(key, STATE)
+        await storage.set_data(key, encode(session))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used
+
+
+async def update_latency(storage: BaseStorage, users: int, updates: int) -> float:
+    """Среднее время одного шага сессии: чтение данных и запись номера сравнения"""
+    started = time.perf_counter()
+    for i in range(updates):
+        key = StorageKey(bot_id=1, chat_id=i % users, user_id=i % users)
+        data = await storage.get_data(key)
+        await storage.update_data(key, {'current_index': data.get('current_index', 0) + 1})
+    return (time.perf_counter() - started) / updates
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    experiment = make_experiment(args.variants)
+    sessions = [make_session(experiment, rng.randint(0, args.max_history), rng) for _ in range(args.sessions)]
+
+    legacy_sizes = [len(json.dumps(legacy_data(experiment, session))) for session in sessions[:10_000]]
+    compact_sizes = [len(json.dumps(compact_data(experiment, session))) for session in sessions[:10_000]]
+    print(f"{args.sessions} sessions, {args.variants} variants, up to {args.max_history} past sessions per user, "
+          f"history cap {config.SESSION_HISTORY_MAX_BYTES} bytes")
+    print(f"  JSON per session, legacy   p50 {percentile(legacy_sizes, 50):6.0f} B  max {max(legacy_sizes):6d} B")
+    print(f"  JSON per session, compact  p50 {percentile(compact_sizes, 50):6.0f} B  max {max(compact_sizes):6d} B")
+
+    results = []
+    for name, storage, encode in (
+            ("MemoryStorage, legacy", MemoryStorage(), lambda s: legacy_data(experiment, s)),
+            ("MemoryStorage, compact", MemoryStorage(), lambda s: compact_data(experiment, s)),
+            ("TTLMemoryStorage, compact", TTLMemoryStorage(), lambda s: compact_data(experiment, s))):
+        used = await fill(storage, sessions, encode)
+        latency = await update_latency(storage, args.sessions, 20_000)
+        results.append(used)
+        print(f"  {name:<26} {used / 1024 / 1024:7.1f} MiB  {used / args.sessions:6.0f} B/session  "
+              f"step {latency * 1e6:5.1f} us")
+        await storage.close()
+    print(f"  memory vs legacy: {results[2] / results[0] * 100:.0f}%")
+
+    # Вытеснение: сессии обновлялись раз в секунду, в пределах TTL остаются последние --active
+    clock = FakeClock()
+    storage = TTLMemoryStorage(ttl=args.active, eviction_interval=args.sessions * 2, clock=clock)
+    used = await fill(storage, sessions, lambda s: compact_data(experiment, s), clock)
+    clock.now = args.sessions
+    started = time.perf_counter()
+    evicted = storage.evict_expired()
+    elapsed = time.perf_counter() - started
+    print(f"  TTL eviction: {evicted} idle sessions evicted in {elapsed * 1000:.1f} ms, {len(storage)} of "
+          f"{args.sessions} left (~{used * len(storage) / args.sessions / 1024 / 1024:.1f} MiB of {used / 1024 / 1024:.1f} MiB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FSM session memory and TTL eviction")
+    parser.add_argument('--sessions', type=int, default=100_000)
+    parser.add_argument('--variants', type=int, default=500, help="вариантов в эксперименте")
+    parser.add_argument('--max-history', type=int, default=10, help="наибольшее число прошлых сессий пользователя")
+    parser.add_argument('--active', type=int, default=10_000, help="сессий, которые переживут вытеснение")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# benchmarks/bench_webhook.py
+# Задержка от отправки обновления Telegram до обработчика: polling против webhook
+#
+# Одна и та же нагрузка (LoadDriver из bench_load) идет через mock Bot API сначала в
+# режиме polling (getUpdates), затем в режиме webhook (WebhookServer с пулом,
+# сохраняющим порядок в чате). latency - время запроса к Bot API туда и обратно.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_webhook --users 100 --api-latency 0.05
+
+import argparse
+import asyncio
+import logging
+import random
+import socket
+import time
+from typing import Dict, List
+
+from benchmarks.harness import load_bot, start_services, stop_services
+from benchmarks.bench_database import percentile
+from benchmarks.bench_load import LoadDriver
+from benchmarks.mock_bot_api import MockBotApiServer
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import config
+from webhook import WebhookServer
+
+SECRET = 'bench-secret'
+
+
+class UpdateLatency:
+    """Внешний middleware обновлений: время от передачи обновления mock-серверу до dp"""
+
+    def __init__(self, emitted_at: Dict[int, float]):
+        self.emitted_at = emitted_at
+        self.latencies: List[float] = []
+
+    async def __call__(self, handler, event, data):
+        emitted = self.emitted_at.pop(event.update_id, None)
+        if emitted is not None:
+            self.latencies.append(time.perf_counter() - emitted)
+        return await handler(event, data)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def drive(driver: LoadDriver, timer: UpdateLatency, users: int, first_user: int, ramp: float) -> Dict:
+    driver.tap_latencies.clear()
+    timer.latencies.clear()
+    driver.votes = driver.timeouts = driver.failed = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(driver.run_user(first_user + i, random.uniform(0, ramp)) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    return {'elapsed': elapsed, 'votes': driver.votes, 'failed': driver.failed,
+            'update': list(timer.latencies), 'tap': list(driver.tap_latencies)}
+
+
+def report(mode: str, result: Dict):
+    update, tap = result['update'], result['tap']
+    print(f"{mode:>8}: {result['votes']} votes in {result['elapsed']:.2f}s, stalled users {result['failed']}")
+    print(f"          update -> dp  p50 {percentile(update, 50) * 1000:6.1f} ms  p95 {percentile(update, 95) * 1000:6.1f} ms"
+          f"  p99 {percentile(update, 99) * 1000:6.1f} ms")
+    print(f"          tap -> next   p50 {percentile(tap, 50) * 1000:6.1f} ms  p95 {percentile(tap, 95) * 1000:6.1f} ms"
+          f"  p99 {percentile(tap, 99) * 1000:6.1f} ms")
+
+
+async def run(args):
+    config.RESPONSE_TIMEOUT = args.response_timeout
+    server = MockBotApiServer(latency=args.api_latency)
+    url = await server.start()
+    bot_module, _ = load_bot(db_latency=args.db_latency, rate_limit=False,
+                             session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    bot, dp = bot_module.bot, bot_module.dp
+    timer = UpdateLatency(server.emitted_at)
+    dp.update.outer_middleware(timer)
+    await start_services(bot_module)
+    driver = LoadDriver(server, args.think_time, args.timeout_rate, step_timeout=60.0)
+
+    try:
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+        await asyncio.gather(*(driver.run_user(i, 0) for i in range(1, 4)))
+        polling_result = await drive(driver, timer, args.users, 1000, args.ramp)
+        await dp.stop_polling()
+        await polling
+
+        port = free_port()
+        webhook = WebhookServer(bot, dp, path='/webhook', secret=SECRET, host='127.0.0.1', port=port,
+                                workers=args.workers)
+        await webhook.start()
+        await bot.set_webhook(url=f'http://127.0.0.1:{port}/webhook', secret_token=SECRET)
+        try:
+            webhook_result = await drive(driver, timer, args.users, 100_000, args.ramp)
+        finally:
+            await bot.delete_webhook()
+            await webhook.stop()
+    finally:
+        await stop_services(bot_module)
+        await bot.session.close()
+        await server.stop()
+
+    print(f"{args.users} users, think {args.think_time}s, Bot API round trip {args.api_latency * 1000:g} ms, "
+          f"{args.workers} webhook workers")
+    report("polling", polling_result)
+    report("webhook", webhook_result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare update latency in polling and webhook modes")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--ramp', type=float, default=2.0)
+    parser.add_argument('--think-time', type=float, default=0.5)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--response-timeout', type=float, default=5.0)
+    parser.add_argument('--db-latency', type=float, default=0.005)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="время запроса к Bot API туда и обратно, сек")
+    parser.add_argument('--workers', type=int, default=config.WEBHOOK_WORKERS)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.disable(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
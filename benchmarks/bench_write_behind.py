@@ -0,0 +1,143 @@
+# benchmarks/bench_write_behind.py
+# Пропускная способность записи голосов: прямая запись против буфера отложенной записи
+#
+# Затем проверяется повтор пачки: повторная запись тех же голосов не меняет счетчики, а
+# если чтение не видит уже записанные сравнения (отставание реплики), запись завершается
+# ошибкой, а не повторяется бесконечно. При нарушении скрипт завершается с ошибкой.
+#
+# Запуск из корня проекта:
+#     python -m benchmarks.bench_write_behind --votes 5000 --latency 0.01
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from typing import List
+
+import config
+from write_behind import ComparisonWriter
+from benchmarks.bench_database import create_database, percentile
+from benchmarks.fake_firestore import FakeFirestore, FakeSnapshot
+
+
+class LaggingFirestore(FakeFirestore):
+    """Заглушка, в которой чтение по ссылкам еще не видит записанные документы"""
+
+    async def get_all(self, references, field_paths=None):
+        await self.round_trip()
+        for reference in references:
+            self.reads += 1
+            yield FakeSnapshot(reference, None)
+
+
+async def prepare(latency: float):
+    """Создает базу с загруженным каталогом изображений"""
+    client = FakeFirestore(latency=latency)
+    db = await create_database(client)
+    images = db.experiments.experiments()[0].variant_keys()
+    return client, db, images
+
+
+async def run_direct(votes: int, users: int, latency: float) -> dict:
+    """Каждый голос записывается отдельным вызовом save_comparison_result"""
+    client, db, images = await prepare(latency)
+    latencies: List[float] = []
+
+    async def vote(i: int):
+        started = time.perf_counter()
+        await db.save_comparison_result(
+            user_id=i % users,
+            fixed_image_path=config.FIXED_IMAGE_PATH,
+            variable_image_path=os.path.join(config.IMAGES_FOLDER, images[i % len(images)]),
+            selected_original=i % 2 == 0
+        )
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(vote(i) for i in range(votes)))
+    return {'elapsed': time.perf_counter() - started, 'latencies': latencies, 'round_trips': client.round_trips}
+
+
+async def run_write_behind(votes: int, users: int, latency: float, batch_size: int) -> dict:
+    """Голоса принимаются буфером и записываются пачками"""
+    client, db, images = await prepare(latency)
+    latencies: List[float] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = ComparisonWriter(db, os.path.join(tmp, 'comparisons.journal'), batch_size=batch_size, flush_interval=0.05)
+        await writer.start()
+
+        async def vote(i: int):
+            started = time.perf_counter()
+            writer.submit(
+                user_id=i % users,
+                fixed_image=os.path.basename(config.FIXED_IMAGE_PATH),
+                variable_image=images[i % len(images)],
+                selected_original=i % 2 == 0
+            )
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(vote(i) for i in range(votes)))
+        # Время считается до момента, когда все голоса записаны в хранилище
+        await writer.stop()
+        elapsed = time.perf_counter() - started
+    return {'elapsed': elapsed, 'latencies': latencies, 'round_trips': client.round_trips}
+
+
+async def check_replays(votes: int, users: int) -> List[str]:
+    """Повтор пачки после записи: счетчики не меняются; при отставании чтения - ошибка вместо зацикливания"""
+    failures = []
+    for client in (FakeFirestore(), LaggingFirestore()):
+        db = await create_database(client)
+        images = db.experiments.experiments()[0].variant_keys()
+        records = [{
+            'id': uuid.uuid4().hex,
+            'user_id': i % users,
+            'fixed_image': db.experiments.experiments()[0].fixed_key,
+            'variable_image': images[i % len(images)],
+            'selected_original': i % 2 == 0,
+            'created_at': None
+        } for i in range(votes)]
+        await db.save_comparison_batch(records)
+        try:
+            saved = await asyncio.wait_for(db.save_comparison_batch(records), timeout=10)
+        except asyncio.TimeoutError:
+            failures.append(f"{type(client).__name__}: replay did not finish")
+            continue
+        total = sum(doc.get('total_comparisons', 0) for doc in client._docs(config.USERS_COLLECTION).values())
+        lagging = isinstance(client, LaggingFirestore)
+        print(f"  replay, {type(client).__name__:<16} saved={saved}  user counters total={total} of {votes}")
+        if total != votes or saved == lagging:
+            failures.append(f"{type(client).__name__}: replay returned {saved}, counters {total} of {votes}")
+    return failures
+
+
+def report(name: str, votes: int, result: dict):
+    latencies = result['latencies']
+    print(f"{name:>14}: {votes / result['elapsed']:8.0f} votes/s  round_trips={result['round_trips']:5d}  "
+          f"ack p50={percentile(latencies, 50) * 1000:.2f}ms p99={percentile(latencies, 99) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark direct vs write-behind comparison writes")
+    parser.add_argument('--votes', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.01, help="задержка одного запроса, сек")
+    parser.add_argument('--batch-size', type=int, default=config.WRITE_BEHIND_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    report("direct", args.votes, asyncio.run(run_direct(args.votes, args.users, args.latency)))
+    report("write-behind", args.votes, asyncio.run(run_write_behind(args.votes, args.users, args.latency, args.batch_size)))
+    failures = asyncio.run(check_replays(min(args.votes, 1000), args.users))
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
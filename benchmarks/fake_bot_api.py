@@ -0,0 +1,101 @@
+# benchmarks/fake_bot_api.py
+# Локальная заглушка Telegram Bot API в виде HTTP-сессии aiogram
+
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response
+from aiogram.types import InputFile
+
+# Методы, которые возвращают сообщение с фотографией
+PHOTO_METHODS = {'sendPhoto', 'editMessageMedia'}
+# Методы, которые возвращают сообщение
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageMedia'}
+
+
+class FakeBotSession(BaseSession):
+    """Сессия бота, отвечающая на запросы без обращения к Telegram
+
+    Считает вызовы по методам и загрузки файлов, выдает file_id загруженным фото и
+    запоминает последнее сообщение с клавиатурой в каждом чате, чтобы драйвер мог
+    "нажимать" кнопки.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.uploads = 0
+        self.call_latencies: List[float] = []
+        self.keyboard_messages: Dict[int, Dict] = {}
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def reset(self):
+        self.calls.clear()
+        self.uploads = 0
+        self.call_latencies.clear()
+        self.keyboard_messages.clear()
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    def _photo(self, media: Any) -> List[Dict]:
+        if isinstance(media, InputFile):
+            self.uploads += 1
+            file_id = f"file_{next(self._file_ids)}"
+        else:
+            file_id = media
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 640}]
+
+    def _message(self, method: TelegramMethod, photo: Any = None) -> Dict:
+        message_id = getattr(method, 'message_id', None) or next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': method.chat_id, 'type': 'private'},
+        }
+        if getattr(method, 'text', None):
+            message['text'] = method.text
+        if getattr(method, 'caption', None):
+            message['caption'] = method.caption
+        if photo is not None:
+            message['photo'] = self._photo(photo)
+        reply_markup = getattr(method, 'reply_markup', None)
+        if reply_markup is not None:
+            message['reply_markup'] = reply_markup.model_dump(exclude_none=True)
+            self.keyboard_messages[method.chat_id] = message
+        return message
+
+    def _result(self, method: TelegramMethod) -> Any:
+        name = method.__api_method__
+        if name == 'sendMediaGroup':
+            return [self._message(method, photo=item.media) for item in method.media]
+        if name == 'sendPhoto':
+            return self._message(method, photo=method.photo)
+        if name == 'editMessageMedia':
+            message = self._message(method, photo=method.media.media)
+            message['caption'] = method.media.caption
+            return message
+        if name in MESSAGE_METHODS:
+            return self._message(method)
+        return True
+
+    async def make_request(self, bot, method: TelegramMethod, timeout: Optional[int] = None):
+        started = time.perf_counter()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[method.__api_method__] += 1
+        result = self._result(method)
+        self.call_latencies.append(time.perf_counter() - started)
+        response = Response[method.__returning__].model_validate({'ok': True, 'result': result}, context={'bot': bot})
+        return response.result
@@ -0,0 +1,341 @@
+# benchmarks/fake_firestore.py
+# Локальная заглушка асинхронного клиента Firestore для бенчмарков
+
+import asyncio
+import bisect
+import datetime
+import itertools
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import Aborted, AlreadyExists
+from google.cloud.firestore_v1 import transforms
+
+
+def _resolve(current: Any, value: Any) -> Any:
+    """Применяет специальные значения Firestore (SERVER_TIMESTAMP, Increment, ArrayUnion)"""
+    if value is transforms.SERVER_TIMESTAMP:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, transforms.Increment):
+        return (current or 0) + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current or [])
+        result.extend(v for v in value.values if v not in result)
+        return result
+    return value
+
+
+def _apply(existing: Optional[Dict], data: Dict, merge: bool) -> Dict:
+    """Накладывает изменения на документ; ключи вида 'a.b' трактуются как вложенные поля"""
+    result = dict(existing or {}) if merge else {}
+    for key, value in data.items():
+        *parents, leaf = key.split('.')
+        target = result
+        for part in parents:
+            target = target.setdefault(part, {})
+        if isinstance(value, dict) and merge:
+            target[leaf] = _apply(target.get(leaf), value, True)
+        else:
+            target[leaf] = _resolve(target.get(leaf), value)
+    return result
+
+
+class FakeFirestore:
+    """In-memory аналог AsyncClient с настраиваемой задержкой каждого запроса
+
+    blocking=True имитирует синхронный клиент: задержка выполняется через time.sleep
+    и блокирует event loop, как это делали вызовы firestore.client().
+    """
+
+    def __init__(self, latency: float = 0.0, blocking: bool = False):
+        self.latency = latency
+        self.blocking = blocking
+        self.round_trips = 0
+        # Число прочитанных запросами документов (Firestore тарифицирует чтения по документам)
+        self.reads = 0
+        self._collections: Dict[str, Dict[str, Dict]] = {}
+        # Упорядоченные индексы для order_by и номера изменений коллекций для их сброса
+        self._indexes: Dict[Tuple[str, str], Tuple[int, List]] = {}
+        self._versions: Dict[str, int] = {}
+
+    async def round_trip(self):
+        """Имитирует сетевой запрос к Firestore"""
+        self.round_trips += 1
+        if self.blocking:
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+
+    def collection(self, name: str) -> 'FakeCollection':
+        return FakeCollection(self, name)
+
+    def batch(self) -> 'FakeBatch':
+        return FakeBatch(self)
+
+    def transaction(self) -> 'FakeTransaction':
+        return FakeTransaction(self)
+
+    async def get_all(self, references: List['FakeDocument'], field_paths=None):
+        """Читает несколько документов за один запрос"""
+        await self.round_trip()
+        for reference in references:
+            self.reads += 1
+            yield FakeSnapshot(reference, self._docs(reference._collection).get(reference.id))
+
+    def _docs(self, collection: str) -> Dict[str, Dict]:
+        return self._collections.setdefault(collection, {})
+
+    def _ordered(self, collection: str, field: str) -> List[Tuple[Any, str]]:
+        """Документы коллекции, упорядоченные по полю и ID; документы без поля не входят, как в Firestore
+
+        Индекс строится заново, только если коллекция менялась после его построения.
+        """
+        docs = self._docs(collection)
+        key = (collection, field)
+        cached = self._indexes.get(key)
+        if cached is None or cached[0] != self._versions.get(collection, 0):
+            index = sorted((_field(data, field), doc_id) for doc_id, data in docs.items()
+                           if _field(data, field) is not None)
+            cached = self._indexes[key] = (self._versions.get(collection, 0), index)
+        return cached[1]
+
+    def _changed(self, collection: str):
+        self._versions[collection] = self._versions.get(collection, 0) + 1
+
+
+def _field(data: Optional[Dict], field: str) -> Any:
+    """Значение поля документа (вложенные поля через точку) или None"""
+    value = data
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+class FakeSnapshot:
+    """Снимок документа"""
+
+    def __init__(self, reference: 'FakeDocument', data: Optional[Dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict]:
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field: str) -> Any:
+        # Как и в Firestore, отсутствующее поле приводит к KeyError
+        value = self._data
+        for part in field.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                raise KeyError(field)
+            value = value[part]
+        return value
+
+    def _field(self, field: str) -> Any:
+        return _field(self._data, field)
+
+
+class FakeDocument:
+    """Ссылка на документ"""
+
+    def __init__(self, client: FakeFirestore, collection: str, doc_id: str):
+        self._client = client
+        self._collection = collection
+        self.id = doc_id
+
+    def _write(self, data: Dict, merge: bool):
+        docs = self._client._docs(self._collection)
+        docs[self.id] = _apply(docs.get(self.id), data, merge)
+        self._client._changed(self._collection)
+
+    async def set(self, data: Dict, merge: bool = False):
+        await self._client.round_trip()
+        self._write(data, merge)
+
+    async def update(self, data: Dict):
+        await self._client.round_trip()
+        if self.id not in self._client._docs(self._collection):
+            raise KeyError(f"No document to update: {self._collection}/{self.id}")
+        self._write(data, True)
+
+    async def get(self, transaction: Optional['FakeTransaction'] = None) -> FakeSnapshot:
+        await self._client.round_trip()
+        self._client.reads += 1
+        data = self._client._docs(self._collection).get(self.id)
+        if transaction is not None:
+            transaction._reads.append((self, data))
+        return FakeSnapshot(self, data)
+
+    async def delete(self):
+        await self._client.round_trip()
+        self._client._docs(self._collection).pop(self.id, None)
+        self._client._changed(self._collection)
+
+
+class FakeQuery:
+    """Запрос с фильтрами на равенство/сравнение, сортировкой и курсором"""
+
+    _OPERATORS = {
+        '==': lambda a, b: a == b,
+        '>': lambda a, b: a is not None and a > b,
+        '>=': lambda a, b: a is not None and a >= b,
+        '<': lambda a, b: a is not None and a < b,
+        'in': lambda a, b: a in b,
+    }
+
+    def __init__(self, client: FakeFirestore, collection: str, filters=(), order=None, limit_count=None, cursor=None):
+        self._client = client
+        self._collection = collection
+        self._filters: Tuple = tuple(filters)
+        self._order = order
+        self._limit = limit_count
+        self._cursor = cursor
+
+    def _copy(self, **changes) -> 'FakeQuery':
+        params = dict(filters=self._filters, order=self._order, limit_count=self._limit, cursor=self._cursor)
+        params.update(changes)
+        return FakeQuery(self._client, self._collection, **params)
+
+    def where(self, field: str, op: str, value: Any) -> 'FakeQuery':
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def select(self, field_paths: List[str]) -> 'FakeQuery':
+        # Проекция не влияет на результат заглушки
+        return self._copy()
+
+    def order_by(self, field: str) -> 'FakeQuery':
+        return self._copy(order=field)
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return self._copy(limit_count=count)
+
+    def start_after(self, snapshot: FakeSnapshot) -> 'FakeQuery':
+        return self._copy(cursor=snapshot)
+
+    def _matches(self) -> List[FakeSnapshot]:
+        # Фильтры и сортировка работают по данным документов; снимки создаются только для результата
+        docs = self._client._docs(self._collection)
+
+        def matches(data: Dict) -> bool:
+            return all(self._OPERATORS[op](_field(data, field), value) for field, op, value in self._filters)
+
+        if self._order:
+            # Как индекс Firestore: упорядоченный список, от курсора документы просматриваются
+            # до заполнения limit, а не сортируются заново при каждом запросе
+            index = self._client._ordered(self._collection, self._order)
+            start = 0
+            if self._cursor is not None:
+                start = bisect.bisect_right(index, (self._cursor._field(self._order), self._cursor.id))
+            result = []
+            for _, doc_id in itertools.islice(index, start, None):
+                data = docs[doc_id]
+                if matches(data):
+                    result.append((doc_id, data))
+                    if self._limit is not None and len(result) >= self._limit:
+                        break
+        else:
+            result = [(doc_id, data) for doc_id, data in docs.items() if matches(data)]
+            if self._limit is not None:
+                result = result[:self._limit]
+        self._client.reads += len(result)
+        return [FakeSnapshot(FakeDocument(self._client, self._collection, doc_id), data) for doc_id, data in result]
+
+    async def stream(self):
+        await self._client.round_trip()
+        for snapshot in self._matches():
+            yield snapshot
+
+    async def get(self) -> List[FakeSnapshot]:
+        await self._client.round_trip()
+        return self._matches()
+
+
+class FakeCollection(FakeQuery):
+    """Коллекция документов"""
+
+    def __init__(self, client: FakeFirestore, name: str):
+        super().__init__(client, name)
+
+    def document(self, doc_id: Optional[str] = None) -> FakeDocument:
+        return FakeDocument(self._client, self._collection, doc_id or uuid.uuid4().hex[:20])
+
+    async def add(self, data: Dict):
+        document = self.document()
+        await document.set(data)
+        return datetime.datetime.now(datetime.timezone.utc), document
+
+
+class FakeBatch:
+    """Пакетная запись: все операции применяются за один запрос"""
+
+    def __init__(self, client: FakeFirestore):
+        self._client = client
+        # (документ, данные, merge); merge=None - создание, только если документа еще нет
+        self._operations: List[Tuple[FakeDocument, Dict, Optional[bool]]] = []
+
+    def __len__(self) -> int:
+        return len(self._operations)
+
+    def set(self, reference: FakeDocument, data: Dict, merge: bool = False):
+        self._operations.append((reference, data, merge))
+
+    def update(self, reference: FakeDocument, data: Dict):
+        self._operations.append((reference, data, True))
+
+    def create(self, reference: FakeDocument, data: Dict):
+        self._operations.append((reference, data, None))
+
+    async def commit(self):
+        if len(self._operations) > 500:
+            raise ValueError("Firestore batch cannot contain more than 500 operations")
+        await self._client.round_trip()
+        # Пакет атомарен: при нарушенном предусловии не применяется ни одна операция
+        for reference, _, merge in self._operations:
+            if merge is None and reference.id in self._client._docs(reference._collection):
+                raise AlreadyExists(f"Document already exists: {reference._collection}/{reference.id}")
+        for reference, data, merge in self._operations:
+            reference._write(data, bool(merge))
+        self._operations = []
+
+
+class FakeTransaction(FakeBatch):
+    """Транзакция с оптимистичной проверкой: если прочитанный в ней документ изменился до
+    фиксации, фиксация отклоняется с Aborted, и async_transactional повторяет функцию
+
+    Реализует внутренние методы AsyncTransaction, которые вызывает async_transactional.
+    """
+
+    def __init__(self, client: FakeFirestore, max_attempts: int = 5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        # (документ, данные на момент чтения)
+        self._reads: List[Tuple[FakeDocument, Optional[Dict]]] = []
+
+    def _clean_up(self):
+        self._operations = []
+        self._reads = []
+        self._id = None
+
+    async def _begin(self, retry_id=None):
+        await self._client.round_trip()
+        self._id = uuid.uuid4().bytes
+
+    async def _rollback(self):
+        self._clean_up()
+
+    async def _commit(self):
+        await self._client.round_trip()
+        for reference, data in self._reads:
+            # Каждая запись заменяет словарь документа, поэтому изменение видно по идентичности
+            if self._client._docs(reference._collection).get(reference.id) is not data:
+                self._clean_up()
+                raise Aborted(f"Transaction conflict on {reference._collection}/{reference.id}")
+        for reference, data, merge in self._operations:
+            reference._write(data, bool(merge))
+        self._clean_up()
@@ -0,0 +1,137 @@
+# benchmarks/harness.py
+# Запуск настоящих обработчиков bot.py с заглушками Firestore и Bot API
+#
+# Модуль нужно импортировать до config: он задает окружение (токен, каталог данных
+# во временной папке, FSM в памяти, по умолчанию один эксперимент из IMAGES_FOLDER),
+# в котором bot.py можно импортировать локально.
+
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+DATA_DIR = tempfile.mkdtemp(prefix='bot-bench-')
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ['DATA_DIR'] = DATA_DIR
+os.environ.setdefault('FSM_STORAGE', 'memory')
+os.environ.setdefault('EXPERIMENTS_FOLDER', '')
+
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+import database
+from benchmarks.fake_bot_api import FakeBotSession
+from benchmarks.fake_firestore import FakeFirestore
+
+
+def load_bot(db_latency: float = 0.0, api_latency: float = 0.0, rate_limit: bool = True,
+             session: Optional[BaseSession] = None):
+    """Импортирует bot.py с Firestore-заглушкой и подменяет HTTP-сессию бота
+
+    Без session бот отвечает из FakeBotSession в том же процессе, без HTTP.
+    """
+    class BenchDatabase(database.FirestoreDatabase):
+        def __init__(self, **kwargs):
+            super().__init__(client=FakeFirestore(latency=db_latency), **kwargs)
+
+    database.FirestoreDatabase = BenchDatabase
+    # bot.py пишет bot.log в текущий каталог
+    os.chdir(DATA_DIR)
+    import bot as bot_module
+
+    if session is None:
+        session = FakeBotSession(latency=api_latency)
+    if rate_limit:
+        session.middleware(bot_module.outbound_limiter)
+    session.middleware(bot_module.api_metrics)
+    bot_module.bot.session = session
+    return bot_module, session
+
+
+async def start_services(bot_module):
+    """Выполняет подготовку из main() без запуска polling"""
+    await bot_module.db.connect()
+    # Каталоги сканируются сразу, а не в фоне, чтобы первые сессии не остались без изображений
+    await bot_module.experiments.ensure_loaded()
+    await bot_module.experiments.start()
+    await bot_module.comparison_writer.start()
+    await bot_module.timeout_scheduler.start()
+
+
+async def stop_services(bot_module):
+    await bot_module.experiments.stop()
+    await bot_module.timeout_scheduler.stop()
+    await bot_module.comparison_writer.stop()
+
+
+class SessionDriver:
+    """Имитирует пользователей: /start, "Начать" и нажатия кнопок выбора"""
+
+    def __init__(self, bot_module, session: FakeBotSession):
+        self.bot_module = bot_module
+        self.bot = bot_module.bot
+        self.dp = bot_module.dp
+        self.session = session
+        self._update_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    async def feed(self, payload: Dict):
+        payload['update_id'] = next(self._update_ids)
+        update = Update.model_validate(payload, context={'bot': self.bot})
+        await self.dp.feed_update(self.bot, update)
+
+    async def command(self, user_id: int, text: str):
+        await self.feed({'message': {
+            'message_id': 0,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        }})
+
+    async def press(self, user_id: int, data: str):
+        """Нажимает кнопку на последнем сообщении с клавиатурой в чате пользователя
+
+        data - данные кнопки без номера сравнения ("select_original"); номер берется из кнопки.
+        """
+        message = self.session.keyboard_messages[user_id]
+        buttons = [button['callback_data'] for row in message['reply_markup']['inline_keyboard'] for button in row]
+        await self.feed({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': next((button for button in buttons if button.split(':')[0] == data), data),
+            'message': message
+        }})
+
+    async def state(self, user_id: int) -> Optional[str]:
+        return await self.dp.storage.get_state(StorageKey(bot_id=self.bot.id, chat_id=user_id, user_id=user_id))
+
+    async def run_session(self, user_id: int, choose: Callable[[int], bool] = lambda i: i % 2 == 0,
+                          tap_latencies: Optional[List[float]] = None, think_time: float = 0.0) -> float:
+        """Проходит полную сессию сравнений; возвращает ее длительность"""
+        await self.command(user_id, '/start')
+        started = time.perf_counter()
+        await self.press(user_id, 'start_comparison')
+        finished = self.bot_module.RatingStates.finished.state
+        index = 0
+        while await self.state(user_id) != finished:
+            if think_time:
+                await asyncio.sleep(think_time)
+            tap_started = time.perf_counter()
+            await self.press(user_id, 'select_original' if choose(index) else 'select_variant')
+            if tap_latencies is not None:
+                tap_latencies.append(time.perf_counter() - tap_started)
+            index += 1
+        return time.perf_counter() - started
@@ -0,0 +1,224 @@
+# benchmarks/mock_bot_api.py
+# Локальный HTTP-сервер, изображающий Telegram Bot API для нагрузочного теста
+#
+# Бот подключается к нему обычной aiohttp-сессией (TelegramAPIServer с адресом сервера)
+# и получает обновления через getUpdates или, после setWebhook, POST-запросами на свой
+# webhook, как в production. Драйвер нагрузки передает обновления серверу и ждет
+# сообщений бота с клавиатурой в нужном чате.
+#
+# latency - время запроса к Bot API туда и обратно; доставка обновления в одну сторону
+# (ответ getUpdates или запрос на webhook) занимает половину этого времени.
+
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, web
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+# Методы, которые возвращают сообщение
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageMedia'}
+
+
+class MockBotApiServer:
+    """Bot API на 127.0.0.1: getUpdates с долгим опросом, отправка и редактирование сообщений
+
+    Считает вызовы по методам и загрузки файлов, выдает file_id загруженным фото и хранит
+    последнее сообщение с клавиатурой в каждом чате с номером версии, чтобы драйвер мог
+    дождаться следующего шага сессии.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.uploads = 0
+        self.url: Optional[str] = None
+        self._updates: List[Dict] = []
+        self._update_ids = itertools.count(1)
+        self._updates_changed = asyncio.Condition()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._keyboards: Dict[int, Tuple[int, Dict]] = {}
+        self._keyboards_changed = asyncio.Condition()
+        self._runner: Optional[web.AppRunner] = None
+        # Время передачи каждого обновления серверу, для замера задержки до обработчика
+        self.emitted_at: Dict[int, float] = {}
+        self.webhook_url: Optional[str] = None
+        self._webhook_secret: Optional[str] = None
+        self._webhook_slots: Optional[asyncio.Semaphore] = None
+        self._client: Optional[ClientSession] = None
+        self._deliveries: set = set()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        self.calls.clear()
+        self.uploads = 0
+
+    # Обновления для бота
+
+    async def emit(self, update: Dict):
+        update['update_id'] = next(self._update_ids)
+        self.emitted_at[update['update_id']] = time.perf_counter()
+        if self.webhook_url:
+            task = asyncio.create_task(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+            return
+        async with self._updates_changed:
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        if self.latency:
+            await asyncio.sleep(self.latency / 2)
+        async with self._updates_changed:
+            # offset подтверждает все обновления до него
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._updates_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            updates = self._updates[:limit]
+        if self.latency:
+            await asyncio.sleep(self.latency / 2)
+        return updates
+
+    def _set_webhook(self, params: Dict):
+        self.webhook_url = params['url']
+        self._webhook_secret = params.get('secret_token')
+        self._webhook_slots = asyncio.Semaphore(int(params.get('max_connections') or 40))
+        if self._client is None:
+            self._client = ClientSession()
+
+    async def _deliver(self, update: Dict):
+        """Отправляет обновление на webhook бота, повторяя при ошибке, как Telegram"""
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self._webhook_secret} if self._webhook_secret else {}
+        async with self._webhook_slots:
+            for attempt in range(5):
+                if self.latency:
+                    await asyncio.sleep(self.latency / 2)
+                try:
+                    async with self._client.post(self.webhook_url, json=update, headers=headers) as response:
+                        if response.status == 200:
+                            return
+                except OSError:
+                    pass
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+    # Сообщения бота
+
+    def keyboard_version(self, chat_id: int) -> int:
+        return self._keyboards.get(chat_id, (0, None))[0]
+
+    def keyboard(self, chat_id: int) -> Tuple[int, Dict]:
+        """Последнее сообщение с клавиатурой в чате и его версия"""
+        return self._keyboards[chat_id]
+
+    async def next_keyboard(self, chat_id: int, after_version: int, timeout: Optional[float] = None) -> Tuple[int, Dict]:
+        """Ждет сообщения с клавиатурой в чате новее after_version"""
+        async with self._keyboards_changed:
+            await asyncio.wait_for(
+                self._keyboards_changed.wait_for(lambda: self.keyboard_version(chat_id) > after_version),
+                timeout
+            )
+            return self._keyboards[chat_id]
+
+    def _photo(self, media: Any) -> List[Dict]:
+        if isinstance(media, str) and not media.startswith('attach://'):
+            file_id = media
+        else:
+            self.uploads += 1
+            file_id = f"file_{next(self._file_ids)}"
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 640}]
+
+    def _message(self, params: Dict, photo: Any = None, caption: Optional[str] = None) -> Dict:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if params.get('text'):
+            message['text'] = params['text']
+        caption = caption or params.get('caption')
+        if caption:
+            message['caption'] = caption
+        if photo is not None:
+            message['photo'] = self._photo(photo)
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        return message
+
+    async def _keyboard_sent(self, message: Dict):
+        if 'inline_keyboard' not in message.get('reply_markup', {}):
+            return
+        chat_id = message['chat']['id']
+        async with self._keyboards_changed:
+            self._keyboards[chat_id] = (self.keyboard_version(chat_id) + 1, message)
+            self._keyboards_changed.notify_all()
+
+    async def _result(self, name: str, params: Dict) -> Any:
+        if name == 'getUpdates':
+            return await self._get_updates(params)
+        if name == 'getMe':
+            return BOT_USER
+        if name == 'setWebhook':
+            self._set_webhook(params)
+            return True
+        if name == 'deleteWebhook':
+            self.webhook_url = None
+            return True
+        if name == 'sendMediaGroup':
+            return [self._message(params, photo=item['media'], caption=item.get('caption'))
+                    for item in json.loads(params['media'])]
+        if name == 'editMessageMedia':
+            media = json.loads(params['media'])
+            message = self._message(params, photo=media['media'], caption=media.get('caption'))
+        elif name == 'sendPhoto':
+            message = self._message(params, photo=params['photo'])
+        elif name in MESSAGE_METHODS:
+            message = self._message(params)
+        else:
+            return True
+        await self._keyboard_sent(message)
+        return message
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        name = request.match_info['method']
+        form = await request.post()
+        # Загруженные файлы передаются частями формы; остальные поля - строки
+        params = {key: value for key, value in form.items() if isinstance(value, str)}
+        if name != 'getUpdates':
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        return web.json_response({'ok': True, 'result': await self._result(name, params)})
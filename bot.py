@@ -1,18 +1,33 @@
 import logging
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
-from aiogram.filters.command import Command
+from aiogram.filters.command import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest
 import asyncio
-import datetime
-import random
-from typing import List, Dict, Optional, Tuple
+import signal
+from typing import List, Dict, NamedTuple, Optional, Tuple
 import os
+import uuid
 import config
-from database import Database
+from database import create_database
+from experiments import Experiment, ExperimentRegistry, split_key
+from file_id_cache import FileIdCache, is_stale_file_id_error
+from image_cache import ImageBytesCache
+from session_state import (add_shown, encode_variants, record_vote, session_experiment, session_history,
+                           session_length, session_variants, shown_variants, vote_counts)
+from write_behind import ComparisonWriter
+from fsm_storage import create_storage
+from scheduler import DeadlineScheduler
+from outbound import OutboundLimiter, low_priority
+from render import CompositeCache
+from webhook import WebhookServer
+from chat_locks import ChatLocks, ChatSerializationMiddleware
+from metrics import (ActiveSessions, ApiMetricsMiddleware, HandlerMetricsMiddleware, InstrumentedDatabase,
+                     LoopLagMonitor, MetricsServer, registry)
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,11 +41,92 @@ logging.basicConfig(
 
 # Инициализация бота
 bot = Bot(token=config.BOT_TOKEN)
-storage = MemoryStorage()
+
+# Все исходящие запросы проходят через ограничитель скорости Bot API
+outbound_limiter = OutboundLimiter(
+    global_rate=config.OUTBOUND_GLOBAL_RATE,
+    chat_rate=config.OUTBOUND_CHAT_RATE,
+    chat_burst=config.OUTBOUND_CHAT_BURST,
+    max_retries=config.OUTBOUND_MAX_RETRIES
+)
+bot.session.middleware(outbound_limiter)
+# Число, время и ошибки запросов к Bot API (после ограничителя - без ожидания в очереди)
+api_metrics = ApiMetricsMiddleware()
+bot.session.middleware(api_metrics)
+storage = create_storage()
 dp = Dispatcher(storage=storage)
 
-# Инициализация базы данных
-db = Database()
+# Обновления одного чата обрабатываются по очереди (тайм-ауты берут ту же блокировку),
+# повторно доставленные нажатия отбрасываются
+chat_locks = ChatLocks()
+dp.update.outer_middleware(ChatSerializationMiddleware(chat_locks))
+
+# Время обработчиков и активные чаты для /metrics
+active_sessions = ActiveSessions(config.METRICS_ACTIVE_WINDOW)
+handler_metrics = HandlerMetricsMiddleware(active_sessions)
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+# Эксперименты и индексы их изображений: обработчики не обращаются к файловой системе
+experiments = ExperimentRegistry.from_config()
+
+# Инициализация базы данных (время каждого метода попадает в метрики)
+db = InstrumentedDatabase(create_database(experiments=experiments))
+
+# Отложенная запись результатов сравнений пачками
+comparison_writer = ComparisonWriter(
+    db,
+    config.COMPARISON_JOURNAL_PATH,
+    batch_size=config.WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=config.WRITE_BEHIND_FLUSH_INTERVAL,
+    fsync=config.WRITE_BEHIND_FSYNC,
+    max_backoff=config.WRITE_BEHIND_MAX_BACKOFF,
+    max_attempts=config.WRITE_BEHIND_MAX_ATTEMPTS,
+    dead_letter_path=config.COMPARISON_DEAD_LETTER_PATH
+)
+
+# Кэш file_id, чтобы не загружать одни и те же изображения при каждом сравнении
+file_id_cache = FileIdCache(config.FILE_ID_CACHE_PATH, bot_id=bot.id, catalog=experiments)
+
+# Содержимое часто загружаемых изображений в памяти: пока file_id нет, файлы не перечитываются с диска
+image_cache = ImageBytesCache(
+    config.IMAGE_CACHE_MAX_BYTES,
+    max_file_bytes=config.IMAGE_CACHE_MAX_FILE_BYTES,
+    catalog=experiments
+)
+
+# Готовые склейки пар для режима edit, строятся заранее
+composite_cache = CompositeCache(
+    config.COMPOSITES_DIR,
+    panel_size=(config.COMPOSITE_PANEL_WIDTH, config.COMPOSITE_PANEL_HEIGHT),
+    workers=config.COMPOSITE_WORKERS or None,
+    catalog=experiments
+)
+
+# Фоновые задачи построения склеек (ссылки держим, чтобы задачи не собрал GC)
+prebuild_tasks = set()
+
+def schedule_composite_prebuild(experiment: Experiment, image_paths: List[str]) -> None:
+    """Запускает построение недостающих склеек эксперимента в фоне (нужны только в режиме edit)"""
+    if config.COMPARISON_MODE != "edit" or not experiment.ready:
+        return
+    task = asyncio.create_task(composite_cache.prebuild(experiment.fixed_path, image_paths))
+    prebuild_tasks.add(task)
+    task.add_done_callback(prebuild_tasks.discard)
+
+async def on_experiment_changed(experiment: Experiment, changed: List[str], removed: List[str]) -> None:
+    """Регистрирует новые изображения в базе и перестраивает склейки изменившихся пар"""
+    if changed:
+        await db.add_images([experiment.key(name) for name in changed])
+        if experiment.fixed_name in changed:
+            # Изменился оригинал (или эксперимент только что загружен) - меняются все склейки
+            schedule_composite_prebuild(experiment, experiment.catalog.paths())
+        else:
+            schedule_composite_prebuild(experiment, [experiment.path(name) for name in changed])
+    if removed:
+        logging.info(f"Images removed from experiment {experiment.id}: {', '.join(removed)}")
+
+experiments.on_change(on_experiment_changed)
 
 # Определение состояний для FSM (Finite State Machine)
 class RatingStates(StatesGroup):
@@ -44,12 +140,16 @@ def get_start_keyboard() -> InlineKeyboardMarkup:
     builder.add(InlineKeyboardButton(text="Начать", callback_data="start_comparison"))
     return builder.as_markup()
 
-def get_comparison_keyboard() -> InlineKeyboardMarkup:
-    """Возвращает клавиатуру для выбора изображения"""
+def get_comparison_keyboard(index: int) -> InlineKeyboardMarkup:
+    """Возвращает клавиатуру для выбора изображения в сравнении index
+
+    Номер сравнения в данных кнопки позволяет отличить повторное нажатие от выбора
+    в следующем сравнении.
+    """
     builder = InlineKeyboardBuilder()
     builder.row(
-        InlineKeyboardButton(text="Выбрать слева (оригинал) 👈", callback_data="select_original"),
-        InlineKeyboardButton(text="Выбрать справа (вариант) 👉", callback_data="select_variant")
+        InlineKeyboardButton(text="Выбрать слева (оригинал) 👈", callback_data=f"select_original:{index}"),
+        InlineKeyboardButton(text="Выбрать справа (вариант) 👉", callback_data=f"select_variant:{index}")
     )
     return builder.as_markup()
 
@@ -62,54 +162,236 @@ def get_finish_keyboard() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+async def build_comparison_media(image_paths: List[str], caption: str, use_cache: bool = True) -> List[InputMediaPhoto]:
+    """Собирает медиагруппу, подставляя file_id из кэша вместо загрузки файла"""
+    media = []
+    for i, path in enumerate(image_paths):
+        file_id = file_id_cache.get(path) if use_cache else None
+        media.append(InputMediaPhoto(
+            media=file_id or await image_cache.input_file(path),
+            caption=caption if i == 0 else None
+        ))
+    return media
+
+async def send_comparison_media(chat_id: int, image_paths: List[str], caption: str) -> None:
+    """Отправляет изображения медиагруппой и запоминает file_id загруженных файлов"""
+    media = await build_comparison_media(image_paths, caption)
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=media)
+    except TelegramBadRequest as e:
+        # Если использовались file_id из кэша, они могли устареть - загружаем файлы заново
+        if all(isinstance(item.media, types.InputFile) for item in media) or not is_stale_file_id_error(e.message):
+            raise
+        logging.warning(f"Cached file id rejected, re-uploading: {e}")
+        for path in image_paths:
+            file_id_cache.invalidate(path)
+        messages = await bot.send_media_group(chat_id=chat_id, media=await build_comparison_media(image_paths, caption, use_cache=False))
+    
+    for path, message in zip(image_paths, messages):
+        if message.photo:
+            # Последний размер - самый большой, его file_id пригоден для повторной отправки
+            file_id_cache.put(path, message.photo[-1].file_id)
+
+async def send_photo_cached(chat_id: int, image_path: str, caption: str, reply_markup: InlineKeyboardMarkup, message_id: Optional[int] = None) -> int:
+    """Отправляет фото или заменяет фото в сообщении message_id, используя кэш file_id
+
+    Возвращает ID сообщения с фото.
+    """
+    async def send(photo) -> types.Message:
+        if message_id is None:
+            return await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup)
+        return await bot.edit_message_media(
+            chat_id=chat_id,
+            message_id=message_id,
+            media=InputMediaPhoto(media=photo, caption=caption),
+            reply_markup=reply_markup
+        )
+    
+    file_id = file_id_cache.get(image_path)
+    try:
+        message = await send(file_id or await image_cache.input_file(image_path))
+    except TelegramBadRequest as e:
+        if file_id is None or not is_stale_file_id_error(e.message):
+            raise
+        logging.warning(f"Cached file id rejected, re-uploading: {e}")
+        file_id_cache.invalidate(image_path)
+        message = await send(await image_cache.input_file(image_path))
+    
+    if isinstance(message, types.Message):
+        if message.photo:
+            file_id_cache.put(image_path, message.photo[-1].file_id)
+        return message.message_id
+    return message_id
+
+async def edit_callback_message(callback: types.CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+    """Меняет текст сообщения с кнопкой (для сообщения с фото меняется подпись)"""
+    if callback.message.photo:
+        await callback.message.edit_caption(caption=text, reply_markup=reply_markup)
+    else:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+
+async def send_session_finish(chat_id: int, state: FSMContext, data: Dict, notice: Optional[str] = None) -> None:
+    """Завершает сессию: благодарность, кнопки повтора и статистика"""
+    await state.set_state(RatingStates.finished)
+    
+    thanks_text = "🏆 Спасибо за помощь!\nТы помог(ла) сделать модель лучше. Хочешь попробовать ещё раз? 🚀"
+    
+    # Статистика
+    original_count, total = vote_counts(data)
+    stats_text = None
+    if total > 0:
+        original_percentage = int((original_count / total) * 100)
+        variant_percentage = 100 - original_percentage
+        stats_text = f"📊 Статистика: ты выбрал(а) оригинал {original_count} из {total} раз ({original_percentage}%) и вариант {total-original_count} раз ({variant_percentage}%)!"
+    
+    message_id = data.get("comparison_message_id")
+    if config.COMPARISON_MODE == "edit" and message_id:
+        # Итог выводится в подписи того же сообщения одним запросом
+        caption = "\n\n".join(text for text in (notice, thanks_text, stats_text) if text)
+        await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=caption, reply_markup=get_finish_keyboard())
+        return
+    
+    if notice:
+        with low_priority():
+            await bot.send_message(chat_id=chat_id, text=notice)
+    await bot.send_message(chat_id=chat_id, text=thanks_text, reply_markup=get_finish_keyboard())
+    if stats_text:
+        await bot.send_message(chat_id=chat_id, text=stats_text)
+
+class PreparedComparison(NamedTuple):
+    """Сравнение, подготовленное к отправке: все, кроме уведомления о предыдущем шаге"""
+    session_id: Optional[str]
+    index: int
+    image_paths: List[str]
+    composite_path: Optional[str]
+    text: str
+    keyboard: InlineKeyboardMarkup
+
+# Сравнение k+1, которое готовится, пока пользователь смотрит на сравнение k (по чатам)
+prefetched_comparisons: Dict[int, Tuple[Optional[str], int, "asyncio.Task[PreparedComparison]"]] = {}
+
+async def prepare_comparison(experiment: Experiment, data: Dict, index: int) -> PreparedComparison:
+    """Готовит сравнение index сессии: пути изображений, склейку для режима edit, текст и кнопки"""
+    variable_images = session_variants(data, experiment)
+    variable_name = split_key(variable_images[index])[1]
+    variable_image_path = experiment.path(variable_name)
+    composite_path = None
+    if config.COMPARISON_MODE == "edit":
+        # Построение склейки - самая долгая часть подготовки
+        composite_path = await composite_cache.get(experiment.fixed_path, variable_image_path)
+    return PreparedComparison(
+        session_id=data.get("session_id"),
+        index=index,
+        image_paths=[experiment.fixed_path, variable_image_path],
+        composite_path=composite_path,
+        text=(
+            f"📷 Сравнение {index + 1}/{min(len(variable_images), config.IMAGES_PER_SESSION)}\n\n"
+            f"Слева: Оригинал ({experiment.fixed_name})\n"
+            f"Справа: Вариант ({variable_name})\n\n"
+            f"Какое изображение вам нравится больше? 🤔"
+        ),
+        keyboard=get_comparison_keyboard(index)
+    )
+
+def prefetch_comparison(chat_id: int, experiment: Experiment, data: Dict, index: int) -> None:
+    """Начинает готовить сравнение index в фоне, если оно есть и его вариант доступен"""
+    variable_images = session_variants(data, experiment)
+    if index >= min(len(variable_images), config.IMAGES_PER_SESSION):
+        discard_prefetched_comparison(chat_id)
+        return
+    if split_key(variable_images[index])[1] not in experiment.catalog:
+        return
+    task = asyncio.create_task(prepare_comparison(experiment, data, index))
+    prefetched_comparisons[chat_id] = (data.get("session_id"), index, task)
+
+def discard_prefetched_comparison(chat_id: int) -> None:
+    """Отменяет подготовку следующего сравнения чата (сессия закончена или начата заново)"""
+    entry = prefetched_comparisons.pop(chat_id, None)
+    if entry is not None:
+        entry[2].cancel()
+
+async def take_prefetched_comparison(chat_id: int, session_id: Optional[str], index: int) -> Optional[PreparedComparison]:
+    """Забирает заранее подготовленное сравнение, если оно относится к этому шагу сессии"""
+    entry = prefetched_comparisons.pop(chat_id, None)
+    if entry is None:
+        return None
+    prefetched_session, prefetched_index, task = entry
+    if prefetched_session != session_id or prefetched_index != index:
+        task.cancel()
+        return None
+    try:
+        return await task
+    except Exception as e:
+        logging.warning(f"Prefetched comparison for chat {chat_id} failed, preparing again: {e}")
+        return None
+
+async def warm_image_cache() -> None:
+    """Загружает в кэш изображений оригиналы экспериментов и лучшие по рейтингу варианты"""
+    try:
+        paths = [experiment.fixed_path for experiment in experiments.experiments()]
+        for item in await db.get_leaderboard(config.IMAGE_CACHE_WARM_VARIANTS):
+            experiment = experiments.experiment_for_key(item['variable_image'])
+            if experiment is None or not experiment.ready:
+                continue
+            variable_image_path = experiments.path_for_key(item['variable_image'])
+            if config.COMPARISON_MODE == "edit":
+                # В режиме edit загружается склейка пары, если она уже построена
+                variable_image_path = composite_cache.lookup(experiment.fixed_path, variable_image_path)
+            if variable_image_path:
+                paths.append(variable_image_path)
+        loaded = await image_cache.warm(paths)
+        logging.info(f"Warmed image cache with {loaded} images ({image_cache.size / 1024 / 1024:.1f} MiB)")
+    except Exception as e:
+        logging.error(f"Error warming image cache: {e}")
+
 # Функция для отправки сравнения двух изображений
-async def send_image_comparison(chat_id: int, state: FSMContext) -> None:
-    """Отправляет сравнение двух изображений пользователю"""
+async def send_image_comparison(chat_id: int, state: FSMContext, notice: Optional[str] = None) -> None:
+    """Отправляет сравнение двух изображений пользователю
+
+    notice - короткое уведомление о предыдущем шаге ("Вы выбрали ...", "Время вышло").
+    Оно выводится в тексте с кнопками (режим media_group) или в подписи (режим edit)
+    следующего сравнения, без отдельного сообщения. Сравнение обычно уже подготовлено
+    prefetch_comparison, пока пользователь смотрел на предыдущее; после отправки
+    в фоне готовится следующее.
+    """
     data = await state.get_data()
     
-    variable_images = data.get("variable_images", [])
     current_index = data.get("current_index", 0)
-    shown_comparisons = data.get("shown_comparisons", [])
     
-    if current_index >= len(variable_images) or current_index >= config.IMAGES_PER_SESSION:
+    if current_index >= session_length(data) or current_index >= config.IMAGES_PER_SESSION:
         # Все сравнения показаны
+        discard_prefetched_comparison(chat_id)
+        await send_session_finish(chat_id, state, data, notice)
+        return
+    
+    # Эксперимента нет или его каталог пронумерован заново: варианты сессии не восстановить
+    experiment = session_experiment(data, experiments)
+    if experiment is None:
+        logging.error(f"Experiment not found for session of chat {chat_id}")
+        discard_prefetched_comparison(chat_id)
         await bot.send_message(
             chat_id=chat_id,
-            text="🏆 Спасибо за помощь!\nТы помог(ла) сделать модель лучше. Хочешь попробовать ещё раз? 🚀",
-            reply_markup=get_finish_keyboard()
+            text="❌ Эта сессия больше недоступна. Отправь /start, чтобы начать заново."
         )
-        await state.set_state(RatingStates.finished)
-        
-        # Статистика
-        selections = data.get("selections", {})
-        original_count = sum(1 for v in selections.values() if v)
-        total = len(selections)
-        if total > 0:
-            original_percentage = int((original_count / total) * 100)
-            variant_percentage = 100 - original_percentage
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"📊 Статистика: ты выбрал(а) оригинал {original_count} из {total} раз ({original_percentage}%) и вариант {total-original_count} раз ({variant_percentage}%)!"
-            )
+        await state.clear()
         return
     
-    current_variable_image = variable_images[current_index]
-    variable_image_path = os.path.join(config.IMAGES_FOLDER, current_variable_image)
+    current_variable_name = split_key(session_variants(data, experiment)[current_index])[1]
     
-    # Проверяем существуют ли оба файла
-    if not os.path.exists(config.FIXED_IMAGE_PATH):
-        logging.error(f"Fixed image not found: {config.FIXED_IMAGE_PATH}")
+    # Проверяем существуют ли оба файла (по индексу каталога)
+    if not experiment.ready:
+        logging.error(f"Fixed image not found: {experiment.fixed_path}")
         await bot.send_message(
             chat_id=chat_id,
             text="❌ Ошибка: оригинальное изображение не найдено. Обратитесь к администратору."
         )
         return
     
-    if not os.path.exists(variable_image_path):
-        logging.error(f"Variable image not found: {variable_image_path}")
+    if current_variable_name not in experiment.catalog:
+        logging.error(f"Variable image not found: {experiment.path(current_variable_name)}")
         await bot.send_message(
             chat_id=chat_id,
-            text=f"❌ Ошибка: вариант изображения {current_variable_image} не найден. Пропускаем."
+            text=f"❌ Ошибка: вариант изображения {current_variable_name} не найден. Пропускаем."
         )
         # Переходим к следующему изображению
         await state.update_data(current_index=current_index + 1)
@@ -117,42 +399,39 @@ async def send_image_comparison(chat_id: int, state: FSMContext) -> None:
         return
     
     try:
-        # Отправляем оба изображения в одном сообщении с медиагруппой
-        media = [
-            InputMediaPhoto(
-                media=types.FSInputFile(config.FIXED_IMAGE_PATH),
-                caption="Какой вариант вам нравится больше?"
-            ),
-            InputMediaPhoto(
-                media=types.FSInputFile(variable_image_path)
-            )
-        ]
-        
-        # Отправляем группу изображений
-        await bot.send_media_group(chat_id=chat_id, media=media)
+        prepared = (await take_prefetched_comparison(chat_id, data.get("session_id"), current_index)
+                    or await prepare_comparison(experiment, data, current_index))
+        text = f"{notice}\n\n{prepared.text}" if notice else prepared.text
         
-        # Отправляем текст с кнопками выбора отдельным сообщением
-        await bot.send_message(
-            chat_id=chat_id,
-            text=f"📷 Сравнение {current_index + 1}/{min(len(variable_images), config.IMAGES_PER_SESSION)}\n\n"
-                 f"Слева: Оригинал (afro.jpg)\n"
-                 f"Справа: Вариант ({current_variable_image})\n\n"
-                 f"Какое изображение вам нравится больше? 🤔",
-            reply_markup=get_comparison_keyboard()
-        )
+        updates = {}
+        if config.COMPARISON_MODE == "edit":
+            # Одно сообщение со склейкой пары, которое редактируется на каждом шаге
+            updates['comparison_message_id'] = await send_photo_cached(
+                chat_id,
+                prepared.composite_path,
+                text,
+                prepared.keyboard,
+                message_id=data.get("comparison_message_id")
+            )
+        else:
+            # Отправляем оба изображения в одном сообщении с медиагруппой
+            await send_comparison_media(chat_id, prepared.image_paths, "Какой вариант вам нравится больше?")
+            
+            # Отправляем текст с кнопками выбора отдельным сообщением
+            await bot.send_message(chat_id=chat_id, text=text, reply_markup=prepared.keyboard)
         
-        # Обновляем список показанных сравнений
-        shown_comparisons.append((os.path.basename(config.FIXED_IMAGE_PATH), current_variable_image))
+        # Пока пользователь выбирает, готовим следующее сравнение
+        prefetch_comparison(chat_id, experiment, data, current_index + 1)
         
-        # Обновляем данные состояния
+        # Добавляем вариант в историю показов и обновляем данные состояния
         await state.update_data(
             current_index=current_index, 
-            shown_comparisons=shown_comparisons
+            shown=add_shown(data.get("shown", {}), experiment, [current_variable_name]),
+            **updates
         )
         
         # Установка таймера на указанный в конфиге промежуток времени
-        timer_task = asyncio.create_task(auto_skip_comparison(chat_id, state, current_index))
-        await state.update_data(timer_task=timer_task)
+        timeout_scheduler.schedule(chat_id, current_index, config.RESPONSE_TIMEOUT)
     
     except Exception as e:
         logging.error(f"Error sending comparison: {e}")
@@ -166,26 +445,49 @@ async def send_image_comparison(chat_id: int, state: FSMContext) -> None:
 
 async def auto_skip_comparison(chat_id: int, state: FSMContext, expected_index: int) -> None:
     """Автоматически пропускает сравнение, если пользователь не отвечает"""
-    await asyncio.sleep(config.RESPONSE_TIMEOUT)  # Ждем указанное в конфиге время
-    
-    # Проверяем, не выбрал ли пользователь уже
-    current_data = await state.get_data()
-    current_index = current_data.get("current_index", 0)
-    
-    if current_index == expected_index:  # Пользователь не сделал выбор
-        logging.info(f"User {chat_id} didn't select in comparison {expected_index}, skipping to next")
-        
-        # Обновляем индекс
-        await state.update_data(current_index=current_index + 1)
-        
-        # Отправляем сообщение о пропуске
-        await bot.send_message(
-            chat_id=chat_id,
-            text="⏱️ Время вышло! Переходим к следующему сравнению."
-        )
+    # Под блокировкой чата: нажатие, пришедшее одновременно с тайм-аутом, ждет его завершения
+    async with chat_locks(chat_id):
+        # Проверяем, не выбрал ли пользователь уже и не закончил ли сессию
+        if await state.get_state() != RatingStates.showing_comparisons.state:
+            return
+        current_data = await state.get_data()
+        current_index = current_data.get("current_index", 0)
         
-        # Отправляем следующее сравнение
-        await send_image_comparison(chat_id, state)
+        if current_index == expected_index:  # Пользователь не сделал выбор
+            logging.info(f"User {chat_id} didn't select in comparison {expected_index}, skipping to next")
+            
+            # Обновляем индекс
+            await state.update_data(current_index=current_index + 1)
+            
+            # Отправляем следующее сравнение с сообщением о пропуске
+            await send_image_comparison(chat_id, state, notice="⏱️ Время вышло! Переходим к следующему сравнению.")
+
+async def on_comparisons_expired(expired: List[Tuple[int, int]]) -> None:
+    """Обрабатывает пачку истекших таймеров сравнений"""
+    await asyncio.gather(*(
+        auto_skip_comparison(chat_id, get_chat_state(chat_id), index)
+        for chat_id, index in expired
+    ))
+
+def get_chat_state(chat_id: int) -> FSMContext:
+    """Возвращает FSM-контекст личного чата (chat_id совпадает с user_id)"""
+    return FSMContext(storage=dp.storage, key=StorageKey(bot_id=bot.id, chat_id=chat_id, user_id=chat_id))
+
+# Единый планировщик тайм-аутов вместо отдельной задачи на каждое сравнение
+timeout_scheduler = DeadlineScheduler(config.TIMERS_DB_PATH, on_comparisons_expired, resolution=config.TIMER_RESOLUTION,
+                                      persist_interval=config.TIMER_PERSIST_INTERVAL)
+
+# Показатели, которые считываются при запросе /metrics
+registry.gauge('bot_active_sessions', "Chats with updates within METRICS_ACTIVE_WINDOW", lambda: len(active_sessions))
+registry.gauge('bot_pending_timers', "Comparisons waiting for an answer", lambda: len(timeout_scheduler))
+registry.gauge('bot_chats_in_progress', "Chats with updates being processed or waiting for their turn", lambda: len(chat_locks))
+registry.gauge('bot_outbound_queue_depth', "Bot API requests waiting for the rate limiter", lambda: outbound_limiter.queue_depth)
+registry.gauge('bot_pending_comparison_writes', "Votes not yet written to the database", lambda: comparison_writer.pending_count)
+registry.gauge('bot_comparison_write_failures', "Consecutive failed attempts to write the oldest pending votes", lambda: comparison_writer.failures)
+registry.gauge('bot_image_cache_bytes', "Image bytes held in the in-memory cache", lambda: image_cache.size)
+registry.gauge('bot_image_cache_files', "Images held in the in-memory cache", lambda: len(image_cache))
+loop_lag_monitor = LoopLagMonitor()
+metrics_server = MetricsServer(config.METRICS_HOST, config.METRICS_PORT)
 
 # Обработчики команд
 @dp.message(Command("start"))
@@ -206,7 +508,9 @@ async def cmd_start(message: types.Message, state: FSMContext):
         reply_markup=get_start_keyboard()
     )
     
-    # Сбрасываем состояние, если оно было
+    # Сбрасываем состояние и таймер, если они были
+    timeout_scheduler.cancel(message.chat.id)
+    discard_prefetched_comparison(message.chat.id)
     await state.clear()
 
 # Обработчики колбэков
@@ -218,18 +522,18 @@ async def on_start_comparison(callback: types.CallbackQuery, state: FSMContext):
     
     # Получаем данные из состояния
     data = await state.get_data()
-    shown_comparisons = data.get("shown_comparisons", [])
+    history = session_history(data, experiments)
     
-    # Проверяем наличие фиксированного изображения
-    if not os.path.exists(config.FIXED_IMAGE_PATH):
-        logging.error(f"Fixed image not found: {config.FIXED_IMAGE_PATH}")
-        await callback.message.edit_text("❌ Ошибка: основное изображение не найдено. Обратитесь к администратору.")
+    # Проверяем, что есть хотя бы один эксперимент с оригиналом
+    if not experiments.experiments():
+        logging.error("No experiments with a fixed image are available")
+        await edit_callback_message(callback, "❌ Ошибка: основное изображение не найдено. Обратитесь к администратору.")
         await callback.answer()
         return
     
-    # Получаем переменные изображения (все кроме фиксированного)
+    # Эксперимент выбирается стратегией распределения сессий, варианты - случайно
     # Исключаем ранее показанные переменные изображения
-    shown_variable_images = [pair[1] for pair in shown_comparisons]
+    shown_variable_images = shown_variants(history, experiments)
     variable_images = await db.get_random_images(
         config.IMAGES_PER_SESSION, 
         exclude_for_user_id=user_id,
@@ -238,43 +542,45 @@ async def on_start_comparison(callback: types.CallbackQuery, state: FSMContext):
     
     # Проверяем, получили ли мы изображения
     if not variable_images:
-        # Если нет вариантов в базе, попробуем загрузить их из папки
+        # Если нет новых вариантов, берем любые изображения одного из экспериментов
         try:
-            all_images = []
-            for filename in os.listdir(config.IMAGES_FOLDER):
-                if filename.lower().endswith(('.jpg', '.jpeg', '.png')) and filename != os.path.basename(config.FIXED_IMAGE_PATH):
-                    all_images.append(filename)
+            experiment = experiments.allocate(user_id, set())
             
-            if all_images:
-                # Добавляем все изображения в базу данных
-                image_paths = [os.path.join(config.IMAGES_FOLDER, img) for img in all_images]
-                await db.add_images(image_paths)
-                
-                # Получаем случайные изображения
-                variable_images = random.sample(all_images, min(len(all_images), config.IMAGES_PER_SESSION))
-            else:
-                await callback.message.edit_text("❌ Ошибка: нет доступных вариантов изображений. Обратитесь к администратору.")
+            if experiment is not None:
+                variable_images = await db.get_random_images(config.IMAGES_PER_SESSION, experiment=experiment)
+            if not variable_images:
+                await edit_callback_message(callback, "❌ Ошибка: нет доступных вариантов изображений. Обратитесь к администратору.")
                 await callback.answer()
                 return
         except Exception as e:
             logging.error(f"Error loading images from folder: {e}")
-            await callback.message.edit_text("❌ Ошибка при загрузке изображений. Обратитесь к администратору.")
+            await edit_callback_message(callback, "❌ Ошибка при загрузке изображений. Обратитесь к администратору.")
             await callback.answer()
             return
     
-    # Сохраняем данные в состояние
-    await state.update_data(
-        variable_images=variable_images,
-        current_index=0,
-        shown_comparisons=shown_comparisons,
-        selections={}
-    )
+    # При повторном запуске в режиме edit продолжаем редактировать то же сообщение с фото
+    comparison_message_id = None
+    if config.COMPARISON_MODE == "edit" and callback.message.photo:
+        comparison_message_id = callback.message.message_id
+    
+    # Сохраняем данные новой сессии (компактно, см. session_state); от прошлой остается только история показов
+    experiment = experiments.experiment_for_key(variable_images[0])
+    await state.set_data({
+        "session_id": uuid.uuid4().hex[:16],
+        "experiment": experiment.id,
+        "catalog": experiment.catalog.generation,
+        "variants": encode_variants(experiment, variable_images),
+        "current_index": 0,
+        "shown": history,
+        "comparison_message_id": comparison_message_id
+    })
     
     # Устанавливаем состояние
     await state.set_state(RatingStates.showing_comparisons)
     
     # Отправляем сообщение о начале процесса
-    await callback.message.edit_text("🚀 Начинаем показ сравнений! Выбери изображение, которое тебе нравится больше.")
+    if comparison_message_id is None:
+        await edit_callback_message(callback, "🚀 Начинаем показ сравнений! Выбери изображение, которое тебе нравится больше.")
     
     # Отправляем первую пару изображений
     await send_image_comparison(callback.message.chat.id, state)
@@ -282,63 +588,75 @@ async def on_start_comparison(callback: types.CallbackQuery, state: FSMContext):
     # Отвечаем на callback, чтобы убрать состояние загрузки у кнопки
     await callback.answer()
 
-@dp.callback_query(F.data.in_(["select_original", "select_variant"]), RatingStates.showing_comparisons)
+@dp.callback_query(F.data.regexp(r"^select_(original|variant)(:\d+)?$"), RatingStates.showing_comparisons)
 async def on_comparison_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик выбора изображения"""
     # Получаем данные из состояния
     data = await state.get_data()
     current_index = data.get("current_index", 0)
-    variable_images = data.get("variable_images", [])
-    selections = data.get("selections", {})
+    
+    # Кнопка относится к уже пройденному сравнению: двойное нажатие или нажатие после
+    # тайм-аута. Кнопки без номера (клавиатуры, отправленные до его появления) относятся к текущему
+    choice, _, tapped_index = callback.data.partition(":")
+    if tapped_index and int(tapped_index) != current_index:
+        await callback.answer("Этот выбор уже учтен")
+        return
     
     # Если есть активный таймер, отменяем его
-    timer_task = data.get("timer_task")
-    if timer_task and not timer_task.done():
-        timer_task.cancel()
+    timeout_scheduler.cancel(callback.message.chat.id, current_index)
+    
+    # Голос не засчитывается: вариант сессии нельзя определить достоверно
+    experiment = session_experiment(data, experiments)
+    if experiment is None:
+        discard_prefetched_comparison(callback.message.chat.id)
+        await state.clear()
+        await callback.answer("Сессия больше недоступна, отправь /start")
+        return
     
     # Текущее переменное изображение
-    current_variable_image = variable_images[current_index]
+    current_variable_image = session_variants(data, experiment)[current_index]
     
     # Определяем выбор (оригинал или вариант)
-    selected_original = callback.data == "select_original"
+    selected_original = choice == "select_original"
     
-    # Сохраняем выбор
-    comparison_key = f"{os.path.basename(config.FIXED_IMAGE_PATH)}_{current_variable_image}"
-    selections[comparison_key] = selected_original
-    
-    # Сохраняем выбор в базу данных
-    await db.save_comparison_result(
+    # Сохраняем выбор: голос попадает в журнал сразу, а в базу данных - пачкой в фоне
+    # ID голоса - ключ идемпотентности (сессия и номер сравнения): повторная запись
+    # того же голоса не создает второй строки
+    session_id = data.get("session_id")
+    comparison_writer.submit(
         user_id=callback.from_user.id,
-        fixed_image_path=config.FIXED_IMAGE_PATH,
-        variable_image_path=os.path.join(config.IMAGES_FOLDER, current_variable_image),
-        selected_original=selected_original
+        fixed_image=experiment.fixed_key,
+        variable_image=current_variable_image,
+        selected_original=selected_original,
+        vote_id=f"{session_id}-{current_index}" if session_id else None
     )
     
-    # Обновляем данные состояния
+    # Обновляем данные состояния: выбор сохраняется в битовых масках сессии
     await state.update_data(
         current_index=current_index + 1,
-        selections=selections
+        **record_vote(data, current_index, selected_original)
     )
     
-    # Отвечаем на callback
-    await callback.answer("Выбор сохранен!")
-    
-    # Отправляем сообщение с результатом выбора
-    selected_text = "оригинал (слева)" if selected_original else f"вариант {current_variable_image} (справа)"
-    await bot.send_message(
-        chat_id=callback.message.chat.id,
-        text=f"Вы выбрали: {selected_text} ✅"
-    )
+    # Отвечаем на callback параллельно с отправкой следующего сравнения: подтверждение
+    # не должно задерживать новую пару
+    answer = asyncio.ensure_future(callback.answer("Выбор сохранен!"))
     
-    # Отправляем следующее сравнение
-    await send_image_comparison(callback.message.chat.id, state)
+    # Отправляем следующее сравнение с результатом выбора
+    selected_text = "оригинал (слева)" if selected_original else f"вариант {split_key(current_variable_image)[1]} (справа)"
+    try:
+        await send_image_comparison(callback.message.chat.id, state, notice=f"Вы выбрали: {selected_text} ✅")
+    finally:
+        await answer
 
 @dp.callback_query(F.data == "finish")
 async def on_finish(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик нажатия на кнопку 'Закончить'"""
-    await callback.message.edit_text(
+    await edit_callback_message(
+        callback,
         "Спасибо за участие! Если захочешь сравнить ещё изображения, просто отправь команду /start."
     )
+    timeout_scheduler.cancel(callback.message.chat.id)
+    discard_prefetched_comparison(callback.message.chat.id)
     await state.clear()
     await callback.answer()
 
@@ -361,55 +679,162 @@ async def cmd_stats(message: types.Message):
         logging.error(f"Failed to get user stats: {e}")
         await message.answer("К сожалению, не удалось получить статистику. Попробуйте позже.")
 
+# Обработчик команды рейтинга вариантов
+@dp.message(Command("top"))
+async def cmd_top(message: types.Message, command: CommandObject):
+    """Показывает варианты, которые чаще всего выигрывают у оригинала (/top <эксперимент> - в одном эксперименте)"""
+    try:
+        experiment_id = command.args.strip() if command.args else None
+        leaderboard = await db.get_leaderboard(config.TOP_VARIANTS_COUNT, experiment_id=experiment_id)
+        
+        if not leaderboard:
+            await message.answer("Пока недостаточно голосов для рейтинга. Попробуй позже!")
+            return
+        
+        title = f"🏅 Лучшие варианты против оригинала в эксперименте {experiment_id}:\n" if experiment_id else "🏅 Лучшие варианты против оригинала:\n"
+        lines = [title]
+        for place, item in enumerate(leaderboard, start=1):
+            lines.append(f"{place}. {item['variable_image']} - {item['win_rate'] * 100:.1f}% побед ({item['total']} голосов)")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        logging.error(f"Failed to get leaderboard: {e}")
+        await message.answer("К сожалению, не удалось получить рейтинг. Попробуйте позже.")
+
+# Обработчик команды статистики экспериментов
+@dp.message(Command("experiments"))
+async def cmd_experiments(message: types.Message):
+    """Показывает число голосов и долю выборов оригинала по экспериментам"""
+    try:
+        stats = await db.get_experiment_stats()
+        
+        if not stats:
+            await message.answer("Пока нет голосов ни в одном эксперименте.")
+            return
+        
+        lines = ["🧪 Эксперименты:\n"]
+        for item in stats[:config.TOP_VARIANTS_COUNT]:
+            lines.append(f"{item['experiment'] or 'default'} - {item['total']} голосов, оригинал {item['original_percentage']:.1f}%")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        logging.error(f"Failed to get experiment stats: {e}")
+        await message.answer("К сожалению, не удалось получить статистику экспериментов. Попробуйте позже.")
+
+async def run_webhook() -> None:
+    """Принимает обновления по webhook до сигнала остановки"""
+    if not config.WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+    server = WebhookServer(
+        bot, dp,
+        path=config.WEBHOOK_PATH,
+        secret=config.WEBHOOK_SECRET,
+        host=config.WEBHOOK_HOST,
+        port=config.WEBHOOK_PORT,
+        workers=config.WEBHOOK_WORKERS,
+        max_pending=config.WEBHOOK_MAX_PENDING,
+        index=config.WEBHOOK_PROCESS_INDEX,
+        peers=config.WEBHOOK_PEERS
+    )
+    registry.gauge('bot_webhook_pending_updates', "Webhook updates accepted but not processed", lambda: server.pool.pending)
+    await server.start()
+    
+    # Адрес регистрирует один процесс, остальные только принимают обновления
+    if config.WEBHOOK_URL and config.WEBHOOK_PROCESS_INDEX == 0:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS
+        )
+        logging.info(f"Webhook set to {config.WEBHOOK_URL}")
+    
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        # Принятые обновления дорабатываются до закрытия базы и записи голосов
+        await server.stop()
+
 # Главная функция для запуска бота
 async def main():
     try:
         # Инициализируем базу данных Firebase
         logging.info("Initializing Firebase database...")
-        await db.connect()  # Для совместимости, хотя Firebase инициализируется в __init__
+        await db.connect()  # Загружает индекс изображений, Firebase инициализируется в __init__
+        
+        # Метрики: задержка цикла событий и HTTP-эндпоинт /metrics
+        loop_lag_monitor.start()
+        if config.METRICS_PORT:
+            await metrics_server.start()
+        
+        # Запускаем отложенную запись сравнений (сначала дописываются голоса из журнала)
+        await comparison_writer.start()
+        
+        # Восстанавливаем таймеры сравнений, сохраненные до перезапуска
+        await timeout_scheduler.start()
         
         # Проверяем изображения
-        logging.info(f"Using images folder: {config.IMAGES_FOLDER}")
-        if os.path.exists(config.IMAGES_FOLDER):
-            # Добавляем изображения в базу данных
-            image_paths = []
+        images_folder = config.EXPERIMENTS_FOLDER or config.IMAGES_FOLDER
+        logging.info(f"Using images folder: {images_folder}")
+        if not os.path.exists(images_folder):
+            logging.error(f"Images folder does not exist: {images_folder}")
             try:
-                for filename in os.listdir(config.IMAGES_FOLDER):
-                    if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                        full_path = os.path.join(config.IMAGES_FOLDER, filename)
-                        if os.path.isfile(full_path):
-                            image_paths.append(full_path)
-                
-                if image_paths:
-                    logging.info(f"Adding {len(image_paths)} images to Firebase database")
-                    await db.add_images(image_paths)
-                else:
-                    logging.warning(f"No image files found in folder: {config.IMAGES_FOLDER}")
-            except Exception as e:
-                logging.error(f"Error scanning image directory: {e}")
-        else:
-            logging.error(f"Images folder does not exist: {config.IMAGES_FOLDER}")
-            try:
-                os.makedirs(config.IMAGES_FOLDER, exist_ok=True)
-                logging.info(f"Created images folder: {config.IMAGES_FOLDER}")
+                os.makedirs(images_folder, exist_ok=True)
+                logging.info(f"Created images folder: {images_folder}")
             except Exception as e:
                 logging.error(f"Failed to create images folder: {e}")
         
-        # Проверяем наличие фиксированного изображения
-        if not os.path.exists(config.FIXED_IMAGE_PATH):
-            logging.error(f"Fixed image not found: {config.FIXED_IMAGE_PATH}")
-        else:
-            logging.info(f"Fixed image found: {config.FIXED_IMAGE_PATH}")
-            # Добавляем фиксированное изображение в базу данных
-            await db.add_images([config.FIXED_IMAGE_PATH])
+        # Загружаем индексы каталогов экспериментов (из манифестов) и запускаем отслеживание
+        # изменений; папки без манифеста сканируются в фоне и добавляются по готовности
+        try:
+            await experiments.start()
+            ready = experiments.experiments()
+            image_keys = [key for e in ready for key in [e.fixed_key] + e.variant_keys()]
+            
+            if image_keys:
+                logging.info(f"Adding {len(image_keys)} images of {len(ready)} experiments to Firebase database")
+                await db.add_images(image_keys)
+                # Склейки строятся параллельно с работой бота; до готовности пара рисуется по запросу
+                for experiment in ready:
+                    schedule_composite_prebuild(experiment, experiment.catalog.paths())
+            else:
+                logging.warning("No experiment catalogs loaded yet, scanning in background")
+        except Exception as e:
+            logging.error(f"Error scanning image directory: {e}")
+        
+        # Стратегия распределения сессий продолжает с накопленных счетчиков экспериментов
+        experiments.allocator.seed({
+            item['experiment']: item['total'] // config.IMAGES_PER_SESSION
+            for item in await db.get_experiment_stats()
+        })
+        # Выбор вариантов продолжает с накопленных голосов
+        await db.load_sampler_stats()
+        
+        # Оригиналы и лучшие варианты загружаются первыми сессиями нового бота - читаем их заранее
+        await warm_image_cache()
         
         # Запускаем бота
-        logging.info("Starting the bot...")
-        await dp.start_polling(bot)
+        logging.info(f"Starting the bot in {config.RUN_MODE} mode...")
+        if config.RUN_MODE == 'webhook':
+            await run_webhook()
+        else:
+            if config.RUN_MODE != 'polling':
+                logging.error(f"Unknown run mode: {config.RUN_MODE}, using polling")
+            # getUpdates не работает, пока у бота установлен webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
     finally:
         logging.info("Bot stopped!")
+        await metrics_server.stop()
+        await loop_lag_monitor.stop()
+        await experiments.stop()
+        file_id_cache.flush()
+        await timeout_scheduler.stop()
+        await comparison_writer.stop()
         await db.close()
         await bot.session.close()
 
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Расширения файлов, которые считаются изображениями
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class ImageEntry(NamedTuple):
+    """Запись индекса: имя файла, размер, mtime (нс) и SHA-256 содержимого"""
+    name: str
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 содержимого файла"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Обработчик изменений: (добавленные или измененные имена, удаленные имена)
+ChangeHandler = Callable[[List[str], List[str]], Awaitable[None]]
+
+
+class ImageCatalog:
+    """Индекс изображений папки в памяти
+
+    Обработчики и база данных узнают о наличии файлов, их размере и хэше из индекса,
+    не обращаясь к файловой системе. Индекс сохраняется в манифест, поэтому при
+    запуске файлы не перехэшируются; фоновая задача раз в poll_interval секунд
+    сверяет размеры и mtime и пересчитывает хэш только изменившихся файлов.
+
+    Каждому имени выдается постоянный порядковый номер (ordinal): номера не меняются
+    при добавлении и удалении файлов и не переиспользуются, поэтому по ним можно
+    компактно хранить ссылки на изображения (например, в данных сессий). Если номера
+    выдаются заново (манифест потерян или поврежден, другая папка), меняется поколение
+    каталога generation: ссылки, сохраненные с прежним поколением, недействительны.
+    """
+
+    def __init__(self, folder: str, manifest_path: str, poll_interval: float = 10.0):
+        self.folder = os.path.abspath(folder)
+        self.manifest_path = manifest_path
+        self.poll_interval = poll_interval
+        self._entries: Dict[str, ImageEntry] = {}
+        self._names: List[str] = []
+        self._ordinals: Dict[str, int] = {}
+        self._ordinal_names: Dict[int, str] = {}
+        # Поколение нумерации; сохраняется в манифесте вместе с номерами
+        self.generation = ''
+        self._loaded = False
+        self._handlers: List[ChangeHandler] = []
+        self._poll_task: Optional[asyncio.Task] = None
+        self._refresh_lock: Optional[asyncio.Lock] = None
+
+    # Чтение индекса
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def names(self) -> List[str]:
+        """Имена всех изображений в алфавитном порядке"""
+        return self._names
+
+    def paths(self) -> List[str]:
+        """Полные пути всех изображений"""
+        return [os.path.join(self.folder, name) for name in self._names]
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def get(self, name: str) -> Optional[ImageEntry]:
+        return self._entries.get(name)
+
+    def entry_for_path(self, path: str) -> Optional[ImageEntry]:
+        """Запись индекса для полного пути, если файл лежит в этой папке"""
+        if os.path.dirname(os.path.abspath(path)) != self.folder:
+            return None
+        return self._entries.get(os.path.basename(path))
+
+    def ordinal(self, name: str) -> Optional[int]:
+        """Постоянный порядковый номер изображения"""
+        return self._ordinals.get(name)
+
+    def name_for_ordinal(self, ordinal: int) -> Optional[str]:
+        """Имя изображения по порядковому номеру (в том числе удаленного из папки)"""
+        return self._ordinal_names.get(ordinal)
+
+    def exists(self, path: str) -> bool:
+        """Есть ли файл в индексе (замена os.path.exists для изображений каталога)"""
+        return self.entry_for_path(path) is not None
+
+    # Загрузка и обновление
+
+    def on_change(self, handler: ChangeHandler):
+        """Регистрирует обработчик, вызываемый после изменения набора изображений"""
+        self._handlers.append(handler)
+
+    def _load_manifest(self) -> Tuple[Dict[str, ImageEntry], Dict[str, int], str]:
+        """Записи индекса, порядковые номера и поколение нумерации из манифеста"""
+        if not os.path.exists(self.manifest_path):
+            return {}, {}, ''
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('folder') != self.folder:
+                logging.info("Catalog manifest describes another folder, rescanning")
+                return {}, {}, ''
+            entries = {name: ImageEntry(name, *values) for name, values in data.get('images', {}).items()}
+            # В манифестах прежнего формата номеров нет - они выдаются заново
+            return entries, data.get('ordinals', {}), data.get('generation', '')
+        except Exception as e:
+            logging.error(f"Error loading catalog manifest: {e}")
+            return {}, {}, ''
+
+    def _save_manifest(self):
+        """Атомарно сохраняет манифест на диск"""
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'folder': self.folder,
+                    'images': {name: [e.size, e.mtime_ns, e.sha256] for name, e in self._entries.items()},
+                    'ordinals': self._ordinals,
+                    'generation': self.generation
+                }, f, ensure_ascii=False)
+            os.replace(tmp_path, self.manifest_path)
+        except Exception as e:
+            logging.error(f"Error saving catalog manifest: {e}")
+
+    def _scan(self, known: Dict[str, ImageEntry]) -> Tuple[Dict[str, ImageEntry], List[str], List[str]]:
+        """Сверяет папку с индексом known; хэширует только новые и изменившиеся файлы
+
+        Выполняется в отдельном потоке и не меняет состояние каталога.
+        """
+        entries: Dict[str, ImageEntry] = {}
+        changed = []
+        try:
+            with os.scandir(self.folder) as it:
+                for dir_entry in it:
+                    if not dir_entry.name.lower().endswith(IMAGE_EXTENSIONS) or not dir_entry.is_file():
+                        continue
+                    try:
+                        stat = dir_entry.stat()
+                        entry = known.get(dir_entry.name)
+                        if entry is None or entry.size != stat.st_size or entry.mtime_ns != stat.st_mtime_ns:
+                            entry = ImageEntry(dir_entry.name, stat.st_size, stat.st_mtime_ns, file_digest(dir_entry.path))
+                            changed.append(dir_entry.name)
+                        entries[dir_entry.name] = entry
+                    except OSError as e:
+                        # Файл удалили или еще дописывают - учтем при следующем опросе
+                        logging.warning(f"Cannot read image {dir_entry.path}: {e}")
+        except FileNotFoundError:
+            logging.error(f"Images folder does not exist: {self.folder}")
+        removed = [name for name in known if name not in entries]
+        return entries, changed, removed
+
+    def _apply(self, entries: Dict[str, ImageEntry]):
+        self._entries = entries
+        self._names = sorted(entries)
+        if not self._ordinals:
+            # Номера выдаются с нуля: ссылки на номера прежней нумерации недействительны
+            self.generation = uuid.uuid4().hex[:8]
+        # Новым именам - следующие номера; номера удаленных файлов сохраняются
+        next_ordinal = max(self._ordinal_names, default=-1) + 1
+        for name in self._names:
+            if name not in self._ordinals:
+                self._ordinals[name] = next_ordinal
+                self._ordinal_names[next_ordinal] = name
+                next_ordinal += 1
+
+    def _restore_ordinals(self, ordinals: Dict[str, int], generation: str):
+        self._ordinals = dict(ordinals)
+        self._ordinal_names = {ordinal: name for name, ordinal in ordinals.items()}
+        # Манифесты, записанные до появления поколений, получают новое
+        self.generation = generation if ordinals and generation else uuid.uuid4().hex[:8]
+
+    async def load(self):
+        """Загружает индекс из манифеста, без манифеста - сканирует папку"""
+        entries, ordinals, generation = await asyncio.to_thread(self._load_manifest)
+        if entries:
+            self._restore_ordinals(ordinals, generation)
+            self._apply(entries)
+            if len(ordinals) < len(self._ordinals) or self.generation != generation:
+                await asyncio.to_thread(self._save_manifest)
+            logging.info(f"Loaded catalog manifest: {len(entries)} images")
+        else:
+            entries, _, _ = await asyncio.to_thread(self._scan, {})
+            self._apply(entries)
+            await asyncio.to_thread(self._save_manifest)
+            logging.info(f"Scanned images folder: {len(entries)} images")
+        self._loaded = True
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await self.load()
+
+    async def refresh(self) -> Tuple[List[str], List[str]]:
+        """Обновляет индекс по изменениям в папке; возвращает (измененные, удаленные) имена"""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            entries, changed, removed = await asyncio.to_thread(self._scan, self._entries)
+            if not changed and not removed:
+                return [], []
+            self._apply(entries)
+            await asyncio.to_thread(self._save_manifest)
+            logging.info(f"Catalog changed: {len(changed)} added or modified, {len(removed)} removed")
+        for handler in self._handlers:
+            try:
+                await handler(changed, removed)
+            except Exception as e:
+                logging.error(f"Error in catalog change handler: {e}")
+        return changed, removed
+
+    async def start(self):
+        """Запускает фоновую сверку папки; первая сверка подхватывает изменения, сделанные без бота"""
+        await self.ensure_loaded()
+        self._poll_task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Error refreshing image catalog: {e}")
+            await asyncio.sleep(self.poll_interval)
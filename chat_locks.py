@@ -0,0 +1,80 @@
+import asyncio
+import collections
+import contextlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+
+class ChatLocks:
+    """Асинхронные блокировки по чатам
+
+    Блокировка создается при первом ожидании и удаляется, когда ее никто не держит и не ждет,
+    поэтому память занимают только чаты с обновлениями в обработке. asyncio.Lock выдается
+    в порядке ожидания, так что обновления чата применяются в порядке поступления.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        """Число чатов, чьи обновления сейчас обрабатываются или ждут"""
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, chat_id: Hashable):
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[chat_id] -= 1
+            if not self._users[chat_id]:
+                del self._users[chat_id]
+                del self._locks[chat_id]
+
+
+class ChatSerializationMiddleware(BaseMiddleware):
+    """Внешний middleware обновлений: обновления одного чата обрабатываются по очереди
+
+    Фильтры и обработчик выполняются под блокировкой чата, поэтому двойное нажатие или
+    нажатие одновременно с тайм-аутом видят состояние, уже обновленное предыдущим шагом;
+    обновления разных чатов по-прежнему идут параллельно. Повторно доставленные
+    callback-запросы (тот же id) отбрасываются: последние seen_limit id хранятся в памяти.
+    """
+
+    def __init__(self, locks: ChatLocks, seen_limit: int = 10000):
+        self.locks = locks
+        self.seen_limit = seen_limit
+        self.duplicates = 0
+        self._seen_callbacks: collections.OrderedDict = collections.OrderedDict()
+
+    def _is_duplicate(self, update: Update) -> bool:
+        callback = update.callback_query
+        if callback is None:
+            return False
+        if callback.id in self._seen_callbacks:
+            return True
+        self._seen_callbacks[callback.id] = None
+        if len(self._seen_callbacks) > self.seen_limit:
+            self._seen_callbacks.popitem(last=False)
+        return False
+
+    async def __call__(self, handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]], event: Update, data: Dict[str, Any]) -> Any:
+        if self._is_duplicate(event):
+            self.duplicates += 1
+            logging.info(f"Skipping duplicate callback query {event.callback_query.id}")
+            return None
+        chat = data.get('event_chat')
+        user = data.get('event_from_user')
+        key = chat.id if chat is not None else user.id if user is not None else None
+        if key is None:
+            return await handler(event, data)
+        async with self.locks(key):
+            return await handler(event, data)
@@ -73,3 +73,143 @@ LOG_LEVEL = os.getenv('LOG_LEVEL', "INFO")
 USERS_COLLECTION = os.getenv('USERS_COLLECTION', "users")
 IMAGES_COLLECTION = os.getenv('IMAGES_COLLECTION', "images")
 COMPARISONS_COLLECTION = os.getenv('COMPARISONS_COLLECTION', "comparisons")
+# Служебные счетчики (выдача порядковых номеров изображений)
+COUNTERS_COLLECTION = os.getenv('COUNTERS_COLLECTION', "counters")
+
+# Ограничения на число одновременных запросов к Firestore
+DB_MAX_CONCURRENT_READS = int(os.getenv('DB_MAX_CONCURRENT_READS', 50))
+DB_MAX_CONCURRENT_WRITES = int(os.getenv('DB_MAX_CONCURRENT_WRITES', 20))
+
+# Каталог для служебных данных бота (кэши, журналы)
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(__file__), 'data'))
+
+# Хранилище данных: firestore или sqlite (встроенная база для разработки и небольших установок)
+DB_BACKEND = os.getenv('DB_BACKEND', "firestore")
+SQLITE_DB_PATH = os.getenv('SQLITE_DB_PATH', os.path.join(DATA_DIR, 'bot.sqlite3'))
+
+# Кэш Telegram file_id загруженных изображений
+FILE_ID_CACHE_PATH = os.getenv('FILE_ID_CACHE_PATH', os.path.join(DATA_DIR, 'file_ids.json'))
+
+# Кэш содержимого изображений в памяти для загрузки файлов без file_id (байты)
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Файлы больше этого размера читаются с диска при каждой загрузке
+IMAGE_CACHE_MAX_FILE_BYTES = int(os.getenv('IMAGE_CACHE_MAX_FILE_BYTES', 10 * 1024 * 1024))
+# Сколько лучших по рейтингу вариантов загрузить в кэш при запуске (вместе с оригиналами)
+IMAGE_CACHE_WARM_VARIANTS = int(os.getenv('IMAGE_CACHE_WARM_VARIANTS', 20))
+
+# Максимальное число операций в одном пакете записи Firestore
+FIRESTORE_BATCH_LIMIT = int(os.getenv('FIRESTORE_BATCH_LIMIT', 500))
+
+# Отложенная запись результатов сравнений: размер пачки, интервал записи (сек) и журнал
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 1.0))
+# fsync журнала после каждой строки: голос переживает сбой питания, но каждый ответ ждет диска
+WRITE_BEHIND_FSYNC = os.getenv('WRITE_BEHIND_FSYNC', 'true').lower() == 'true'
+COMPARISON_JOURNAL_PATH = os.getenv('COMPARISON_JOURNAL_PATH', os.path.join(DATA_DIR, 'comparisons.journal'))
+# Повтор неудачной записи: пауза удваивается до WRITE_BEHIND_MAX_BACKOFF (сек); после
+# WRITE_BEHIND_MAX_ATTEMPTS неудач подряд пачка, которая мешает записи следующих, переносится
+# в файл отложенных голосов (формат журнала: чтобы повторить, допишите его строки в журнал)
+WRITE_BEHIND_MAX_BACKOFF = float(os.getenv('WRITE_BEHIND_MAX_BACKOFF', 60.0))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', 5))
+COMPARISON_DEAD_LETTER_PATH = os.getenv('COMPARISON_DEAD_LETTER_PATH', os.path.join(DATA_DIR, 'comparisons.dead'))
+
+# Шардированные счетчики побед/поражений вариантов и рейтинг для /top
+VARIANT_STATS_COLLECTION = os.getenv('VARIANT_STATS_COLLECTION', "variant_stats")
+VARIANT_COUNTER_SHARDS = int(os.getenv('VARIANT_COUNTER_SHARDS', 10))
+LEADERBOARD_REFRESH_INTERVAL = int(os.getenv('LEADERBOARD_REFRESH_INTERVAL', 300))
+TOP_VARIANTS_COUNT = int(os.getenv('TOP_VARIANTS_COUNT', 10))
+
+# Хранилище состояний FSM: memory, sqlite или redis
+FSM_STORAGE = os.getenv('FSM_STORAGE', "sqlite")
+FSM_SQLITE_PATH = os.getenv('FSM_SQLITE_PATH', os.path.join(DATA_DIR, 'fsm.sqlite3'))
+REDIS_URL = os.getenv('REDIS_URL', "redis://localhost:6379/0")
+# Время жизни неактивной сессии (в секундах)
+FSM_SESSION_TTL = int(os.getenv('FSM_SESSION_TTL', 7 * 24 * 3600))
+# Предельный размер истории показанных вариантов в данных сессии (в байтах):
+# при превышении забываются эксперименты, показанные раньше остальных
+SESSION_HISTORY_MAX_BYTES = int(os.getenv('SESSION_HISTORY_MAX_BYTES', 1024))
+
+# Хранилище дедлайнов тайм-аутов сравнений
+TIMERS_DB_PATH = os.getenv('TIMERS_DB_PATH', os.path.join(DATA_DIR, 'timers.sqlite3'))
+# Шаг округления дедлайнов (в секундах): близкие таймеры обрабатываются одной пачкой
+TIMER_RESOLUTION = float(os.getenv('TIMER_RESOLUTION', 0.5))
+# Интервал (в секундах) записи изменений таймеров в SQLite одной транзакцией
+TIMER_PERSIST_INTERVAL = float(os.getenv('TIMER_PERSIST_INTERVAL', 1.0))
+
+# Ограничения скорости исходящих запросов к Bot API (сообщений в секунду)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', 5))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 3))
+
+# Режим показа сравнений: media_group (две фотографии и сообщение с кнопками)
+# или edit (одно сообщение со склейкой пары, которое редактируется на каждом шаге)
+COMPARISON_MODE = os.getenv('COMPARISON_MODE', "media_group")
+COMPOSITES_DIR = os.getenv('COMPOSITES_DIR', os.path.join(DATA_DIR, 'composites'))
+# Размер одной панели склейки: вся склейка 1280 пикселей в ширину - предельный размер,
+# до которого Telegram уменьшает фотографии, поэтому повторного сжатия не происходит
+COMPOSITE_PANEL_WIDTH = int(os.getenv('COMPOSITE_PANEL_WIDTH', 640))
+COMPOSITE_PANEL_HEIGHT = int(os.getenv('COMPOSITE_PANEL_HEIGHT', 640))
+# Шрифт подписей "Оригинал" / "Вариант" (нужна кириллица)
+COMPOSITE_FONT_PATH = os.getenv('COMPOSITE_FONT_PATH', "DejaVuSans.ttf")
+# Число процессов для построения склеек (0 - по числу ядер)
+COMPOSITE_WORKERS = int(os.getenv('COMPOSITE_WORKERS', 0))
+
+# Манифест каталога изображений (имя, размер, mtime, хэш), чтобы не сканировать папку при запуске
+CATALOG_MANIFEST_PATH = os.getenv('CATALOG_MANIFEST_PATH', os.path.join(DATA_DIR, 'catalog.json'))
+# Как часто проверять папку с изображениями на изменения (в секундах)
+CATALOG_POLL_INTERVAL = float(os.getenv('CATALOG_POLL_INTERVAL', 10))
+
+# Папка с экспериментами: каждая подпапка - отдельный эксперимент со своим оригиналом
+# и вариантами. По умолчанию (пустое значение) - один эксперимент из IMAGES_FOLDER с оригиналом
+# FIXED_IMAGE_PATH. Ключи изображений экспериментов - "<эксперимент>/<имя файла>", поэтому
+# накопленные в режиме одной папки изображения, показанные варианты и статистика к ним не переходят
+EXPERIMENTS_FOLDER = os.getenv('EXPERIMENTS_FOLDER', "")
+# Оригиналы экспериментов, отличающиеся от FIXED_IMAGE_NAME, в виде "img_1=img_1.jpg,img_5=smith.jpg"
+EXPERIMENT_FIXED_IMAGES = dict(
+    item.split('=', 1) for item in os.getenv('EXPERIMENT_FIXED_IMAGES', "").split(',') if '=' in item
+)
+# Манифесты каталогов экспериментов
+CATALOG_MANIFEST_DIR = os.getenv('CATALOG_MANIFEST_DIR', os.path.join(DATA_DIR, 'catalogs'))
+# Распределение сессий по экспериментам: least_served, round_robin, random или sticky
+SESSION_ALLOCATOR = os.getenv('SESSION_ALLOCATOR', "least_served")
+# Коллекция со счетчиками голосов по экспериментам
+EXPERIMENTS_COLLECTION = os.getenv('EXPERIMENTS_COLLECTION', "experiments")
+# Выбор вариантов для сессии: thompson (чаще показывать варианты, чье место в рейтинге
+# еще не определено) или uniform (равномерно случайно)
+VARIANT_SAMPLER = os.getenv('VARIANT_SAMPLER', "thompson")
+
+# Инкрементальная выгрузка сравнений (export_comparisons.py --incremental): файл с отметкой
+# времени записи (written_at), до которой сравнения уже выгружены, и сколько секунд
+# не выгружать самые свежие записи, пока не завершатся начатые пакеты
+EXPORT_WATERMARK_PATH = os.getenv('EXPORT_WATERMARK_PATH', os.path.join(DATA_DIR, 'export_watermark.json'))
+EXPORT_SETTLE_SECONDS = float(os.getenv('EXPORT_SETTLE_SECONDS', 600))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - не запускать)
+METRICS_HOST = os.getenv('METRICS_HOST', "127.0.0.1")
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+# Сессия считается активной, если от чата были обновления за это время (в секундах)
+METRICS_ACTIVE_WINDOW = float(os.getenv('METRICS_ACTIVE_WINDOW', 300))
+
+# Способ получения обновлений: polling или webhook
+RUN_MODE = os.getenv('RUN_MODE', "polling")
+# Публичный адрес, на который Telegram отправляет обновления (например, https://bot.example.com);
+# пустое значение - не вызывать setWebhook (адрес настроен заранее)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', "")
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', "/webhook")
+# Секретный токен setWebhook: запросы без него отклоняются
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', "")
+# Адрес встроенного сервера за обратным прокси
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+# Одновременно обрабатываемые обновления и предел принятых, но не обработанных
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 64))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 1000))
+# Число параллельных соединений Telegram к webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+# Несколько процессов за одним прокси: адреса всех процессов по порядку
+# ("http://127.0.0.1:8081,http://127.0.0.1:8082") и номер этого процесса в списке.
+# Каждому процессу нужен свой DATA_DIR (база SQLite, если выбрана, общая - задайте
+# SQLITE_DB_PATH явно); setWebhook вызывает процесс 0
+WEBHOOK_PEERS = [peer for peer in os.getenv('WEBHOOK_PEERS', "").split(',') if peer]
+WEBHOOK_PROCESS_INDEX = int(os.getenv('WEBHOOK_PROCESS_INDEX', 0))
@@ -1,16 +1,266 @@
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from firebase_admin import firestore_async
+from google.api_core.exceptions import AlreadyExists
+import asyncio
+from abc import ABC, abstractmethod
 import os
 import logging
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Set, Tuple
 import datetime
+import math
+import uuid
 import config
 import random
+from experiments import ExperimentRegistry, Experiment, SINGLE_EXPERIMENT_DOC_ID, split_key
+from sampling import VariantSampler, create_sampler
+
+# Документ коллекции config.COUNTERS_COLLECTION со следующим свободным номером изображения
+IMAGE_ORDINALS_DOC_ID = "image_ordinals"
+
+# Сравнений в одном пакете записи Firestore: каждое дает не больше четырех операций
+# (сравнение, пользователь, шард счетчика варианта, эксперимент)
+COMPARISONS_PER_COMMIT = max(1, config.FIRESTORE_BATCH_LIMIT // 4)
+
+def wilson_lower_bound(wins: int, total: int, z: float = 1.96) -> float:
+    """Нижняя граница доверительного интервала Уилсона для доли побед"""
+    if total == 0:
+        return 0.0
+    p = wins / total
+    denominator = 1 + z * z / total
+    centre = p + z * z / (2 * total)
+    margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total))
+    return (centre - margin) / denominator
+
+class BaseDatabase(ABC):
+    """Общая часть хранилищ данных бота
+
+    Выбор изображений для сессии, рейтинг для /top и стратегии выбора вариантов не зависят
+    от хранилища и реализованы здесь поверх методов, которые реализует конкретное хранилище:
+    FirestoreDatabase (Firebase Firestore) или SQLiteDatabase (встроенная база SQLite).
+    Хранилище выбирается в config.DB_BACKEND, экземпляр создает create_database.
+    """
+
+    def __init__(self, experiments: Optional[ExperimentRegistry] = None):
+        """experiments - эксперименты и индексы их каталогов; по умолчанию строятся по config"""
+        # Наличие файлов изображений проверяется по индексам каталогов, а не на диске
+        self.experiments = experiments if experiments is not None else ExperimentRegistry.from_config()
+        
+        # Стратегии выбора вариантов для сессий, по одной на эксперимент
+        self._samplers: Dict[str, VariantSampler] = {}
+        
+        # Кэш рейтинга вариантов для /top
+        self._leaderboard: List[Dict] = []
+        self._leaderboard_updated_at: Optional[float] = None
+        self._leaderboard_lock: Optional[asyncio.Lock] = None
+    
+    # Методы хранилища
+    
+    @abstractmethod
+    async def connect(self):
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def close(self):
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def save_user(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def add_images(self, image_keys: List[str]):
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def get_image_id(self, filename: str) -> Optional[str]:
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def get_seen_images(self, user_id: int) -> Set[str]:
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def save_comparison_batch(self, records: List[Dict]) -> bool:
+        raise NotImplementedError
+    
+    @abstractmethod
+    def iter_comparison_pages(self, page_size: int = 1000, since: Optional[datetime.datetime] = None,
+                              until: Optional[datetime.datetime] = None, time_field: str = 'created_at'):
+        """Асинхронный генератор страниц сравнений, упорядоченных по time_field
+
+        time_field - created_at (время голоса) или written_at (время записи в базу).
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def backfill_stats(self) -> int:
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def get_experiment_stats(self) -> List[Dict]:
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def get_variant_stats(self) -> List[Dict]:
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def get_user_stats(self, user_id: int) -> Dict:
+        raise NotImplementedError
+    
+    # Общая логика
+    
+    async def get_random_images(self, count: int, exclude_for_user_id=None, exclude_images=None,
+                                experiment: Optional[Experiment] = None) -> List[str]:
+        """Возвращает ключи вариантов одного эксперимента для сессии
+
+        Варианты выбирает стратегия config.VARIANT_SAMPLER (по умолчанию томпсоновское
+        сэмплирование по голосам). Если эксперимент не передан, его выбирает стратегия распределения сессий среди
+        экспериментов, где у пользователя остались непоказанные варианты.
+        """
+        try:
+            # Исключаем указанные изображения и изображения, уже показанные пользователю
+            excluded = set(exclude_images or ())
+            if exclude_for_user_id:
+                # Множество показанных вариантов читается одним запросом, без обхода сравнений
+                excluded |= await self.get_seen_images(exclude_for_user_id)
+            
+            if experiment is None:
+                experiment = self.experiments.allocate(exclude_for_user_id or 0, excluded)
+                if experiment is None:
+                    logging.info(f"No unseen images left for user {exclude_for_user_id}")
+                    return []
+            
+            # Варианты выбираются из индекса каталога эксперимента стратегией config.VARIANT_SAMPLER
+            selected_images = self._sampler(experiment.id).select(experiment.variant_keys(), count, excluded)
+            if not selected_images:
+                return []
+            
+            # Добавляем выбранные изображения в базу данных, если их там еще нет
+            await self.add_images([experiment.fixed_key] + selected_images)
+            
+            return selected_images
+        
+        except Exception as e:
+            logging.error(f"Error getting random images: {e}")
+            return []
+
+    async def save_comparison_result(self, user_id: int, fixed_image_path: str, variable_image_path: str, selected_original: bool):
+        """Сохраняет результат сравнения"""
+        try:
+            # Получаем ключи изображений из путей
+            fixed_filename = self.experiments.key_for_path(fixed_image_path)
+            variable_filename = self.experiments.key_for_path(variable_image_path)
+            
+            # Проверяем существование файлов по индексу каталога
+            if not self.experiments.exists(fixed_image_path):
+                logging.error(f"Fixed image not found: {fixed_image_path}")
+                return False
+                
+            if not self.experiments.exists(variable_image_path):
+                logging.error(f"Variable image not found: {variable_image_path}")
+                return False
+            
+            # Сохраняем результат сравнения
+            saved = await self.save_comparison_batch([{
+                'id': uuid.uuid4().hex,
+                'user_id': user_id,
+                'fixed_image': fixed_filename,
+                'variable_image': variable_filename,
+                'selected_original': selected_original,
+                'created_at': None
+            }])
+            if not saved:
+                return False
+            
+            logging.info(f"Saved comparison: user={user_id}, fixed={fixed_filename}, variable={variable_filename}, selected_original={selected_original}")
+            return True
+        
+        except Exception as e:
+            logging.error(f"Error saving comparison: {e}")
+            return False
+
+    async def iter_comparisons(self):
+        """Перебирает все сравнения как (user_id, фиксированное изображение, вариант, selected_original)"""
+        async for page in self.iter_comparison_pages(page_size=5000):
+            for record in page:
+                yield record['user_id'], record['fixed_image'], record['variable_image'], record['selected_original']
+
+    def _sampler(self, experiment_id: str) -> VariantSampler:
+        sampler = self._samplers.get(experiment_id)
+        if sampler is None:
+            sampler = create_sampler(config.VARIANT_SAMPLER)
+            self._samplers[experiment_id] = sampler
+        return sampler
+
+    def _observe_votes(self, variant_counters: Dict[Tuple[str, str], List[int]]):
+        """Передает стратегиям выбора записанные голоса: (оригинал, вариант) -> [поражения, победы]"""
+        for (fixed_image, variable_image), (losses, wins) in variant_counters.items():
+            self._sampler(split_key(fixed_image)[0]).observe(variable_image, wins, losses)
+
+    async def load_sampler_stats(self):
+        """Передает стратегиям выбора вариантов накопленные счетчики побед и поражений"""
+        try:
+            counts: Dict[str, Dict[str, Tuple[int, int]]] = {}
+            for item in await self.get_variant_stats():
+                counts.setdefault(item['experiment'], {})[item['variable_image']] = (item['wins'], item['losses'])
+            for experiment_id, experiment_counts in counts.items():
+                self._sampler(experiment_id).seed(experiment_counts)
+            logging.info(f"Loaded variant stats of {len(counts)} experiments into samplers")
+        except Exception as e:
+            logging.error(f"Error loading variant stats into samplers: {e}")
+
+    async def get_leaderboard(self, limit: int, experiment_id: Optional[str] = None) -> List[Dict]:
+        """Возвращает лучшие варианты из кэша, обновляя его не чаще LEADERBOARD_REFRESH_INTERVAL
+
+        experiment_id - показать варианты только одного эксперимента.
+        """
+        try:
+            if self._leaderboard_lock is None:
+                self._leaderboard_lock = asyncio.Lock()
+            async with self._leaderboard_lock:
+                now = asyncio.get_running_loop().time()
+                if self._leaderboard_updated_at is None or now - self._leaderboard_updated_at >= config.LEADERBOARD_REFRESH_INTERVAL:
+                    self._leaderboard = await self.get_variant_stats()
+                    self._leaderboard_updated_at = now
+        
+        except Exception as e:
+            logging.error(f"Error getting leaderboard: {e}")
+        
+        if experiment_id is None:
+            return self._leaderboard[:limit]
+        return [item for item in self._leaderboard if item['experiment'] == experiment_id][:limit]
+
+
+class FirestoreDatabase(BaseDatabase):
+    def __init__(self, client=None, experiments: Optional[ExperimentRegistry] = None):
+        """Инициализация соединения с Firebase Firestore
+
+        client - готовый асинхронный клиент (например, локальная заглушка Firestore
+        для бенчмарков). Если не передан, создается AsyncClient из firebase_admin.
+        """
+        super().__init__(experiments)
+        
+        # Семафоры, ограничивающие число одновременных запросов к Firestore
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        
+        # Индекс каталога изображений: ключ изображения ("<эксперимент>/<имя файла>") <-> ID документа
+        self._image_ids: Dict[str, str] = {}
+        self._image_filenames: Dict[str, str] = {}
+        self._image_ordinals: Dict[str, int] = {}
+        self._ordinal_filenames: Dict[int, str] = {}
+        self._image_index_loaded = False
+        # ID документов изображений, которых нет в коллекции (удалены) - чтобы не запрашивать их повторно
+        self._missing_image_ids: Set[str] = set()
+        self._image_lock: Optional[asyncio.Lock] = None
+
+        if client is not None:
+            self.db = client
+            logging.info("Using provided Firestore client")
+            return
 
-class Database:
-    def __init__(self):
-        """Инициализация соединения с Firebase Firestore"""
         try:
             # Проверяем, не инициализирован ли уже Firebase
             if not firebase_admin._apps:
@@ -34,17 +284,30 @@ class Database:
                 })
                 logging.info("Firebase initialized successfully")
             
-            # Получение клиента Firestore
-            self.db = firestore.client()
-            logging.info("Firestore client created")
+            # Получение асинхронного клиента Firestore, чтобы запросы не блокировали event loop
+            self.db = firestore_async.client()
+            logging.info("Firestore async client created")
         
         except Exception as e:
             logging.error(f"Error initializing Firebase: {e}")
             raise
     
+    def _limit(self, operation: str) -> asyncio.Semaphore:
+        """Возвращает семафор для типа операции ('read' или 'write')
+
+        Семафоры создаются лениво, чтобы привязываться к уже запущенному event loop.
+        """
+        semaphore = self._limits.get(operation)
+        if semaphore is None:
+            limit = config.DB_MAX_CONCURRENT_WRITES if operation == 'write' else config.DB_MAX_CONCURRENT_READS
+            semaphore = asyncio.Semaphore(limit)
+            self._limits[operation] = semaphore
+        return semaphore
+
     async def connect(self):
-        """Метод для совместимости с существующим кодом"""
+        """Загружает индекс изображений; соединение с Firebase управляется автоматически"""
         logging.info("Firebase connection is managed automatically")
+        await self.load_image_index()
         return True
     
     async def close(self):
@@ -59,13 +322,14 @@ class Database:
             user_ref = self.db.collection(config.USERS_COLLECTION).document(str(user_id))
             
             # Создаем или обновляем документ пользователя
-            user_ref.set({
-                'user_id': user_id,
-                'username': username,
-                'first_name': first_name,
-                'last_name': last_name,
-                'created_at': firestore.SERVER_TIMESTAMP  # Автоматическая метка времени
-            }, merge=True)  # merge=True работает как UPSERT
+            async with self._limit('write'):
+                await user_ref.set({
+                    'user_id': user_id,
+                    'username': username,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'created_at': firestore.SERVER_TIMESTAMP  # Автоматическая метка времени
+                }, merge=True)  # merge=True работает как UPSERT
             
             logging.info(f"User saved/updated: {user_id}, {username}")
             return True
@@ -74,35 +338,136 @@ class Database:
             logging.error(f"Error saving user: {e}")
             return False
     
-    async def add_images(self, image_paths: List[str]):
-        """Добавляет изображения в базу данных Firestore"""
-        try:
-            # Используем пакетную запись для эффективности
+    async def _commit_batches(self, writes: List[Tuple]):
+        """Записывает операции (ссылка, данные, merge) пакетами не больше лимита Firestore"""
+        for start in range(0, len(writes), config.FIRESTORE_BATCH_LIMIT):
             batch = self.db.batch()
-            added_count = 0
+            for ref, data, merge in writes[start:start + config.FIRESTORE_BATCH_LIMIT]:
+                batch.set(ref, data, merge=merge)
+            async with self._limit('write'):
+                await batch.commit()
+
+    def _image_index_lock(self) -> asyncio.Lock:
+        """Блокировка для загрузки и пополнения индекса изображений"""
+        if self._image_lock is None:
+            self._image_lock = asyncio.Lock()
+        return self._image_lock
+
+    async def load_image_index(self):
+        """Загружает весь каталог изображений одним запросом в индекс имя файла -> ID
+
+        Каждому изображению соответствует постоянный порядковый номер (ordinal), по которому
+        хранится множество уже показанных пользователю вариантов. Документам без номера
+        (созданным до его появления) номера назначаются здесь же.
+        """
+        async with self._image_index_lock():
+            query = self.db.collection(config.IMAGES_COLLECTION).select(['filename', 'ordinal'])
+            async with self._limit('read'):
+                docs = [doc async for doc in query.stream()]
+            
+            self._image_ids = {}
+            self._image_ordinals = {}
+            unnumbered = []
+            for doc in sorted(docs, key=lambda d: d.id):
+                data = doc.to_dict()
+                filename = data.get('filename')
+                # При дубликатах оставляем первый найденный документ
+                if not filename or filename in self._image_ids:
+                    continue
+                self._image_ids[filename] = doc.id
+                ordinal = data.get('ordinal')
+                if ordinal is None:
+                    unnumbered.append((doc.reference, filename))
+                else:
+                    self._image_ordinals[filename] = ordinal
             
-            for path in image_paths:
-                filename = os.path.basename(path)
+            # Назначаем номера старым документам
+            writes = []
+            if unnumbered:
+                next_ordinal = await self._allocate_ordinals(len(unnumbered))
+                for ref, filename in unnumbered:
+                    self._image_ordinals[filename] = next_ordinal
+                    writes.append((ref, {'ordinal': next_ordinal}, True))
+                    next_ordinal += 1
+            if writes:
+                await self._commit_batches(writes)
+                logging.info(f"Assigned ordinals to {len(writes)} images")
+            
+            self._image_filenames = {image_id: filename for filename, image_id in self._image_ids.items()}
+            self._ordinal_filenames = {ordinal: filename for filename, ordinal in self._image_ordinals.items()}
+            self._image_index_loaded = True
+            logging.info(f"Loaded image index: {len(self._image_ids)} images")
+
+    async def _allocate_ordinals(self, count: int) -> int:
+        """Резервирует count последовательных номеров изображений; возвращает первый из них
+
+        Следующий свободный номер хранится в документе счетчика и увеличивается в транзакции,
+        поэтому процессы, одновременно добавляющие изображения, получают разные номера
+        (при конфликте транзакция повторяется). Счетчик, которого еще нет (номера назначались
+        до его появления), продолжает наибольший номер в индексе. Номера зарезервированных,
+        но не записанных изображений остаются неиспользованными.
+        """
+        counter_ref = self.db.collection(config.COUNTERS_COLLECTION).document(IMAGE_ORDINALS_DOC_ID)
+        
+        @firestore.async_transactional
+        async def allocate(transaction) -> int:
+            snapshot = await counter_ref.get(transaction=transaction)
+            stored = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            start = max(stored.get('next', 0), max(self._image_ordinals.values(), default=-1) + 1)
+            transaction.set(counter_ref, {'next': start + count}, merge=True)
+            return start
+        
+        async with self._limit('write'):
+            return await allocate(self.db.transaction())
+
+    async def _ensure_image_index(self):
+        """Загружает индекс изображений при первом обращении"""
+        if not self._image_index_loaded:
+            await self.load_image_index()
+
+    async def add_images(self, image_keys: List[str]):
+        """Добавляет изображения в базу данных Firestore
+
+        image_keys - ключи изображений: "<эксперимент>/<имя файла>", а в режиме одной
+        папки - имена файлов. Ключ хранится в поле filename, ID эксперимента - в experiment.
+        """
+        try:
+            await self._ensure_image_index()
+            
+            async with self._image_index_lock():
+                # Новые изображения определяются по индексу в памяти, без запросов к Firestore
+                new_filenames = []
+                seen_keys = set()
+                for filename in image_keys:
+                    if filename not in self._image_ids and filename not in seen_keys:
+                        new_filenames.append(filename)
+                        seen_keys.add(filename)
                 
-                # Проверяем, существует ли изображение с таким именем
-                images_query = self.db.collection(config.IMAGES_COLLECTION).where('filename', '==', filename).limit(1)
-                existing_images = list(images_query.stream())
+                if not new_filenames:
+                    logging.debug("No new images to add")
+                    return True
                 
-                if not existing_images:
-                    # Если изображение не существует, добавляем его
-                    new_image_ref = self.db.collection(config.IMAGES_COLLECTION).document()
-                    batch.set(new_image_ref, {
+                collection = self.db.collection(config.IMAGES_COLLECTION)
+                next_ordinal = await self._allocate_ordinals(len(new_filenames))
+                writes = []
+                for ordinal, filename in enumerate(new_filenames, start=next_ordinal):
+                    writes.append((collection.document(), {
                         'filename': filename,
+                        'experiment': split_key(filename)[0],
+                        'ordinal': ordinal,
                         'upload_date': firestore.SERVER_TIMESTAMP
-                    })
-                    added_count += 1
-            
-            # Выполняем пакетную операцию только если есть что добавлять
-            if added_count > 0:
-                batch.commit()
-                logging.info(f"Added {added_count} new images to database")
-            else:
-                logging.info("No new images to add")
+                    }, False))
+                
+                # Используем пакетную запись для эффективности
+                await self._commit_batches(writes)
+                
+                # Пополняем индекс только после успешной записи
+                for ref, data, _ in writes:
+                    self._image_ids[data['filename']] = ref.id
+                    self._image_filenames[ref.id] = data['filename']
+                    self._image_ordinals[data['filename']] = data['ordinal']
+                    self._ordinal_filenames[data['ordinal']] = data['filename']
+                logging.info(f"Added {len(writes)} new images to database")
             
             return True
         
@@ -111,129 +476,408 @@ class Database:
             return False
     
     async def get_image_id(self, filename: str) -> Optional[str]:
-        """Получает ID изображения по имени файла"""
+        """Получает ID изображения по имени файла (из индекса в памяти)"""
         try:
-            # Запрос для поиска изображения по имени файла
-            query = self.db.collection(config.IMAGES_COLLECTION).where('filename', '==', filename).limit(1)
-            results = list(query.stream())
-            
-            if results:
-                return results[0].id
-            return None
+            await self._ensure_image_index()
+            return self._image_ids.get(filename)
         
         except Exception as e:
             logging.error(f"Error getting image ID: {e}")
             return None
     
-    async def get_random_images(self, count: int, exclude_for_user_id=None, exclude_images=None) -> List[str]:
-        """Возвращает случайные изображения из базы данных Firestore"""
+    async def get_seen_images(self, user_id: int) -> Set[str]:
+        """Возвращает имена вариантов, которые пользователь уже оценивал
+
+        Множество хранится в документе пользователя (поле seen_ordinals) и читается
+        одним запросом. Для пользователей, у которых поля еще нет, оно однократно
+        восстанавливается по коллекции сравнений.
+        """
+        await self._ensure_image_index()
+        user_ref = self.db.collection(config.USERS_COLLECTION).document(str(user_id))
+        async with self._limit('read'):
+            user_doc = await user_ref.get()
+        
+        seen_ordinals = user_doc.to_dict().get('seen_ordinals') if user_doc.exists else None
+        if seen_ordinals is None:
+            seen_ordinals = await self._backfill_seen_ordinals(user_id)
+        
+        return {self._ordinal_filenames[o] for o in seen_ordinals if o in self._ordinal_filenames}
+
+    async def _backfill_seen_ordinals(self, user_id: int) -> List[int]:
+        """Восстанавливает seen_ordinals пользователя по его сравнениям и сохраняет их"""
+        query = self.db.collection(config.COMPARISONS_COLLECTION).where('user_id', '==', user_id)
+        async with self._limit('read'):
+            comparison_docs = [doc async for doc in query.stream()]
+        
+        seen_ordinals = set()
+        for doc in comparison_docs:
+            filename = self._image_filenames.get(doc.to_dict().get('variable_image_id'))
+            if filename in self._image_ordinals:
+                seen_ordinals.add(self._image_ordinals[filename])
+        
+        user_ref = self.db.collection(config.USERS_COLLECTION).document(str(user_id))
+        async with self._limit('write'):
+            await user_ref.set({'seen_ordinals': sorted(seen_ordinals)}, merge=True)
+        logging.info(f"Backfilled seen images for user {user_id}: {len(seen_ordinals)}")
+        return sorted(seen_ordinals)
+
+    async def save_comparison_batch(self, records: List[Dict]) -> bool:
+        """Сохраняет пачку результатов сравнений
+
+        Каждая запись содержит id, user_id, fixed_image и variable_image (ключи изображений),
+        selected_original и created_at (None - время сервера). Пачка записывается частями
+        по COMPARISONS_PER_COMMIT сравнений; сравнения части, отметка вариантов в seen_ordinals
+        и счетчики статистики пользователей, вариантов и экспериментов попадают в один пакет.
+        Документы сравнений создаются с переданными id через create(): если сравнение уже
+        записано (повтор пачки из журнала или после частичной записи), пакет отклоняется
+        целиком и записывается заново без него, поэтому повтор не создает дубликатов
+        и не увеличивает счетчики повторно - как INSERT OR IGNORE в SQLiteDatabase.
+        """
         try:
-            # Получаем имя фиксированного изображения
-            fixed_image_name = os.path.basename(config.FIXED_IMAGE_PATH)
-            
-            # Получаем доступные изображения из файловой системы
-            available_images = []
-            if os.path.exists(config.IMAGES_FOLDER):
-                for filename in os.listdir(config.IMAGES_FOLDER):
-                    if filename.lower().endswith(('.jpg', '.jpeg', '.png')) and filename != fixed_image_name:
-                        if os.path.isfile(os.path.join(config.IMAGES_FOLDER, filename)):
-                            available_images.append(filename)
-            
-            if not available_images:
-                logging.error("No available images found in the images folder")
-                return []
-            
-            # Исключаем указанные изображения
-            if exclude_images and len(exclude_images) > 0:
-                available_images = [img for img in available_images if img not in exclude_images]
-            
-            # Если нужно исключить изображения, уже показанные пользователю
-            if exclude_for_user_id:
-                # Получаем сравнения для этого пользователя
-                comparison_docs = self.db.collection(config.COMPARISONS_COLLECTION).where('user_id', '==', exclude_for_user_id).stream()
-                
-                # Получаем имена переменных изображений из сравнений
-                shown_images = []
-                for doc in comparison_docs:
-                    data = doc.to_dict()
-                    variable_image_id = data.get('variable_image_id')
-                    if variable_image_id:
-                        image_doc = self.db.collection(config.IMAGES_COLLECTION).document(variable_image_id).get()
-                        if image_doc.exists:
-                            image_filename = image_doc.to_dict().get('filename')
-                            if image_filename:
-                                shown_images.append(image_filename)
-                
-                # Исключаем показанные изображения
-                available_images = [img for img in available_images if img not in shown_images]
+            # Изображения, которых еще нет в каталоге, добавляем одним вызовом
+            filenames = {r['fixed_image'] for r in records} | {r['variable_image'] for r in records}
+            missing = [filename for filename in filenames if await self.get_image_id(filename) is None]
+            if missing:
+                await self.add_images(missing)
             
-            # Перемешиваем и ограничиваем количество
-            random.shuffle(available_images)
-            selected_images = available_images[:min(count, len(available_images))]
-            
-            # Добавляем выбранные изображения в базу данных, если их там еще нет
-            image_paths = [os.path.join(config.IMAGES_FOLDER, img) for img in selected_images]
-            await self.add_images(image_paths)
-            
-            return selected_images
+            # Повторы одного голоса внутри пачки записываются один раз
+            records = list({record['id']: record for record in records}.values())
+            saved = 0
+            for start in range(0, len(records), COMPARISONS_PER_COMMIT):
+                saved += await self._create_comparisons(records[start:start + COMPARISONS_PER_COMMIT])
+            logging.debug(f"Saved {saved} of {len(records)} comparisons")
+            return True
         
         except Exception as e:
-            logging.error(f"Error getting random images: {e}")
-            return []
+            logging.error(f"Error saving comparison batch: {e}")
+            return False
     
-    async def save_comparison_result(self, user_id: int, fixed_image_path: str, variable_image_path: str, selected_original: bool):
-        """Сохраняет результат сравнения в Firestore"""
-        try:
-            # Получаем имена файлов из путей
-            fixed_filename = os.path.basename(fixed_image_path)
-            variable_filename = os.path.basename(variable_image_path)
-            
-            # Проверяем существование файлов
-            if not os.path.exists(fixed_image_path):
-                logging.error(f"Fixed image not found: {fixed_image_path}")
-                return False
-                
-            if not os.path.exists(variable_image_path):
-                logging.error(f"Variable image not found: {variable_image_path}")
-                return False
+    async def _create_comparisons(self, records: List[Dict]) -> int:
+        """Записывает сравнения и их счетчики одним пакетом; возвращает число новых сравнений
+
+        Если пакет отклонен из-за уже существующего сравнения, записанные сравнения
+        определяются одним чтением и пакет повторяется без них. Если чтение не нашло ни
+        одного из них (чтение отстает или конфликт не из-за повтора), AlreadyExists
+        передается вызывающему: пачка остается в журнале и повторяется позже.
+        """
+        comparisons = self.db.collection(config.COMPARISONS_COLLECTION)
+        while records:
+            writes, variant_counters = self._comparison_writes(records)
+            batch = self.db.batch()
+            for ref, data, merge in writes:
+                if merge is None:
+                    batch.create(ref, data)
+                else:
+                    batch.set(ref, data, merge=merge)
+            try:
+                async with self._limit('write'):
+                    await batch.commit()
+            except AlreadyExists:
+                refs = [comparisons.document(record['id']) for record in records]
+                async with self._limit('read'):
+                    existing = {snapshot.id async for snapshot in self.db.get_all(refs, field_paths=[]) if snapshot.exists}
+                if not existing:
+                    raise
+                logging.info(f"Skipping {len(existing)} already saved comparisons")
+                records = [record for record in records if record['id'] not in existing]
+                continue
             
-            # Получаем ID изображений
-            fixed_image_id = await self.get_image_id(fixed_filename)
-            variable_image_id = await self.get_image_id(variable_filename)
+            # Голоса учитываются в апостериорных оценках только после записи пакета,
+            # поэтому повтор пачки после ошибки не засчитывает их дважды
+            self._observe_votes(variant_counters)
+            return len(records)
+        return 0
+    
+    def _comparison_writes(self, records: List[Dict]) -> Tuple[List[Tuple], Dict[Tuple[str, str], List[int]]]:
+        """Операции записи сравнений и счетчиков и счетчики вариантов (оригинал, вариант) -> [поражения, победы]
+
+        Операции - (ссылка, данные, merge); merge=None - создание документа сравнения.
+        """
+        records_by_user: Dict[int, List[Dict]] = {}
+        for record in records:
+            records_by_user.setdefault(record['user_id'], []).append(record)
+        
+        comparisons = self.db.collection(config.COMPARISONS_COLLECTION)
+        users = self.db.collection(config.USERS_COLLECTION)
+        writes = []
+        for user_id, user_records in records_by_user.items():
+            for record in user_records:
+                writes.append((comparisons.document(record['id']), {
+                    'user_id': user_id,
+                    'fixed_image_id': self._image_ids[record['fixed_image']],
+                    'variable_image_id': self._image_ids[record['variable_image']],
+                    'selected_original': record['selected_original'],
+                    'created_at': record.get('created_at') or firestore.SERVER_TIMESTAMP,
+                    # Время записи на сервере: голоса из журнала записываются позже, чем поданы
+                    'written_at': firestore.SERVER_TIMESTAMP
+                }, None))
+            seen_ordinals = sorted({self._image_ordinals[r['variable_image']] for r in user_records})
+            original_selected = sum(1 for r in user_records if r['selected_original'])
+            writes.append((users.document(str(user_id)), {
+                'seen_ordinals': firestore.ArrayUnion(seen_ordinals),
+                'total_comparisons': firestore.Increment(len(user_records)),
+                'original_selected': firestore.Increment(original_selected),
+                'variant_selected': firestore.Increment(len(user_records) - original_selected)
+            }, True))
+        
+        # Глобальные счетчики побед/поражений вариантов (в случайный шард)
+        variant_counters: Dict[Tuple[str, str], List[int]] = {}
+        for record in records:
+            counters = variant_counters.setdefault((record['fixed_image'], record['variable_image']), [0, 0])
+            counters[0 if record['selected_original'] else 1] += 1
+        for (fixed_image, variable_image), (losses, wins) in variant_counters.items():
+            shard = random.randrange(config.VARIANT_COUNTER_SHARDS)
+            writes.append(self._variant_counter_write(fixed_image, variable_image, shard, {
+                'wins': firestore.Increment(wins),
+                'losses': firestore.Increment(losses)
+            }))
+        
+        # Счетчики экспериментов: одна запись на эксперимент в пакете
+        experiment_counters: Dict[str, List[int]] = {}
+        for record in records:
+            counters = experiment_counters.setdefault(split_key(record['fixed_image'])[0], [0, 0])
+            counters[0] += 1
+            counters[1] += 1 if record['selected_original'] else 0
+        for experiment_id, (total, original_selected) in experiment_counters.items():
+            writes.append(self._experiment_counter_write(experiment_id, {
+                'total_comparisons': firestore.Increment(total),
+                'original_selected': firestore.Increment(original_selected),
+                'variant_selected': firestore.Increment(total - original_selected)
+            }))
+        return writes, variant_counters
+    
+    async def get_image_filename(self, image_id: str) -> Optional[str]:
+        """Ключ изображения по ID документа: из индекса в памяти, при промахе - одним чтением документа
+
+        Изображения, добавленные другим процессом после загрузки индекса, дочитываются
+        и запоминаются; отсутствующие документы запоминаются отдельно.
+        """
+        await self._ensure_image_index()
+        filename = self._image_filenames.get(image_id)
+        if filename is not None or not image_id or image_id in self._missing_image_ids:
+            return filename
+        async with self._limit('read'):
+            doc = await self.db.collection(config.IMAGES_COLLECTION).document(image_id).get()
+        data = doc.to_dict() if doc.exists else {}
+        filename = data.get('filename')
+        if not filename:
+            self._missing_image_ids.add(image_id)
+            return None
+        self._image_filenames[image_id] = filename
+        self._image_ids.setdefault(filename, image_id)
+        return filename
+    
+    async def iter_comparison_pages(self, page_size: int = 1000, since: Optional[datetime.datetime] = None,
+                                    until: Optional[datetime.datetime] = None, time_field: str = 'created_at'):
+        """Перебирает сравнения страницами, упорядоченными по time_field
+
+        Каждая страница - отдельный запрос с курсором после последнего документа предыдущей,
+        поэтому в памяти не больше page_size документов, а долгий поток чтения не держит
+        соединение. since (включительно) и until (исключительно) ограничивают time_field:
+        created_at - время голоса, written_at - время записи документа на сервере (у сравнений,
+        записанных до его появления, written_at нет, и по нему они не выбираются).
+        Страница - список словарей id, user_id, fixed_image, variable_image (ключи изображений),
+        selected_original, created_at, written_at (None, если его нет); сравнения с неизвестными
+        изображениями пропускаются.
+        """
+        fields = ['user_id', 'fixed_image_id', 'variable_image_id', 'selected_original', 'created_at', 'written_at']
+        query = self.db.collection(config.COMPARISONS_COLLECTION).select(fields)
+        if since is not None:
+            query = query.where(time_field, '>=', since)
+        if until is not None:
+            query = query.where(time_field, '<', until)
+        query = query.order_by(time_field).limit(page_size)
+        
+        last_doc = None
+        while True:
+            page_query = query.start_after(last_doc) if last_doc is not None else query
+            async with self._limit('read'):
+                docs = await page_query.get()
+            if not docs:
+                return
             
-            # Если изображения еще не в базе, добавляем их
-            if not fixed_image_id or not variable_image_id:
-                await self.add_images([fixed_image_path, variable_image_path])
-                fixed_image_id = await self.get_image_id(fixed_filename)
-                variable_image_id = await self.get_image_id(variable_filename)
+            page = []
+            for doc in docs:
+                data = doc.to_dict()
+                fixed_image = await self.get_image_filename(data.get('fixed_image_id'))
+                variable_image = await self.get_image_filename(data.get('variable_image_id'))
+                if data.get('user_id') is None or not fixed_image or not variable_image:
+                    continue
+                page.append({
+                    'id': doc.id,
+                    'user_id': data['user_id'],
+                    'fixed_image': fixed_image,
+                    'variable_image': variable_image,
+                    'selected_original': data.get('selected_original', False),
+                    'created_at': data.get('created_at'),
+                    'written_at': data.get('written_at')
+                })
+            yield page
             
-            # Сохраняем результат сравнения
-            self.db.collection(config.COMPARISONS_COLLECTION).add({
-                'user_id': user_id,
-                'fixed_image_id': fixed_image_id,
-                'variable_image_id': variable_image_id,
-                'selected_original': selected_original,
-                'created_at': firestore.SERVER_TIMESTAMP
+            if len(docs) < page_size:
+                return
+            last_doc = docs[-1]
+    
+    async def backfill_stats(self) -> int:
+        """Пересчитывает счетчики пользователей, seen_ordinals и счетчики вариантов по сравнениям
+
+        Разовая операция для данных, записанных до появления счетчиков. Значения
+        перезаписываются целиком, поэтому запускать ее следует при остановленном боте.
+        Возвращает число обновленных пользователей.
+        """
+        await self._ensure_image_index()
+        query = self.db.collection(config.COMPARISONS_COLLECTION).select(['user_id', 'fixed_image_id', 'variable_image_id', 'selected_original'])
+        
+        totals: Dict[int, List[int]] = {}
+        seen: Dict[int, Set[int]] = {}
+        variant_totals: Dict[Tuple[str, str], List[int]] = {}
+        experiment_totals: Dict[str, List[int]] = {}
+        async with self._limit('read'):
+            async for doc in query.stream():
+                data = doc.to_dict()
+                user_id = data.get('user_id')
+                if user_id is None:
+                    continue
+                counters = totals.setdefault(user_id, [0, 0])
+                counters[0] += 1
+                counters[1] += 1 if data.get('selected_original', False) else 0
+                filename = self._image_filenames.get(data.get('variable_image_id'))
+                if filename in self._image_ordinals:
+                    seen.setdefault(user_id, set()).add(self._image_ordinals[filename])
+                fixed_filename = self._image_filenames.get(data.get('fixed_image_id'))
+                if filename and fixed_filename:
+                    variant_counters = variant_totals.setdefault((fixed_filename, filename), [0, 0])
+                    variant_counters[0 if data.get('selected_original', False) else 1] += 1
+                    experiment_counters = experiment_totals.setdefault(split_key(fixed_filename)[0], [0, 0])
+                    experiment_counters[0] += 1
+                    experiment_counters[1] += 1 if data.get('selected_original', False) else 0
+        
+        users = self.db.collection(config.USERS_COLLECTION)
+        writes = []
+        for user_id, (total, original_selected) in totals.items():
+            writes.append((users.document(str(user_id)), {
+                'seen_ordinals': sorted(seen.get(user_id, ())),
+                'total_comparisons': total,
+                'original_selected': original_selected,
+                'variant_selected': total - original_selected
+            }, True))
+        await self._commit_batches(writes)
+        logging.info(f"Backfilled stats for {len(writes)} users")
+        
+        # Счетчики вариантов записываются в шард 0, остальные шарды обнуляются
+        variant_writes = []
+        for (fixed_image, variable_image), (losses, wins) in variant_totals.items():
+            variant_writes.append(self._variant_counter_write(fixed_image, variable_image, 0, {'wins': wins, 'losses': losses}))
+            for shard in range(1, config.VARIANT_COUNTER_SHARDS):
+                variant_writes.append(self._variant_counter_write(fixed_image, variable_image, shard, {'wins': 0, 'losses': 0}))
+        await self._commit_batches(variant_writes)
+        logging.info(f"Backfilled stats for {len(variant_totals)} variants")
+        
+        await self._commit_batches([
+            self._experiment_counter_write(experiment_id, {
+                'total_comparisons': total,
+                'original_selected': original_selected,
+                'variant_selected': total - original_selected
             })
+            for experiment_id, (total, original_selected) in experiment_totals.items()
+        ])
+        logging.info(f"Backfilled stats for {len(experiment_totals)} experiments")
+        self._leaderboard_updated_at = None
+        return len(writes)
+    
+    def _variant_counter_write(self, fixed_image: str, variable_image: str, shard: int, counters: Dict) -> Tuple:
+        """Операция записи в шард счетчика побед/поражений варианта
+
+        Счетчик варианта разбит на VARIANT_COUNTER_SHARDS документов, чтобы частые голоса
+        за популярный вариант не упирались в лимит записей в один документ Firestore.
+        """
+        fixed_image_id = self._image_ids[fixed_image]
+        variable_image_id = self._image_ids[variable_image]
+        ref = self.db.collection(config.VARIANT_STATS_COLLECTION).document(f"{fixed_image_id}_{variable_image_id}_{shard}")
+        return (ref, {
+            'fixed_image_id': fixed_image_id,
+            'variable_image_id': variable_image_id,
+            'shard': shard,
+            **counters
+        }, True)
+
+    def _experiment_counter_write(self, experiment_id: str, counters: Dict) -> Tuple:
+        """Операция записи в счетчики эксперимента (документ с ID эксперимента)"""
+        ref = self.db.collection(config.EXPERIMENTS_COLLECTION).document(experiment_id or SINGLE_EXPERIMENT_DOC_ID)
+        return (ref, {'experiment': experiment_id, **counters}, True)
+
+    async def get_experiment_stats(self) -> List[Dict]:
+        """Возвращает счетчики голосов по экспериментам, от большего числа голосов к меньшему"""
+        try:
+            async with self._limit('read'):
+                docs = [doc.to_dict() async for doc in self.db.collection(config.EXPERIMENTS_COLLECTION).stream()]
             
-            logging.info(f"Saved comparison: user={user_id}, fixed={fixed_filename}, variable={variable_filename}, selected_original={selected_original}")
-            return True
+            stats = []
+            for data in docs:
+                total = data.get('total_comparisons', 0)
+                original_selected = data.get('original_selected', 0)
+                stats.append({
+                    'experiment': data.get('experiment', ''),
+                    'total': total,
+                    'original_selected': original_selected,
+                    'variant_selected': data.get('variant_selected', 0),
+                    'original_percentage': (original_selected / total * 100) if total > 0 else 0
+                })
+            stats.sort(key=lambda item: item['total'], reverse=True)
+            return stats
         
         except Exception as e:
-            logging.error(f"Error saving comparison: {e}")
-            return False
-    
+            logging.error(f"Error getting experiment stats: {e}")
+            return []
+
+    async def get_variant_stats(self) -> List[Dict]:
+        """Суммирует шарды счетчиков и возвращает статистику всех вариантов
+
+        Варианты отсортированы по нижней границе доверительного интервала Уилсона
+        для доли побед над оригиналом, чтобы варианты с парой голосов не занимали верх списка.
+        """
+        await self._ensure_image_index()
+        async with self._limit('read'):
+            shards = [doc.to_dict() async for doc in self.db.collection(config.VARIANT_STATS_COLLECTION).stream()]
+        
+        totals: Dict[Tuple[str, str], List[int]] = {}
+        for shard in shards:
+            key = (shard.get('fixed_image_id'), shard.get('variable_image_id'))
+            counters = totals.setdefault(key, [0, 0])
+            counters[0] += shard.get('wins', 0)
+            counters[1] += shard.get('losses', 0)
+        
+        stats = []
+        for (fixed_image_id, variable_image_id), (wins, losses) in totals.items():
+            total = wins + losses
+            if total == 0:
+                continue
+            fixed_image = self._image_filenames.get(fixed_image_id, fixed_image_id)
+            stats.append({
+                'experiment': split_key(fixed_image)[0],
+                'fixed_image': fixed_image,
+                'variable_image': self._image_filenames.get(variable_image_id, variable_image_id),
+                'wins': wins,
+                'losses': losses,
+                'total': total,
+                'win_rate': wins / total,
+                'score': wilson_lower_bound(wins, total)
+            })
+        stats.sort(key=lambda item: item['score'], reverse=True)
+        return stats
+
     async def get_user_stats(self, user_id: int) -> Dict:
         """Возвращает статистику выборов пользователя из Firestore"""
         try:
-            # Получаем все сравнения пользователя
-            comparison_docs = self.db.collection(config.COMPARISONS_COLLECTION).where('user_id', '==', user_id).stream()
-            comparisons = list(comparison_docs)
+            # Счетчики хранятся в документе пользователя и обновляются вместе с каждым голосом
+            user_ref = self.db.collection(config.USERS_COLLECTION).document(str(user_id))
+            async with self._limit('read'):
+                user_doc = await user_ref.get()
+            user_data = user_doc.to_dict() if user_doc.exists else {}
             
-            # Подсчитываем статистику
-            total = len(comparisons)
-            original_selected = sum(1 for comp in comparisons if comp.to_dict().get('selected_original', False))
-            variant_selected = total - original_selected
+            total = user_data.get('total_comparisons', 0)
+            original_selected = user_data.get('original_selected', 0)
+            variant_selected = user_data.get('variant_selected', 0)
             
             # Вычисляем процент выбора оригинала
             original_percentage = (original_selected / total * 100) if total > 0 else 0
@@ -252,4 +896,15 @@ class Database:
                 "original_selected": 0,
                 "variant_selected": 0,
                 "original_percentage": 0
-            }
\ No newline at end of file
+            }
+
+
+def create_database(experiments: Optional[ExperimentRegistry] = None) -> BaseDatabase:
+    """Создает хранилище, выбранное в config.DB_BACKEND"""
+    if config.DB_BACKEND == 'sqlite':
+        from sqlite_database import SQLiteDatabase
+        logging.info(f"Using SQLite database: {config.SQLITE_DB_PATH}")
+        return SQLiteDatabase(config.SQLITE_DB_PATH, experiments=experiments)
+    if config.DB_BACKEND != 'firestore':
+        logging.error(f"Unknown database backend: {config.DB_BACKEND}, using firestore")
+    return FirestoreDatabase(experiments=experiments)
@@ -0,0 +1,335 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import random
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import config
+from catalog import ImageCatalog, ImageEntry
+
+# ID эксперимента в режиме одной папки (config.IMAGES_FOLDER); ключи изображений - имена файлов
+SINGLE_EXPERIMENT_ID = ""
+# ID документа счетчиков этого эксперимента в Firestore (пустой ID документа недопустим)
+SINGLE_EXPERIMENT_DOC_ID = "default"
+
+
+def split_key(image_key: str) -> Tuple[str, str]:
+    """Разбивает ключ изображения "<эксперимент>/<имя файла>" на ID эксперимента и имя"""
+    experiment_id, _, name = image_key.rpartition('/')
+    return experiment_id, name
+
+
+class Experiment:
+    """Эксперимент: папка с фиксированным изображением (оригиналом) и его вариантами
+
+    Изображения эксперимента идентифицируются ключами "<ID>/<имя файла>", поэтому
+    одинаковые имена файлов в разных папках не пересекаются ни в базе, ни в кэшах.
+    """
+
+    def __init__(self, experiment_id: str, folder: str, fixed_name: str, catalog: ImageCatalog):
+        self.id = experiment_id
+        self.folder = os.path.abspath(folder)
+        self.fixed_name = fixed_name
+        self.catalog = catalog
+        self._variant_keys: List[str] = []
+        self._variant_source: Optional[List[str]] = None
+
+    def __repr__(self) -> str:
+        return f"Experiment({self.id or '<single>'}, {len(self.catalog)} images)"
+
+    def key(self, name: str) -> str:
+        return f"{self.id}/{name}" if self.id else name
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    @property
+    def fixed_path(self) -> str:
+        return self.path(self.fixed_name)
+
+    @property
+    def fixed_key(self) -> str:
+        return self.key(self.fixed_name)
+
+    @property
+    def ready(self) -> bool:
+        """Индекс загружен и оригинал на месте - эксперимент можно показывать"""
+        return self.fixed_name in self.catalog
+
+    def variant_keys(self) -> List[str]:
+        """Ключи всех вариантов (без оригинала); список пересчитывается только после изменения каталога"""
+        names = self.catalog.names()
+        if names is not self._variant_source:
+            self._variant_keys = [self.key(name) for name in names if name != self.fixed_name]
+            self._variant_source = names
+        return self._variant_keys
+
+
+class SessionAllocator(ABC):
+    """Выбирает эксперимент для новой сессии пользователя из подходящих кандидатов"""
+
+    @abstractmethod
+    def choose(self, user_id: int, candidates: List[Experiment]) -> Experiment:
+        raise NotImplementedError
+
+    def seed(self, sessions: Dict[str, int]):
+        """Начальные счетчики сессий по экспериментам (используются не всеми стратегиями)"""
+
+
+class RandomAllocator(SessionAllocator):
+    """Случайный эксперимент"""
+
+    def choose(self, user_id: int, candidates: List[Experiment]) -> Experiment:
+        return random.choice(candidates)
+
+
+class RoundRobinAllocator(SessionAllocator):
+    """Эксперименты по очереди"""
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, user_id: int, candidates: List[Experiment]) -> Experiment:
+        return candidates[next(self._counter) % len(candidates)]
+
+
+class LeastServedAllocator(SessionAllocator):
+    """Эксперимент с наименьшим числом сессий: голоса распределяются по экспериментам поровну"""
+
+    def __init__(self):
+        self._sessions: Dict[str, int] = {}
+
+    def seed(self, sessions: Dict[str, int]):
+        self._sessions.update(sessions)
+
+    def choose(self, user_id: int, candidates: List[Experiment]) -> Experiment:
+        least = min(self._sessions.get(e.id, 0) for e in candidates)
+        experiment = random.choice([e for e in candidates if self._sessions.get(e.id, 0) == least])
+        self._sessions[experiment.id] = least + 1
+        return experiment
+
+
+class StickyAllocator(SessionAllocator):
+    """Пользователь всегда попадает в один и тот же эксперимент, пока в нем есть новые варианты
+
+    Используется rendezvous-хэширование: добавление или удаление эксперимента меняет
+    назначение только у пользователей этого эксперимента.
+    """
+
+    def choose(self, user_id: int, candidates: List[Experiment]) -> Experiment:
+        return max(candidates, key=lambda e: hashlib.blake2b(f"{user_id}:{e.id}".encode(), digest_size=8).digest())
+
+
+ALLOCATORS = {
+    'random': RandomAllocator,
+    'round_robin': RoundRobinAllocator,
+    'least_served': LeastServedAllocator,
+    'sticky': StickyAllocator,
+}
+
+
+def create_allocator(name: str) -> SessionAllocator:
+    """Создает стратегию распределения сессий по имени из config.SESSION_ALLOCATOR"""
+    if name not in ALLOCATORS:
+        logging.error(f"Unknown session allocator: {name}, using least_served")
+        name = 'least_served'
+    return ALLOCATORS[name]()
+
+
+# Обработчик изменений эксперимента: (эксперимент, добавленные или измененные имена, удаленные имена)
+ExperimentChangeHandler = Callable[[Experiment, List[str], List[str]], Awaitable[None]]
+
+
+class ExperimentRegistry:
+    """Набор экспериментов и их индексы каталогов
+
+    В режиме папки экспериментов каждая подпапка root с оригиналом - отдельный эксперимент
+    со своим манифестом. При запуске загружаются только манифесты; папки без манифеста
+    сканируются в фоне и становятся доступны по мере готовности. Одна фоновая задача
+    сверяет все папки и находит новые эксперименты.
+    """
+
+    def __init__(self, root: Optional[str], manifest_dir: str, poll_interval: float = 10.0,
+                 allocator: Optional[SessionAllocator] = None,
+                 fixed_images: Optional[Dict[str, str]] = None, default_fixed_name: str = "afro.jpg"):
+        self.root = os.path.abspath(root) if root else None
+        self.manifest_dir = manifest_dir
+        self.poll_interval = poll_interval
+        self.allocator = allocator or LeastServedAllocator()
+        self.fixed_images = fixed_images or {}
+        self.default_fixed_name = default_fixed_name
+        self._experiments: Dict[str, Experiment] = {}
+        self._by_folder: Dict[str, Experiment] = {}
+        self._loaded: Set[str] = set()
+        self._handlers: List[ExperimentChangeHandler] = []
+        self._poll_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def single(cls, folder: str, fixed_name: str, manifest_path: str, poll_interval: float = 10.0) -> 'ExperimentRegistry':
+        """Один эксперимент из папки folder, ключи изображений - имена файлов"""
+        registry = cls(None, os.path.dirname(manifest_path), poll_interval)
+        registry._add(SINGLE_EXPERIMENT_ID, folder, fixed_name, manifest_path)
+        return registry
+
+    @classmethod
+    def from_config(cls) -> 'ExperimentRegistry':
+        """Эксперименты из config.EXPERIMENTS_FOLDER или одна папка config.IMAGES_FOLDER"""
+        if not config.EXPERIMENTS_FOLDER:
+            return cls.single(config.IMAGES_FOLDER, os.path.basename(config.FIXED_IMAGE_PATH),
+                              config.CATALOG_MANIFEST_PATH, config.CATALOG_POLL_INTERVAL)
+        return cls(
+            config.EXPERIMENTS_FOLDER,
+            config.CATALOG_MANIFEST_DIR,
+            poll_interval=config.CATALOG_POLL_INTERVAL,
+            allocator=create_allocator(config.SESSION_ALLOCATOR),
+            fixed_images=config.EXPERIMENT_FIXED_IMAGES,
+            default_fixed_name=os.path.basename(config.FIXED_IMAGE_PATH)
+        )
+
+    def _add(self, experiment_id: str, folder: str, fixed_name: str, manifest_path: str) -> Experiment:
+        catalog = ImageCatalog(folder, manifest_path, self.poll_interval)
+        experiment = Experiment(experiment_id, folder, fixed_name, catalog)
+
+        async def forward(changed: List[str], removed: List[str]):
+            await self._notify(experiment, changed, removed)
+
+        catalog.on_change(forward)
+        self._experiments[experiment_id] = experiment
+        self._by_folder[experiment.folder] = experiment
+        return experiment
+
+    def _discover(self) -> List[Tuple[str, str]]:
+        """Находит подпапки root, которые еще не зарегистрированы как эксперименты"""
+        if self.root is None:
+            return []
+        try:
+            with os.scandir(self.root) as it:
+                return sorted((entry.name, entry.path) for entry in it
+                              if entry.is_dir() and not entry.name.startswith('.') and entry.name not in self._experiments)
+        except FileNotFoundError:
+            logging.error(f"Experiments folder does not exist: {self.root}")
+            return []
+
+    def _register(self, found: List[Tuple[str, str]]) -> List[Experiment]:
+        return [
+            self._add(experiment_id, folder, self.fixed_images.get(experiment_id, self.default_fixed_name),
+                      os.path.join(self.manifest_dir, f"{experiment_id}.json"))
+            for experiment_id, folder in found
+        ]
+
+    # Чтение
+
+    def __len__(self) -> int:
+        return len(self._experiments)
+
+    def get(self, experiment_id: Optional[str]) -> Optional[Experiment]:
+        return self._experiments.get(experiment_id) if experiment_id is not None else None
+
+    def experiments(self) -> List[Experiment]:
+        """Эксперименты, готовые к показу"""
+        return [e for e in self._experiments.values() if e.id in self._loaded and e.ready]
+
+    def experiment_for_key(self, image_key: str) -> Optional[Experiment]:
+        return self._experiments.get(split_key(image_key)[0])
+
+    def path_for_key(self, image_key: str) -> Optional[str]:
+        experiment_id, name = split_key(image_key)
+        experiment = self._experiments.get(experiment_id)
+        return experiment.path(name) if experiment else None
+
+    def key_for_path(self, path: str) -> Optional[str]:
+        experiment = self._by_folder.get(os.path.dirname(os.path.abspath(path)))
+        return experiment.key(os.path.basename(path)) if experiment else None
+
+    def entry_for_path(self, path: str) -> Optional[ImageEntry]:
+        """Запись индекса для полного пути (размер, mtime, хэш) без обращения к диску"""
+        experiment = self._by_folder.get(os.path.dirname(os.path.abspath(path)))
+        return experiment.catalog.get(os.path.basename(path)) if experiment else None
+
+    def exists(self, path: str) -> bool:
+        return self.entry_for_path(path) is not None
+
+    def allocate(self, user_id: int, excluded: Set[str]) -> Optional[Experiment]:
+        """Выбирает эксперимент для сессии среди тех, где у пользователя остались новые варианты
+
+        excluded - ключи уже показанных пользователю вариантов. Они разбиваются по
+        экспериментам за O(len(excluded)), без перебора всех каталогов.
+        """
+        excluded_per_experiment: Dict[str, int] = {}
+        for image_key in excluded:
+            experiment_id = split_key(image_key)[0]
+            excluded_per_experiment[experiment_id] = excluded_per_experiment.get(experiment_id, 0) + 1
+        candidates = [e for e in self.experiments() if len(e.variant_keys()) > excluded_per_experiment.get(e.id, 0)]
+        if not candidates:
+            return None
+        return self.allocator.choose(user_id, candidates)
+
+    # Загрузка и обновление
+
+    def on_change(self, handler: ExperimentChangeHandler):
+        """Регистрирует обработчик изменений каталогов (в том числе появления новых экспериментов)"""
+        self._handlers.append(handler)
+
+    async def _notify(self, experiment: Experiment, changed: List[str], removed: List[str]):
+        for handler in self._handlers:
+            try:
+                await handler(experiment, changed, removed)
+            except Exception as e:
+                logging.error(f"Error in experiment change handler: {e}")
+
+    async def _load(self, experiment: Experiment, notify: bool):
+        await experiment.catalog.load()
+        self._loaded.add(experiment.id)
+        if not experiment.ready:
+            logging.warning(f"Experiment {experiment.id or config.IMAGES_FOLDER}: fixed image {experiment.fixed_name} not found, skipping")
+        if notify:
+            await self._notify(experiment, experiment.catalog.names(), [])
+
+    async def ensure_loaded(self):
+        """Загружает индексы всех экспериментов (для скриптов и тестов без фоновой задачи)"""
+        self._register(await asyncio.to_thread(self._discover))
+        await asyncio.gather(*(self._load(e, notify=False) for e in self._experiments.values() if e.id not in self._loaded))
+
+    async def start(self):
+        """Загружает манифесты и запускает фоновую сверку папок
+
+        Эксперименты без манифеста (первый запуск, новая папка) сканируются фоновой
+        задачей, поэтому запуск бота не ждет хэширования файлов.
+        """
+        self._register(await asyncio.to_thread(self._discover))
+        with_manifest = [e for e in self._experiments.values()
+                         if e.id not in self._loaded and os.path.exists(e.catalog.manifest_path)]
+        await asyncio.gather(*(self._load(e, notify=False) for e in with_manifest))
+        logging.info(f"Loaded {len(with_manifest)} of {len(self._experiments)} experiment catalogs from manifests")
+        self._poll_task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+    async def refresh(self):
+        """Одна сверка: новые папки, незагруженные и изменившиеся каталоги"""
+        new_experiments = self._register(await asyncio.to_thread(self._discover))
+        if new_experiments:
+            logging.info(f"Found {len(new_experiments)} new experiments")
+        for experiment in list(self._experiments.values()):
+            try:
+                if experiment.id in self._loaded:
+                    await experiment.catalog.refresh()
+                else:
+                    await self._load(experiment, notify=True)
+            except Exception as e:
+                logging.error(f"Error refreshing experiment {experiment.id}: {e}")
+
+    async def _poll(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.poll_interval)
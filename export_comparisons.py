@@ -0,0 +1,203 @@
+# export_comparisons.py
+# Script to stream the comparisons collection into CSV or Parquet files
+#
+# Full export:         python export_comparisons.py comparisons.csv
+# Parquet:             python export_comparisons.py comparisons.parquet --format parquet
+# Nightly incremental: python export_comparisons.py exports/comparisons_$(date +%F).parquet --incremental
+
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import config
+from database import BaseDatabase, create_database
+from experiments import split_key
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+FIELDS = ['id', 'experiment', 'user_id', 'fixed_image', 'variable_image', 'selected_original', 'created_at']
+
+
+class CsvChunkWriter:
+    """Appends chunks of rows to a CSV file"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=FIELDS)
+        self._writer.writeheader()
+
+    def write(self, rows: List[Dict]):
+        for row in rows:
+            created_at = row['created_at']
+            self._writer.writerow({**row, 'created_at': created_at.isoformat() if created_at else ''})
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetChunkWriter:
+    """Writes every chunk of rows as one Parquet row group"""
+
+    def __init__(self, path: str):
+        # Optional dependency: needs the pyarrow package
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ('id', pa.string()),
+            ('experiment', pa.string()),
+            ('user_id', pa.int64()),
+            ('fixed_image', pa.string()),
+            ('variable_image', pa.string()),
+            ('selected_original', pa.bool_()),
+            ('created_at', pa.timestamp('us', tz='UTC')),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, rows: List[Dict]):
+        columns = {field: [row[field] for row in rows] for field in FIELDS}
+        self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {
+    'csv': CsvChunkWriter,
+    'parquet': ParquetChunkWriter,
+}
+
+
+def load_watermark(path: str) -> Tuple[Optional[datetime.datetime], str]:
+    """Time up to which comparisons were already exported, and the field it applies to
+
+    Watermarks saved before comparisons had written_at apply to created_at. Without a watermark
+    the first export goes by created_at as well: comparisons stored before written_at was
+    introduced don't have it and would never be exported by written_at.
+    """
+    if not os.path.exists(path):
+        return None, 'created_at'
+    with open(path, encoding='utf-8') as f:
+        watermark = json.load(f)
+    return datetime.datetime.fromisoformat(watermark['until']), watermark.get('field', 'created_at')
+
+
+def save_watermark(path: str, until: datetime.datetime, output_path: str, exported: int):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'until': until.isoformat(), 'field': 'written_at', 'file': output_path, 'exported': exported}, f)
+    os.replace(tmp_path, path)
+
+
+async def export_comparisons(output_path: str, file_format: str, since: Optional[datetime.datetime],
+                             until: Optional[datetime.datetime], page_size: int, chunk_rows: int,
+                             db: Optional[BaseDatabase] = None, time_field: str = 'created_at',
+                             written_before: Optional[datetime.datetime] = None) -> int:
+    """Stream comparisons with time_field in [since, until) into output_path
+
+    time_field is created_at (when the vote was cast) or written_at (when the database stored it).
+    With written_before, comparisons written at or after it are left out (comparisons without
+    written_at are kept): the next export by written_at picks them up.
+    At most page_size documents and chunk_rows rows are held in memory. The file is written
+    under a temporary name and renamed when complete, so a failed run leaves no partial export.
+    """
+    own_db = db is None
+    if own_db:
+        db = create_database()
+        await db.connect()
+    tmp_path = f"{output_path}.tmp"
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    writer = WRITERS[file_format](tmp_path)
+    exported = 0
+    chunk: List[Dict] = []
+    try:
+        async for page in db.iter_comparison_pages(page_size=page_size, since=since, until=until, time_field=time_field):
+            for record in page:
+                written_at = record.pop('written_at', None)
+                if written_before is not None and written_at is not None and written_at >= written_before:
+                    continue
+                chunk.append({**record, 'experiment': split_key(record['fixed_image'])[0]})
+            if len(chunk) >= chunk_rows:
+                writer.write(chunk)
+                exported += len(chunk)
+                chunk = []
+                logging.info(f"Exported {exported} comparisons")
+        if chunk:
+            writer.write(chunk)
+            exported += len(chunk)
+        writer.close()
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if own_db:
+            await db.close()
+    return exported
+
+
+async def export_incremental(output_path: str, file_format: str, watermark_path: str, settle: float,
+                             page_size: int, chunk_rows: int, db: Optional[BaseDatabase] = None) -> int:
+    """Export comparisons stored since the previous incremental export and move the watermark
+
+    Incremental exports go by the server-side write time: votes replayed from the journal or
+    flushed after an outage are stored long after they were cast, behind a created_at watermark.
+    The first export (no watermark yet) takes everything cast before now by created_at, without
+    comparisons already written after that moment, and the following ones continue by written_at.
+    """
+    since, time_field = load_watermark(watermark_path)
+    # Writes still in flight can commit with a slightly earlier server time, so the newest ones are left for the next run
+    until = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=settle)
+    print(f"Incremental export by {time_field} from {since.isoformat() if since else 'the beginning'} "
+          f"to {until.isoformat()}")
+    count = await export_comparisons(output_path, file_format, since, until, page_size, chunk_rows, db=db,
+                                     time_field=time_field, written_before=until if since is None else None)
+    save_watermark(watermark_path, until, output_path, count)
+    return count
+
+
+def parse_time(value: str) -> datetime.datetime:
+    moment = datetime.datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export comparisons to CSV or Parquet")
+    parser.add_argument('output')
+    parser.add_argument('--format', choices=sorted(WRITERS), help="defaults to the output file extension")
+    parser.add_argument('--since', type=parse_time, help="export comparisons created at or after this ISO time")
+    parser.add_argument('--until', type=parse_time, help="export comparisons created before this ISO time")
+    parser.add_argument('--incremental', action='store_true',
+                        help="continue from the watermark of the previous incremental export")
+    parser.add_argument('--watermark', default=config.EXPORT_WATERMARK_PATH, help="watermark file for --incremental")
+    parser.add_argument('--settle', type=float, default=config.EXPORT_SETTLE_SECONDS,
+                        help="with --incremental, leave out comparisons newer than this many seconds")
+    parser.add_argument('--page-size', type=int, default=1000, help="documents per Firestore query")
+    parser.add_argument('--chunk-rows', type=int, default=50000, help="rows per CSV write / Parquet row group")
+    args = parser.parse_args()
+
+    file_format = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    try:
+        if args.incremental:
+            count = asyncio.run(export_incremental(args.output, file_format, args.watermark, args.settle,
+                                                   args.page_size, args.chunk_rows))
+        else:
+            count = asyncio.run(export_comparisons(args.output, file_format, args.since, args.until,
+                                                   args.page_size, args.chunk_rows))
+        print(f"\n✅ Exported {count} comparisons to {args.output}\n")
+    except Exception as e:
+        logging.error(f"Error exporting comparisons: {e}")
+        print(f"\n❌ Failed to export comparisons: {e}\n")
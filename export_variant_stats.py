@@ -0,0 +1,40 @@
+# export_variant_stats.py
+# Script to export per-variant win/loss counters to CSV
+
+import asyncio
+import csv
+import logging
+import sys
+
+from database import create_database
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+FIELDS = ['experiment', 'fixed_image', 'variable_image', 'wins', 'losses', 'total', 'win_rate', 'score']
+
+
+async def export_variant_stats(output_path: str) -> int:
+    """Write aggregated variant counters (never raw comparisons) to a CSV file"""
+    db = create_database()
+    await db.connect()
+    stats = await db.get_variant_stats()
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(stats)
+    await db.close()
+    return len(stats)
+
+
+if __name__ == "__main__":
+    output_path = sys.argv[1] if len(sys.argv) > 1 else "variant_stats.csv"
+    try:
+        count = asyncio.run(export_variant_stats(output_path))
+        print(f"\n✅ Exported {count} variants to {output_path}\n")
+    except Exception as e:
+        logging.error(f"Error exporting variant stats: {e}")
+        print(f"\n❌ Failed to export variant stats: {e}\n")
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from catalog import file_digest
+
+# Фрагменты текста ошибок Bot API о недействительном file_id ("wrong file identifier/HTTP URL
+# specified", "wrong remote file identifier specified", "FILE_REFERENCE_EXPIRED")
+STALE_FILE_ID_ERRORS = ('file identifier', 'file_reference', 'file reference')
+
+
+def is_stale_file_id_error(message: str) -> bool:
+    """Отклонен ли запрос из-за file_id; другие ошибки (сообщение не найдено,
+    не изменено, чат не найден) повторная загрузка файла не исправит
+    """
+    message = message.lower()
+    return any(fragment in message for fragment in STALE_FILE_ID_ERRORS)
+
+
+class FileIdCache:
+    """Постоянный кэш Telegram file_id для локальных изображений
+
+    Ключ записи - хэш содержимого файла, поэтому после замены файла на диске старый
+    file_id больше не используется, а одинаковые имена файлов в разных экспериментах
+    не мешают друг другу. file_id привязаны к боту, поэтому кэш другого бота (при смене
+    токена) отбрасывается при загрузке. Изменения сохраняются на диск не чаще раза
+    в save_interval секунд и при flush().
+    """
+
+    def __init__(self, path: str, bot_id: Optional[int] = None, catalog=None, save_interval: float = 5.0):
+        self.path = path
+        self.bot_id = bot_id
+        # Индекс каталогов (ExperimentRegistry или ImageCatalog): хэши изображений берутся
+        # из него без обращения к диску
+        self.catalog = catalog
+        self.save_interval = save_interval
+        # sha256 -> file_id
+        self._file_ids: Dict[str, str] = {}
+        # путь -> ключ последней версии, чтобы удалять записи замененных файлов
+        self._path_keys: Dict[str, str] = {}
+        # путь -> (размер, mtime, sha256), чтобы не перечитывать неизменившиеся файлы
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._dirty = False
+        self._saved_at = 0.0
+        self._load()
+
+    def _load(self):
+        """Загружает кэш с диска"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('bot_id') != self.bot_id:
+                logging.info("File id cache belongs to another bot, starting empty")
+                return
+            # Старый формат ключа - "<имя файла>:<sha256>"
+            self._file_ids = {key.rsplit(':', 1)[-1]: file_id for key, file_id in data.get('file_ids', {}).items()}
+            logging.info(f"Loaded {len(self._file_ids)} cached file ids")
+        except Exception as e:
+            logging.error(f"Error loading file id cache: {e}")
+
+    def _save(self):
+        """Атомарно сохраняет кэш на диск"""
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'bot_id': self.bot_id, 'file_ids': self._file_ids}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        except Exception as e:
+            logging.error(f"Error saving file id cache: {e}")
+
+    def _changed(self):
+        """Отмечает изменение и сохраняет кэш, если с прошлого сохранения прошло save_interval"""
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self._save()
+
+    def flush(self):
+        """Сохраняет несохраненные изменения (при остановке бота)"""
+        if self._dirty:
+            self._save()
+
+    def _key(self, image_path: str) -> Optional[str]:
+        """Возвращает ключ кэша для файла или None, если файл недоступен"""
+        entry = self.catalog.entry_for_path(image_path) if self.catalog is not None else None
+        if entry is not None:
+            return entry.sha256
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        cached = self._hashes.get(image_path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = file_digest(image_path)
+        self._hashes[image_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def get(self, image_path: str) -> Optional[str]:
+        """Возвращает file_id для текущего содержимого файла, если он уже загружался"""
+        key = self._key(image_path)
+        return self._file_ids.get(key) if key else None
+
+    def put(self, image_path: str, file_id: str):
+        """Запоминает file_id, полученный после загрузки файла"""
+        key = self._key(image_path)
+        if key and self._file_ids.get(key) != file_id:
+            # Запись для прежней версии этого файла больше не понадобится
+            stale_key = self._path_keys.get(image_path)
+            if stale_key and stale_key != key:
+                self._file_ids.pop(stale_key, None)
+            self._path_keys[image_path] = key
+            self._file_ids[key] = file_id
+            self._changed()
+
+    def invalidate(self, image_path: str):
+        """Удаляет file_id файла (например, если Telegram его отклонил)"""
+        key = self._key(image_path)
+        if key and self._file_ids.pop(key, None) is not None:
+            self._changed()
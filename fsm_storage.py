@@ -0,0 +1,237 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+import config
+
+# Данные сессии больше этого размера (в байтах) сжимаются
+COMPRESS_THRESHOLD = 512
+
+
+def encode_data(data: Mapping[str, Any]) -> bytes:
+    """Компактно сериализует данные сессии: JSON без пробелов, крупные данные сжимаются zlib"""
+    raw = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(raw) > COMPRESS_THRESHOLD:
+        return zlib.compress(raw)
+    return raw
+
+
+def decode_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    """Восстанавливает данные сессии (JSON начинается с '{', поток zlib - с 0x78)"""
+    if not blob:
+        return {}
+    if blob[:1] != b'{':
+        blob = zlib.decompress(blob)
+    return json.loads(blob)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище во встроенной базе SQLite в режиме WAL
+
+    Состояние переживает перезапуск бота, а несколько процессов на одной машине могут
+    работать с одним файлом базы. Сессии, не обновлявшиеся дольше ttl секунд, считаются
+    истекшими и периодически удаляются. Запросы выполняются в отдельном потоке соединения,
+    по одному в порядке вызова, поэтому ожидание блокировки файла не останавливает event loop.
+    """
+
+    def __init__(self, path: str, ttl: Optional[int] = None, eviction_interval: int = 60, key_builder: Optional[KeyBuilder] = None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._last_eviction = 0.0
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm_sessions ("
+            "key TEXT PRIMARY KEY, state TEXT, data BLOB, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS fsm_sessions_updated_at ON fsm_sessions (updated_at)")
+        # Единственный поток соединения: обращения к нему не перемежаются
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-fsm')
+
+    async def _call(self, func: Callable, *args):
+        """Выполняет func(*args) в потоке соединения"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _expired_before(self) -> float:
+        return time.time() - self.ttl if self.ttl else 0.0
+
+    def _maybe_evict(self, now: float):
+        """Удаляет истекшие сессии не чаще раза в eviction_interval секунд"""
+        if self.ttl and now - self._last_eviction >= self.eviction_interval:
+            self._last_eviction = now
+            self._evict_expired()
+
+    def _evict_expired(self) -> int:
+        if not self.ttl:
+            return 0
+        cursor = self._conn.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (self._expired_before(),))
+        if cursor.rowcount:
+            logging.info(f"Evicted {cursor.rowcount} idle FSM sessions")
+        return cursor.rowcount
+
+    async def evict_expired(self) -> int:
+        """Удаляет сессии, не обновлявшиеся дольше ttl; возвращает их число"""
+        return await self._call(self._evict_expired)
+
+    def _row(self, key: str):
+        return self._conn.execute(
+            "SELECT state, data FROM fsm_sessions WHERE key = ? AND updated_at >= ?",
+            (key, self._expired_before())
+        ).fetchone()
+
+    def _set_state(self, key: str, value: Optional[str]):
+        now = time.time()
+        # Данные истекшей, но еще не удаленной сессии не переносятся в новую
+        self._conn.execute(
+            "INSERT INTO fsm_sessions (key, state, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at, "
+            "data = CASE WHEN fsm_sessions.updated_at < ? THEN NULL ELSE fsm_sessions.data END",
+            (key, value, now, self._expired_before())
+        )
+        self._maybe_evict(now)
+
+    def _set_data(self, key: str, blob: Optional[bytes]):
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO fsm_sessions (key, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at, "
+            "state = CASE WHEN fsm_sessions.updated_at < ? THEN NULL ELSE fsm_sessions.state END",
+            (key, blob, now, self._expired_before())
+        )
+        self._maybe_evict(now)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._call(self._set_state, self.key_builder.build(key), value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._call(self._row, self.key_builder.build(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._call(self._set_data, self.key_builder.build(key), encode_data(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._call(self._row, self.key_builder.build(key))
+        return decode_data(row[1]) if row else {}
+
+    def _update_data(self, key: str, data: Mapping[str, Any]) -> Dict[str, Any]:
+        row = self._row(key)
+        current = decode_data(row[1]) if row else {}
+        current.update(data)
+        self._set_data(key, encode_data(current) if current else None)
+        return current
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        """Чтение и запись данных за одно обращение к потоку соединения"""
+        return (await self._call(self._update_data, self.key_builder.build(key), data)).copy()
+
+    async def close(self) -> None:
+        await self._call(self._conn.close)
+        self._executor.shutdown()
+
+
+class TTLMemoryStorage(BaseStorage):
+    """FSM-хранилище в памяти процесса с вытеснением неактивных сессий
+
+    В отличие от MemoryStorage, данные сессии хранятся сериализованными (encode_data), а
+    сессии, не обновлявшиеся дольше ttl секунд, удаляются, поэтому память не растет с
+    числом всех пользователей, когда-либо начинавших сессию. Сессии упорядочены по времени
+    обновления, и вытеснение просматривает только истекшие.
+    """
+
+    def __init__(self, ttl: Optional[int] = None, eviction_interval: int = 60, key_builder: Optional[KeyBuilder] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.clock = clock
+        self._last_eviction = clock()
+        # ключ -> (состояние, данные, время обновления); порядок - от давно обновленных к недавним
+        self._sessions: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _maybe_evict(self, now: float):
+        """Удаляет истекшие сессии не чаще раза в eviction_interval секунд"""
+        if self.ttl and now - self._last_eviction >= self.eviction_interval:
+            self._last_eviction = now
+            self.evict_expired()
+
+    def evict_expired(self) -> int:
+        """Удаляет сессии, не обновлявшиеся дольше ttl; возвращает их число"""
+        if not self.ttl:
+            return 0
+        expired_before = self.clock() - self.ttl
+        evicted = 0
+        while self._sessions:
+            key, (_, _, updated_at) = next(iter(self._sessions.items()))
+            if updated_at >= expired_before:
+                break
+            del self._sessions[key]
+            evicted += 1
+        if evicted:
+            logging.info(f"Evicted {evicted} idle FSM sessions")
+        return evicted
+
+    def _session(self, key: StorageKey):
+        session = self._sessions.get(self.key_builder.build(key))
+        if session is None or (self.ttl and session[2] < self.clock() - self.ttl):
+            return None
+        return session
+
+    def _store(self, key: StorageKey, state: Optional[str], blob: Optional[bytes]):
+        now = self.clock()
+        storage_key = self.key_builder.build(key)
+        self._sessions.pop(storage_key, None)
+        if state is not None or blob is not None:
+            self._sessions[storage_key] = (state, blob, now)
+        self._maybe_evict(now)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        session = self._session(key)
+        value = state.state if isinstance(state, State) else state
+        self._store(key, value, session[1] if session else None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        session = self._session(key)
+        return session[0] if session else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        session = self._session(key)
+        self._store(key, session[0] if session else None, encode_data(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        session = self._session(key)
+        return decode_data(session[1]) if session else {}
+
+    async def close(self) -> None:
+        self._sessions.clear()
+
+
+def create_storage() -> BaseStorage:
+    """Создает FSM-хранилище, выбранное в config.FSM_STORAGE"""
+    if config.FSM_STORAGE == 'sqlite':
+        logging.info(f"Using SQLite FSM storage: {config.FSM_SQLITE_PATH}")
+        return SQLiteStorage(config.FSM_SQLITE_PATH, ttl=config.FSM_SESSION_TTL)
+    if config.FSM_STORAGE == 'redis':
+        # Необязательная зависимость: нужен пакет redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        logging.info(f"Using Redis FSM storage: {config.REDIS_URL}")
+        return RedisStorage.from_url(config.REDIS_URL, state_ttl=config.FSM_SESSION_TTL, data_ttl=config.FSM_SESSION_TTL)
+    logging.info("Using in-memory FSM storage")
+    return TTLMemoryStorage(ttl=config.FSM_SESSION_TTL)
@@ -0,0 +1,101 @@
+import asyncio
+import collections
+import logging
+import os
+from typing import Iterable, Optional, Tuple
+
+from aiogram.types import BufferedInputFile
+
+from metrics import image_cache_lookups
+
+
+class ImageBytesCache:
+    """LRU-кэш содержимого изображений в памяти для загрузки без повторного чтения с диска
+
+    Нужен, когда file_id еще нет (новые варианты, новый токен бота): вместо FSInputFile,
+    который читает файл при каждой отправке, загружается BufferedInputFile из кэша.
+    Запись проверяется по размеру и mtime файла (для изображений каталогов - по индексу,
+    без обращения к диску), поэтому после замены файла кэш перечитывает его. Суммарный
+    объем ограничен max_bytes; файлы больше max_file_bytes не кэшируются.
+    """
+
+    def __init__(self, max_bytes: int, max_file_bytes: Optional[int] = None, catalog=None):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes or max_bytes, max_bytes)
+        # Индекс каталогов (ExperimentRegistry или ImageCatalog): размер и mtime изображений
+        self.catalog = catalog
+        # путь -> (размер, mtime, содержимое); порядок - от давно использованных к недавним
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _version(self, path: str) -> Tuple[int, int]:
+        """Размер и mtime файла: из индекса каталога или os.stat"""
+        entry = self.catalog.entry_for_path(path) if self.catalog is not None else None
+        if entry is not None:
+            return entry.size, entry.mtime_ns
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _get(self, path: str, version: Tuple[int, int]) -> Optional[bytes]:
+        cached = self._entries.get(path)
+        if cached is None or cached[:2] != version:
+            return None
+        self._entries.move_to_end(path)
+        return cached[2]
+
+    def _put(self, path: str, version: Tuple[int, int], data: bytes):
+        self._discard(path)
+        if len(data) > self.max_file_bytes:
+            return
+        self._entries[path] = (version[0], version[1], data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _discard(self, path: str):
+        cached = self._entries.pop(path, None)
+        if cached is not None:
+            self.size -= len(cached[2])
+
+    async def read(self, path: str) -> bytes:
+        """Содержимое файла из кэша; при промахе файл читается в отдельном потоке"""
+        version = self._version(path)
+        data = self._get(path, version)
+        if data is not None:
+            self.hits += 1
+            image_cache_lookups.labels('hit').inc()
+            return data
+        self.misses += 1
+        image_cache_lookups.labels('miss').inc()
+        data = await asyncio.to_thread(_read_file, path)
+        self._put(path, version, data)
+        return data
+
+    async def input_file(self, path: str) -> BufferedInputFile:
+        """Файл для загрузки в Telegram (вместо FSInputFile)"""
+        return BufferedInputFile(await self.read(path), filename=os.path.basename(path))
+
+    async def warm(self, paths: Iterable[str]) -> int:
+        """Загружает файлы в кэш заранее, не считая попаданий и промахов; возвращает число файлов в кэше"""
+        loaded = 0
+        for path in paths:
+            try:
+                version = self._version(path)
+                if self._get(path, version) is None:
+                    self._put(path, version, await asyncio.to_thread(_read_file, path))
+                if path in self._entries:
+                    loaded += 1
+            except OSError as e:
+                logging.warning(f"Failed to warm image cache with {path}: {e}")
+        return loaded
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,365 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiohttp import web
+
+# Границы корзин гистограмм задержек (в секундах), как у клиентов Prometheus
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    """Метрика с метками: значения хранятся по кортежу значений меток"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str):
+        """Дочерняя метрика для значений меток (создается при первом обращении)"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+                for values, child in self._children.items()]
+
+
+class Gauge(_Metric):
+    """Значение, которое считывается функцией в момент запроса /metrics"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def _new_child(self):
+        raise ValueError(f"{self.name} is read by a function and has no labels")
+
+    def _samples(self) -> List[str]:
+        try:
+            value = self.read()
+        except Exception as e:
+            logging.error(f"Failed to read gauge {self.name}: {e}")
+            return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, documentation, read))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+handler_latency = registry.histogram(
+    'bot_handler_duration_seconds', "Duration of aiogram handlers", ('handler',))
+handler_errors = registry.counter(
+    'bot_handler_errors_total', "Exceptions raised by aiogram handlers", ('handler',))
+database_latency = registry.histogram(
+    'bot_database_duration_seconds', "Duration of database methods", ('method',))
+database_errors = registry.counter(
+    'bot_database_errors_total', "Exceptions raised by database methods", ('method',))
+api_latency = registry.histogram(
+    'bot_api_request_duration_seconds', "Duration of Bot API requests", ('method',))
+api_calls = registry.counter(
+    'bot_api_requests_total', "Bot API requests sent", ('method',))
+api_errors = registry.counter(
+    'bot_api_errors_total', "Failed Bot API requests", ('method', 'error'))
+image_cache_lookups = registry.counter(
+    'bot_image_cache_lookups_total', "Image byte cache lookups by result (hit or miss)", ('result',))
+comparisons_dead_lettered = registry.counter(
+    'bot_comparisons_dead_lettered_total', "Votes moved to the dead-letter file after repeated write failures")
+loop_lag = registry.histogram(
+    'bot_event_loop_lag_seconds', "Event loop wake-up delay", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+
+class ActiveSessions:
+    """Чаты, от которых были обновления за последние window секунд"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._last_seen: Dict[int, float] = {}
+
+    def touch(self, chat_id: int):
+        # Повторная вставка переносит чат в конец: словарь упорядочен по времени активности
+        self._last_seen.pop(chat_id, None)
+        self._last_seen[chat_id] = time.monotonic()
+
+    def __len__(self) -> int:
+        threshold = time.monotonic() - self.window
+        while self._last_seen:
+            chat_id, seen = next(iter(self._last_seen.items()))
+            if seen >= threshold:
+                break
+            del self._last_seen[chat_id]
+        return len(self._last_seen)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Middleware обработчиков: гистограмма времени по имени обработчика, ошибки и активные чаты
+
+    Регистрируется как внутренний middleware (dp.message.middleware(...)), поэтому
+    вызывается только для обновлений, нашедших обработчик.
+    """
+
+    def __init__(self, sessions: Optional[ActiveSessions] = None):
+        self.sessions = sessions
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        name = data['handler'].callback.__name__
+        chat = data.get('event_chat')
+        if self.sessions is not None and chat is not None:
+            self.sessions.touch(chat.id)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.labels(name).inc()
+            raise
+        finally:
+            handler_latency.labels(name).observe(time.perf_counter() - started)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: число, время и ошибки запросов к Bot API по методам
+
+    Регистрируется после ограничителя скорости, чтобы считать каждую отправку, включая
+    повторы, и не учитывать ожидание в очереди.
+    """
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        name = method.__api_method__
+        api_calls.labels(name).inc()
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            api_latency.labels(name).observe(time.perf_counter() - started)
+
+
+class InstrumentedDatabase:
+    """Обертка базы данных: время и исключения каждого асинхронного метода
+
+    Остальные атрибуты передаются базе без изменений. Обертки методов создаются при первом
+    обращении и запоминаются в экземпляре, поэтому повторный вызов не проходит через __getattr__.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception:
+                database_errors.labels(name).inc()
+                raise
+            finally:
+                database_latency.labels(name).observe(time.perf_counter() - started)
+
+        self.__dict__[name] = timed
+        return timed
+
+
+class LoopLagMonitor:
+    """Измеряет задержку цикла событий: насколько позже срока просыпается sleep(interval)"""
+
+    def __init__(self, interval: float = 0.5, observe: Callable[[float], None] = loop_lag.observe):
+        self.interval = interval
+        self.observe = observe
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.observe(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class MetricsServer:
+    """HTTP-сервер с /metrics в текстовом формате Prometheus"""
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = registry):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            # Занятый порт не должен мешать работе бота
+            logging.error(f"Failed to start metrics server on {self.host}:{self.port}: {e}")
+            await self.stop()
+            return
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,181 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMediaGroup, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+# Приоритеты исходящих запросов: меньшее значение отправляется раньше
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Приоритет запросов текущей задачи (см. low_priority)
+outbound_priority: ContextVar[int] = ContextVar('outbound_priority', default=PRIORITY_NORMAL)
+
+
+@contextlib.contextmanager
+def low_priority():
+    """Помечает запросы внутри блока как второстепенные (например, подтверждения выбора)"""
+    token = outbound_priority.set(PRIORITY_LOW)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, cost: float = 1.0) -> float:
+        """Через сколько секунд будет доступно cost токенов"""
+        self._refill(time.monotonic())
+        return max(0.0, (cost - self._tokens) / self.rate)
+
+    def take(self, cost: float = 1.0):
+        self._refill(time.monotonic())
+        self._tokens -= cost
+
+    def reserve(self, cost: float = 1.0) -> float:
+        """Резервирует токены (баланс может уйти в минус) и возвращает задержку до их выдачи"""
+        self.take(cost)
+        return max(0.0, -self._tokens / self.rate)
+
+    @property
+    def idle(self) -> bool:
+        """Ведро полностью восполнено и его можно удалить"""
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Middleware сессии бота, ограничивающий скорость исходящих запросов к Bot API
+
+    Все запросы с chat_id проходят через ведро токенов чата и общее ведро бота.
+    Общие токены выдаются по приоритету: медиагруппы раньше обычных сообщений,
+    обычные - раньше второстепенных. Ответ 429 (retry_after) приостанавливает чат на
+    указанное время, после чего запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int = 3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._paused_until: Dict[int, float] = {}
+        self._waiters: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._pacer: Optional[asyncio.Task] = None
+        # Метрики
+        self.queue_depth = 0
+        self.sent = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Текущая длина очереди и статистика ожидания"""
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'retries': self.retries,
+            'wait_avg': self.wait_total / self.sent if self.sent else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        if isinstance(method, SendMediaGroup):
+            priority, cost = PRIORITY_HIGH, float(len(method.media))
+        else:
+            priority, cost = outbound_priority.get(), 1.0
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority, cost)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logging.warning(f"Flood control for chat {chat_id}: retry after {e.retry_after}s")
+                self._paused_until[chat_id] = time.monotonic() + e.retry_after
+
+    async def _acquire(self, chat_id, priority: int, cost: float):
+        """Ждет токены чата и общие токены"""
+        started = time.monotonic()
+        self.queue_depth += 1
+        try:
+            paused_until = self._paused_until.pop(chat_id, 0.0)
+            if paused_until > started:
+                await asyncio.sleep(paused_until - started)
+
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                self._evict_idle_chats()
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = bucket.reserve(cost)
+            if delay:
+                await asyncio.sleep(delay)
+
+            await self._acquire_global(priority, cost)
+        finally:
+            self.queue_depth -= 1
+        waited = time.monotonic() - started
+        self.sent += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    async def _acquire_global(self, priority: int, cost: float):
+        """Получает общие токены; при нехватке встает в очередь по приоритету"""
+        if not self._waiters and self._global.wait_time(cost) == 0:
+            self._global.take(cost)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), cost, future))
+        if self._pacer is None or self._pacer.done():
+            self._pacer = asyncio.create_task(self._pace())
+        await future
+
+    async def _pace(self):
+        """Выдает общие токены ожидающим запросам по мере их восполнения"""
+        while self._waiters:
+            _, _, cost, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._global.wait_time(cost)
+            if delay:
+                # Пока ждем, в очередь может встать запрос с более высоким приоритетом
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._waiters)
+            self._global.take(cost)
+            future.set_result(None)
+
+    def _evict_idle_chats(self, limit: int = 10000):
+        """Удаляет восполненные ведра неактивных чатов, чтобы словарь не рос бесконечно"""
+        if len(self._chats) >= limit:
+            for chat_id in [c for c, b in self._chats.items() if b.idle]:
+                del self._chats[chat_id]
@@ -0,0 +1,49 @@
+# rank_variants.py
+# Script to fit a Bradley-Terry model over all comparisons and export the variant ranking to CSV
+
+import argparse
+import asyncio
+import csv
+import logging
+
+from database import create_database
+from ranking import BradleyTerry, load_comparison_log
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+FIELDS = ['fixed_image', 'variable_image', 'score', 'stderr', 'win_probability', 'votes', 'variant_wins']
+
+
+async def rank_variants(output_path: str, user_bias: bool) -> int:
+    """Load comparisons into NumPy arrays, fit the model and write variants ranked by strength"""
+    db = create_database()
+    await db.connect()
+    log = await load_comparison_log(db)
+    await db.close()
+
+    model = BradleyTerry(log, user_bias=user_bias)
+    iterations = model.fit()
+    logging.info(f"Fitted Bradley-Terry model in {iterations} iterations")
+    ranking = model.ranking()
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(ranking)
+    return len(ranking)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rank variants with a Bradley-Terry model")
+    parser.add_argument('output', nargs='?', default="variant_ranking.csv")
+    parser.add_argument('--user-bias', action='store_true', help="fit per-user preference for the original")
+    args = parser.parse_args()
+    try:
+        count = asyncio.run(rank_variants(args.output, args.user_bias))
+        print(f"\n✅ Ranked {count} variants into {args.output}\n")
+    except Exception as e:
+        logging.error(f"Error ranking variants: {e}")
+        print(f"\n❌ Failed to rank variants: {e}\n")
@@ -0,0 +1,376 @@
+import logging
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class ItemIndex:
+    """Плотная нумерация ключей (изображений или пользователей) для массивов int32"""
+
+    def __init__(self):
+        self._ids: Dict[Hashable, int] = {}
+        self.keys: List[Hashable] = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def id(self, key: Hashable) -> int:
+        index = self._ids.get(key)
+        if index is None:
+            index = self._ids[key] = len(self.keys)
+            self.keys.append(key)
+        return index
+
+    def get(self, key: Hashable) -> Optional[int]:
+        return self._ids.get(key)
+
+    def ids(self, keys: Sequence[Hashable]) -> np.ndarray:
+        return np.fromiter((self.id(key) for key in keys), dtype=np.int32, count=len(keys))
+
+
+class ComparisonLog:
+    """Журнал сравнений в компактных массивах NumPy
+
+    Каждое сравнение - номер фиксированного изображения, номер варианта, номер пользователя
+    (int32) и выбран ли оригинал (bool): 13 байт на голос вместо словаря Python на документ.
+    Массивы растут удвоением, поэтому добавление новых голосов амортизированно O(1).
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.images = ItemIndex()
+        self.users = ItemIndex()
+        self.size = 0
+        self._fixed = np.empty(capacity, dtype=np.int32)
+        self._variable = np.empty(capacity, dtype=np.int32)
+        self._user = np.empty(capacity, dtype=np.int32)
+        self._selected_original = np.empty(capacity, dtype=bool)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def fixed(self) -> np.ndarray:
+        return self._fixed[:self.size]
+
+    @property
+    def variable(self) -> np.ndarray:
+        return self._variable[:self.size]
+
+    @property
+    def user(self) -> np.ndarray:
+        return self._user[:self.size]
+
+    @property
+    def selected_original(self) -> np.ndarray:
+        return self._selected_original[:self.size]
+
+    def _reserve(self, count: int):
+        capacity = len(self._fixed)
+        if self.size + count <= capacity:
+            return
+        while capacity < self.size + count:
+            capacity *= 2
+        for name in ('_fixed', '_variable', '_user', '_selected_original'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, fixed: np.ndarray, variable: np.ndarray, user: np.ndarray, selected_original: np.ndarray):
+        """Добавляет голоса, уже переведенные в номера изображений и пользователей"""
+        count = len(fixed)
+        self._reserve(count)
+        end = self.size + count
+        self._fixed[self.size:end] = fixed
+        self._variable[self.size:end] = variable
+        self._user[self.size:end] = user
+        self._selected_original[self.size:end] = selected_original
+        self.size = end
+
+    def add(self, fixed_images: Sequence[str], variable_images: Sequence[str], user_ids: Sequence[int],
+            selected_original: Sequence[bool]) -> Tuple[int, int]:
+        """Добавляет голоса по ключам изображений и ID пользователей; возвращает диапазон строк"""
+        start = self.size
+        self.append(self.images.ids(fixed_images), self.images.ids(variable_images), self.users.ids(user_ids),
+                    np.asarray(selected_original, dtype=bool))
+        return start, self.size
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30.0, 30.0)))
+
+
+class BradleyTerry:
+    """Модель Брэдли-Терри по журналу сравнений
+
+    P(выбран оригинал) = sigmoid(s[фиксированное] - s[вариант] + b[пользователь]), где s - сила
+    изображения, b - необязательная склонность пользователя выбирать оригинал (user_bias=True).
+    Параметры оцениваются максимумом правдоподобия с L2-регуляризацией (l2 для сил, bias_l2
+    для склонностей), которая делает оценки конечными у вариантов, ни разу не проигравших.
+
+    Без склонностей пользователей голоса агрегируются по парам изображений, и итерация стоит
+    O(число пар), а не O(число голосов). Метод Ньютона решает систему сопряженными градиентами
+    с диагональным предобусловливателем; градиент, диагональ гессиана и произведения гессиана
+    на вектор считаются через np.bincount по массивам пар. MM-алгоритм Хантера (method='mm')
+    доступен для модели без склонностей и сходится линейно.
+
+    update добавляет новые голоса и делает несколько итераций от текущих оценок, поэтому
+    пересчитывать рейтинг с нуля после каждого голоса не нужно.
+    """
+
+    def __init__(self, log: Optional[ComparisonLog] = None, user_bias: bool = False,
+                 l2: float = 0.01, bias_l2: float = 1.0):
+        self.log = log if log is not None else ComparisonLog()
+        self.user_bias = user_bias
+        self.l2 = l2
+        self.bias_l2 = bias_l2
+        self.scores = np.zeros(0)
+        self.bias = np.zeros(0)
+        # Агрегированные пары (для модели без склонностей): номер пары -> строка массивов
+        self._pair_rows: Dict[int, int] = {}
+        self._pair_a = np.zeros(0, dtype=np.int32)
+        self._pair_b = np.zeros(0, dtype=np.int32)
+        self._pair_n = np.zeros(0)
+        self._pair_y = np.zeros(0)
+        self._aggregated = 0
+        # Диагональ гессиана на последней итерации - для приближенных стандартных ошибок
+        self._diagonal = np.zeros(0)
+
+    # Данные
+
+    def _grow(self):
+        """Дополняет векторы параметров нулями для новых изображений и пользователей"""
+        if len(self.scores) < len(self.log.images):
+            self.scores = np.concatenate([self.scores, np.zeros(len(self.log.images) - len(self.scores))])
+        if self.user_bias and len(self.bias) < len(self.log.users):
+            self.bias = np.concatenate([self.bias, np.zeros(len(self.log.users) - len(self.bias))])
+
+    def _aggregate(self):
+        """Добавляет к счетчикам пар голоса, поступившие после прошлой агрегации"""
+        if self._aggregated == self.log.size:
+            return
+        fixed = self.log.fixed[self._aggregated:].astype(np.int64)
+        variable = self.log.variable[self._aggregated:].astype(np.int64)
+        selected = self.log.selected_original[self._aggregated:]
+        codes = (fixed << 32) | variable
+        unique, inverse = np.unique(codes, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(unique)).astype(float)
+        wins = np.bincount(inverse, weights=selected, minlength=len(unique))
+
+        rows = np.empty(len(unique), dtype=np.int64)
+        new_codes = []
+        for i, code in enumerate(unique.tolist()):
+            row = self._pair_rows.get(code)
+            if row is None:
+                row = self._pair_rows[code] = len(self._pair_rows)
+                new_codes.append(code)
+            rows[i] = row
+        if new_codes:
+            new_codes = np.array(new_codes, dtype=np.int64)
+            self._pair_a = np.concatenate([self._pair_a, (new_codes >> 32).astype(np.int32)])
+            self._pair_b = np.concatenate([self._pair_b, (new_codes & 0xFFFFFFFF).astype(np.int32)])
+            self._pair_n = np.concatenate([self._pair_n, np.zeros(len(new_codes))])
+            self._pair_y = np.concatenate([self._pair_y, np.zeros(len(new_codes))])
+        np.add.at(self._pair_n, rows, counts)
+        np.add.at(self._pair_y, rows, wins)
+        self._aggregated = self.log.size
+
+    def _rows(self) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray], np.ndarray, np.ndarray]:
+        """Строки задачи: (фиксированное, вариант, пользователь, число голосов, победы оригинала)"""
+        if self.user_bias:
+            n = np.ones(self.log.size)
+            return self.log.fixed, self.log.variable, self.log.user, n, self.log.selected_original.astype(float)
+        self._aggregate()
+        return self._pair_a, self._pair_b, None, self._pair_n, self._pair_y
+
+    # Обучение
+
+    def fit(self, method: str = 'newton', max_iter: int = 50, tol: float = 1e-6) -> int:
+        """Оценивает параметры по всему журналу от текущих значений; возвращает число итераций"""
+        self._grow()
+        if self.log.size == 0:
+            return 0
+        if method == 'mm':
+            if self.user_bias:
+                raise ValueError("MM fit does not support user bias terms")
+            return self._fit_mm(max_iter, tol)
+        if method != 'newton':
+            raise ValueError(f"Unknown fit method: {method}")
+        return self._fit_newton(max_iter, tol)
+
+    def update(self, fixed_images: Sequence[str], variable_images: Sequence[str], user_ids: Sequence[int],
+               selected_original: Sequence[bool], iterations: int = 3) -> int:
+        """Добавляет новые голоса и уточняет оценки несколькими итерациями Ньютона"""
+        self.log.add(fixed_images, variable_images, user_ids, selected_original)
+        return self.fit(max_iter=iterations)
+
+    def _objective(self, rows, scores: np.ndarray, bias: np.ndarray) -> float:
+        a, b, u, n, y = rows
+        z = scores[a] - scores[b]
+        if u is not None:
+            z = z + bias[u]
+        loss = float(np.dot(n, np.logaddexp(0.0, z)) - np.dot(y, z))
+        loss += 0.5 * self.l2 * float(np.dot(scores, scores))
+        if u is not None:
+            loss += 0.5 * self.bias_l2 * float(np.dot(bias, bias))
+        return loss
+
+    def _fit_newton(self, max_iter: int, tol: float) -> int:
+        rows = self._rows()
+        a, b, u, n, y = rows
+        n_images = len(self.scores)
+        n_users = len(self.bias) if u is not None else 0
+
+        def split(vector: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            return vector[:n_images], vector[n_images:]
+
+        def apply(v: np.ndarray, w: np.ndarray) -> np.ndarray:
+            """Произведение гессиана на вектор v при весах строк w"""
+            v_s, v_b = split(v)
+            t = v_s[a] - v_s[b]
+            if u is not None:
+                t = t + v_b[u]
+            t *= w
+            h_s = np.bincount(a, t, n_images) - np.bincount(b, t, n_images) + self.l2 * v_s
+            if u is None:
+                return h_s
+            return np.concatenate([h_s, np.bincount(u, t, n_users) + self.bias_l2 * v_b])
+
+        loss = self._objective(rows, self.scores, self.bias)
+        for iteration in range(1, max_iter + 1):
+            z = self.scores[a] - self.scores[b]
+            if u is not None:
+                z = z + self.bias[u]
+            p = _sigmoid(z)
+            residual = n * p - y
+            w = n * p * (1.0 - p)
+
+            gradient = np.bincount(a, residual, n_images) - np.bincount(b, residual, n_images) + self.l2 * self.scores
+            diagonal = np.bincount(a, w, n_images) + np.bincount(b, w, n_images) + self.l2
+            if u is not None:
+                gradient = np.concatenate([gradient, np.bincount(u, residual, n_users) + self.bias_l2 * self.bias])
+                diagonal = np.concatenate([diagonal, np.bincount(u, w, n_users) + self.bias_l2])
+            self._diagonal = diagonal[:n_images]
+            if np.max(np.abs(gradient)) < tol:
+                return iteration - 1
+
+            # Сопряженные градиенты для H d = -g с предобусловливателем diag(H)
+            step = np.zeros_like(gradient)
+            r = -gradient
+            s = r / diagonal
+            direction = s.copy()
+            rs = float(np.dot(r, s))
+            threshold = 1e-4 * rs
+            for _ in range(100):
+                h = apply(direction, w)
+                alpha = rs / float(np.dot(direction, h))
+                step += alpha * direction
+                r -= alpha * h
+                s = r / diagonal
+                rs_new = float(np.dot(r, s))
+                if rs_new < threshold:
+                    break
+                direction = s + (rs_new / rs) * direction
+                rs = rs_new
+
+            # Поиск с возвратом: шаг Ньютона далеко от оптимума может увеличить функцию потерь
+            step_s, step_b = split(step)
+            decrease = float(np.dot(gradient, step))
+            t = 1.0
+            while True:
+                scores = self.scores + t * step_s
+                bias = self.bias + t * step_b if u is not None else self.bias
+                new_loss = self._objective(rows, scores, bias)
+                if new_loss <= loss + 1e-4 * t * decrease or t < 1e-3:
+                    break
+                t *= 0.5
+            self.scores, self.bias = scores, bias
+            if loss - new_loss < tol * max(1.0, abs(loss)):
+                return iteration
+            loss = new_loss
+        return max_iter
+
+    def _fit_mm(self, max_iter: int, tol: float) -> int:
+        """MM-итерации Хантера: gamma_i = W_i / sum_j n_ij / (gamma_i + gamma_j)
+
+        Регуляризация - по одной виртуальной победе и поражению каждого изображения над
+        изображением с силой 1, что соответствует слабому априорному распределению.
+        """
+        a, b, _, n, y = self._rows()
+        n_images = len(self.scores)
+        wins = np.bincount(a, y, n_images) + np.bincount(b, n - y, n_images) + 1.0
+        gamma = np.exp(self.scores)
+        for iteration in range(1, max_iter + 1):
+            inverse = n / (gamma[a] + gamma[b])
+            denominator = np.bincount(a, inverse, n_images) + np.bincount(b, inverse, n_images) + 2.0 / (gamma + 1.0)
+            # Виртуальный соперник с силой 1 задает масштаб, нормировать gamma не нужно
+            new_gamma = wins / denominator
+            change = float(np.max(np.abs(np.log(new_gamma) - np.log(gamma))))
+            gamma = new_gamma
+            if change < tol:
+                break
+        self.scores = np.log(gamma)
+        p = _sigmoid(self.scores[a] - self.scores[b])
+        w = n * p * (1.0 - p)
+        self._diagonal = np.bincount(a, w, n_images) + np.bincount(b, w, n_images) + self.l2
+        return iteration
+
+    # Результаты
+
+    def score(self, image_key: str) -> Optional[float]:
+        index = self.log.images.get(image_key)
+        if index is None or index >= len(self.scores):
+            return None
+        return float(self.scores[index])
+
+    def user_biases(self) -> Dict[Hashable, float]:
+        """Склонность каждого пользователя выбирать оригинал (в логитах)"""
+        return {key: float(self.bias[i]) for i, key in enumerate(self.log.users.keys[:len(self.bias)])}
+
+    def ranking(self) -> List[Dict]:
+        """Варианты с силой относительно своего оригинала, от сильнейшего к слабейшему
+
+        score - логарифм шансов варианта против оригинала, win_probability - sigmoid(score),
+        stderr - приближенная стандартная ошибка по диагонали гессиана.
+        """
+        fixed, variable = self.log.fixed, self.log.variable
+        codes = (fixed.astype(np.int64) << 32) | variable
+        unique, inverse = np.unique(codes, return_inverse=True)
+        votes = np.bincount(inverse, minlength=len(unique))
+        variant_wins = np.bincount(inverse, weights=~self.log.selected_original, minlength=len(unique))
+        a = (unique >> 32).astype(np.int64)
+        b = (unique & 0xFFFFFFFF).astype(np.int64)
+        relative = self.scores[b] - self.scores[a]
+        diagonal = self._diagonal if len(self._diagonal) == len(self.scores) else np.full(len(self.scores), np.inf)
+        stderr = np.sqrt(1.0 / diagonal[a] + 1.0 / diagonal[b])
+
+        keys = self.log.images.keys
+        result = [{
+            'fixed_image': keys[a[i]],
+            'variable_image': keys[b[i]],
+            'score': float(relative[i]),
+            'stderr': float(stderr[i]),
+            'win_probability': float(_sigmoid(relative[i])),
+            'votes': int(votes[i]),
+            'variant_wins': int(variant_wins[i])
+        } for i in range(len(unique))]
+        result.sort(key=lambda item: item['score'], reverse=True)
+        return result
+
+
+async def load_comparison_log(db, chunk_size: int = 65536) -> ComparisonLog:
+    """Загружает все сравнения из базы в ComparisonLog порциями по chunk_size"""
+    log = ComparisonLog()
+    chunk: Tuple[List, List, List, List] = ([], [], [], [])
+    async for user_id, fixed_image, variable_image, selected_original in db.iter_comparisons():
+        chunk[0].append(fixed_image)
+        chunk[1].append(variable_image)
+        chunk[2].append(user_id)
+        chunk[3].append(selected_original)
+        if len(chunk[0]) >= chunk_size:
+            log.add(*chunk)
+            chunk = ([], [], [], [])
+    if chunk[0]:
+        log.add(*chunk)
+    logging.info(f"Loaded {log.size} comparisons of {len(log.users)} users and {len(log.images)} images")
+    return log
@@ -0,0 +1,177 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+import config
+from catalog import file_digest
+
+# Версия макета склейки: входит в ключ кэша, поэтому после изменения отрисовки
+# старые файлы не используются
+RENDER_VERSION = 1
+# Подписи панелей слева направо
+PANEL_LABELS = ("Оригинал", "Вариант")
+# Высота полосы с подписями над панелями
+LABEL_HEIGHT = 56
+
+
+@functools.lru_cache(maxsize=None)
+def _load_font(size: int):
+    """Загружает шрифт подписей; без TrueType-шрифта используется встроенный"""
+    try:
+        return ImageFont.truetype(config.COMPOSITE_FONT_PATH, size)
+    except OSError:
+        logging.warning(f"Font not found: {config.COMPOSITE_FONT_PATH}, using default font")
+        return ImageFont.load_default()
+
+
+def _fit_panel(image: Image.Image, panel_size: Tuple[int, int]) -> Image.Image:
+    """Вписывает изображение в панель с сохранением пропорций, поля остаются белыми"""
+    panel_width, panel_height = panel_size
+    image = image.convert('RGB')
+    scale = min(panel_width / image.width, panel_height / image.height)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    panel = Image.new('RGB', panel_size, 'white')
+    panel.paste(image.resize(size, Image.LANCZOS), ((panel_width - size[0]) // 2, (panel_height - size[1]) // 2))
+    return panel
+
+
+def compose_side_by_side(left_path: str, right_path: str, output_path: str,
+                         panel_size: Tuple[int, int] = (640, 640),
+                         labels: Tuple[str, str] = PANEL_LABELS) -> str:
+    """Склеивает два изображения в одно: слева оригинал, справа вариант, над ними подписи"""
+    panel_width, panel_height = panel_size
+    composite = Image.new('RGB', (panel_width * 2, panel_height + LABEL_HEIGHT), 'white')
+    draw = ImageDraw.Draw(composite)
+    font = _load_font(LABEL_HEIGHT // 2)
+
+    for i, (path, label) in enumerate(zip((left_path, right_path), labels)):
+        with Image.open(path) as image:
+            composite.paste(_fit_panel(image, panel_size), (i * panel_width, LABEL_HEIGHT))
+        draw.text((i * panel_width + panel_width // 2, LABEL_HEIGHT // 2), label, fill='black', font=font, anchor='mm')
+    # Разделитель между панелями
+    draw.line([(panel_width, 0), (panel_width, composite.height)], fill='lightgray', width=2)
+
+    # Пишем во временный файл, чтобы параллельный читатель не увидел частично записанный JPEG
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        composite.save(f, 'JPEG', quality=87, optimize=True)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+class CompositeCache:
+    """Кэш склеек пар (фиксированное изображение, вариант) на диске
+
+    Имя файла склейки - хэш содержимого обоих изображений и параметров отрисовки,
+    поэтому замена любого из файлов дает новую склейку, а неизменившиеся пары
+    не перерисовываются даже после перезапуска. Склейки строятся заранее в пуле
+    процессов (prebuild); в обработчиках lookup только находит готовый JPEG.
+    """
+
+    def __init__(self, directory: str, panel_size: Tuple[int, int] = (640, 640), workers: Optional[int] = None,
+                 catalog=None):
+        self.directory = directory
+        # Индекс каталогов (ExperimentRegistry или ImageCatalog): хэши изображений берутся из него
+        self.catalog = catalog
+        self.panel_size = panel_size
+        self.workers = workers
+        # (путь фиксированного, путь варианта) -> путь готовой склейки
+        self._ready: Dict[Tuple[str, str], str] = {}
+        # путь -> (размер, mtime, sha256), чтобы не перечитывать неизменившиеся файлы
+        self._digests: Dict[str, Tuple[int, int, str]] = {}
+        self._prebuild_lock: Optional[asyncio.Lock] = None
+
+    def _digest(self, path: str) -> str:
+        entry = self.catalog.entry_for_path(path) if self.catalog is not None else None
+        if entry is not None:
+            return entry.sha256
+        stat = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = file_digest(path)
+        self._digests[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def composite_path(self, fixed_image_path: str, variable_image_path: str) -> str:
+        """Путь склейки для текущего содержимого пары файлов"""
+        key = hashlib.sha256(
+            f"{RENDER_VERSION}:{self.panel_size}:{PANEL_LABELS}:"
+            f"{self._digest(fixed_image_path)}:{self._digest(variable_image_path)}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, key[:2], f"{key}.jpg")
+
+    def lookup(self, fixed_image_path: str, variable_image_path: str) -> Optional[str]:
+        """Возвращает готовую склейку без обращения к диску или None"""
+        return self._ready.get((fixed_image_path, variable_image_path))
+
+    def _render(self, fixed_image_path: str, variable_image_path: str) -> str:
+        output_path = self.composite_path(fixed_image_path, variable_image_path)
+        if not os.path.exists(output_path):
+            compose_side_by_side(fixed_image_path, variable_image_path, output_path, self.panel_size)
+        self._ready[(fixed_image_path, variable_image_path)] = output_path
+        return output_path
+
+    async def get(self, fixed_image_path: str, variable_image_path: str) -> str:
+        """Возвращает склейку пары; если она еще не построена, рисует ее в отдельном потоке"""
+        output_path = self.lookup(fixed_image_path, variable_image_path)
+        if output_path is None:
+            logging.warning(f"Composite for {os.path.basename(variable_image_path)} was not prebuilt, rendering on demand")
+            output_path = await asyncio.to_thread(self._render, fixed_image_path, variable_image_path)
+        return output_path
+
+    def _plan(self, fixed_image_path: str, variable_image_paths: List[str]) -> List[Tuple[str, str, str]]:
+        """Определяет пути склеек и оставляет только отсутствующие на диске"""
+        missing = []
+        for variable_image_path in variable_image_paths:
+            try:
+                output_path = self.composite_path(fixed_image_path, variable_image_path)
+            except OSError as e:
+                logging.error(f"Cannot read image {variable_image_path}: {e}")
+                continue
+            if os.path.exists(output_path):
+                self._ready[(fixed_image_path, variable_image_path)] = output_path
+            else:
+                missing.append((variable_image_path, output_path))
+        return missing
+
+    async def prebuild(self, fixed_image_path: str, variable_image_paths: List[str]) -> int:
+        """Строит склейки фиксированного изображения со всеми вариантами
+
+        Вызывается при запуске и при изменении каталога: уже построенные пары
+        пропускаются. Возвращает число нарисованных склеек.
+        """
+        if self._prebuild_lock is None:
+            self._prebuild_lock = asyncio.Lock()
+        async with self._prebuild_lock:
+            variable_image_paths = [p for p in variable_image_paths if p != fixed_image_path]
+            missing = await asyncio.to_thread(self._plan, fixed_image_path, variable_image_paths)
+            if not missing:
+                return 0
+
+            logging.info(f"Rendering {len(missing)} composites for {os.path.basename(fixed_image_path)}")
+            loop = asyncio.get_running_loop()
+            rendered = 0
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = [
+                    loop.run_in_executor(pool, compose_side_by_side, fixed_image_path, variable_image_path,
+                                         output_path, self.panel_size)
+                    for variable_image_path, output_path in missing
+                ]
+                results = await asyncio.gather(*futures, return_exceptions=True)
+            for (variable_image_path, output_path), result in zip(missing, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Error rendering composite for {variable_image_path}: {result}")
+                    continue
+                self._ready[(fixed_image_path, variable_image_path)] = output_path
+                rendered += 1
+            logging.info(f"Rendered {rendered} composites")
+            return rendered
@@ -0,0 +1,153 @@
+import heapq
+import itertools
+import logging
+import random
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class VariantSampler(ABC):
+    """Стратегия выбора вариантов одного эксперимента для сессии
+
+    keys - все варианты эксперимента (список из индекса каталога), excluded - уже
+    показанные пользователю ключи. observe получает результат каждого голоса.
+    """
+
+    @abstractmethod
+    def select(self, keys: List[str], count: int, excluded: Set[str]) -> List[str]:
+        raise NotImplementedError
+
+    def observe(self, key: str, wins: int, losses: int):
+        pass
+
+    def seed(self, counts: Dict[str, Tuple[int, int]]):
+        """Начальные счетчики побед и поражений вариантов (из статистики в базе)"""
+        pass
+
+
+class UniformSampler(VariantSampler):
+    """Равномерная случайная выборка из непоказанных вариантов"""
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self._rng = rng or random.Random()
+
+    def select(self, keys: List[str], count: int, excluded: Set[str]) -> List[str]:
+        available = [key for key in keys if key not in excluded]
+        return self._rng.sample(available, min(count, len(available)))
+
+
+class ThompsonSampler(VariantSampler):
+    """Томпсоновское сэмплирование по апостериорным Beta-распределениям "вариант лучше оригинала"
+
+    Для сессии выбираются count вариантов с наибольшими выборками из Beta(wins + 1, losses + 1)
+    (multiple-play Thompson sampling): голоса уходят вариантам, чье место в верхней части
+    рейтинга еще не определено, а варианты с устоявшейся оценкой показываются редко.
+
+    Выборки хранятся в куче и перетягиваются только у выбранных вариантов и вариантов,
+    получивших голос, поэтому выбор стоит O(log n), а не проход по всем вариантам. Чтобы
+    давно не выбиравшиеся варианты не застревали со старой выборкой, после n выборов
+    все выборки обновляются целиком (амортизированно O(1) на выбор).
+    """
+
+    def __init__(self, prior: Tuple[float, float] = (1.0, 1.0), rng: Optional[random.Random] = None):
+        self.prior = prior
+        self._rng = rng or random.Random()
+        # ключ -> [победы варианта, победы оригинала]
+        self._counts: Dict[str, List[int]] = {}
+        # Текущий набор вариантов; список сравнивается по идентичности - индекс каталога
+        # заменяет его новым объектом при каждом изменении
+        self._keys: Optional[List[str]] = None
+        self._members: Set[str] = set()
+        # Куча (-выборка, версия, ключ); записи с версией, отличной от _versions[ключ], устарели
+        self._heap: List[Tuple[float, int, str]] = []
+        self._versions: Dict[str, int] = {}
+        self._counter = itertools.count()
+        self._picks_since_refresh = 0
+
+    def _draw(self, key: str) -> float:
+        wins, losses = self._counts.get(key, (0, 0))
+        return self._rng.betavariate(self.prior[0] + wins, self.prior[1] + losses)
+
+    def _push(self, key: str):
+        version = next(self._counter)
+        self._versions[key] = version
+        heapq.heappush(self._heap, (-self._draw(key), version, key))
+
+    def _refresh(self):
+        """Заново тянет выборки всех вариантов и перестраивает кучу без устаревших записей"""
+        self._versions = {}
+        self._heap = []
+        for key in self._members:
+            version = next(self._counter)
+            self._versions[key] = version
+            self._heap.append((-self._draw(key), version, key))
+        heapq.heapify(self._heap)
+        self._picks_since_refresh = 0
+
+    def _sync(self, keys: List[str]):
+        if keys is self._keys:
+            return
+        members = set(keys)
+        for key in self._members - members:
+            # Запись в куче станет устаревшей и будет выброшена при извлечении
+            self._versions.pop(key, None)
+        for key in members - self._members:
+            self._push(key)
+        self._members = members
+        self._keys = keys
+
+    def select(self, keys: List[str], count: int, excluded: Set[str]) -> List[str]:
+        self._sync(keys)
+        if self._picks_since_refresh >= len(self._members) or len(self._heap) > 4 * len(self._members) + 64:
+            self._refresh()
+
+        selected, skipped = [], []
+        while self._heap and len(selected) < count:
+            entry = heapq.heappop(self._heap)
+            key = entry[2]
+            if self._versions.get(key) != entry[1]:
+                continue
+            if key in excluded:
+                skipped.append(entry)
+                continue
+            selected.append(key)
+        # Показанные пользователю варианты сохраняют свою выборку для следующих сессий
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        # У выбранных вариантов новая выборка, иначе следующая сессия получила бы те же варианты
+        for key in selected:
+            self._push(key)
+        self._picks_since_refresh += len(selected)
+        return selected
+
+    def observe(self, key: str, wins: int, losses: int):
+        counts = self._counts.setdefault(key, [0, 0])
+        counts[0] += wins
+        counts[1] += losses
+        if key in self._members:
+            self._push(key)
+
+    def seed(self, counts: Dict[str, Tuple[int, int]]):
+        for key, (wins, losses) in counts.items():
+            self._counts[key] = [wins, losses]
+        if self._members:
+            self._refresh()
+
+    def posterior(self, key: str) -> Tuple[float, float]:
+        """Параметры Beta-распределения доли побед варианта"""
+        wins, losses = self._counts.get(key, (0, 0))
+        return self.prior[0] + wins, self.prior[1] + losses
+
+
+SAMPLERS = {
+    'uniform': UniformSampler,
+    'thompson': ThompsonSampler,
+}
+
+
+def create_sampler(name: str) -> VariantSampler:
+    """Создает стратегию выбора вариантов по имени из config.VARIANT_SAMPLER"""
+    if name not in SAMPLERS:
+        logging.error(f"Unknown variant sampler: {name}, using thompson")
+        name = 'thompson'
+    return SAMPLERS[name]()
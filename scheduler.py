@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import logging
+import math
+import os
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+# Обработчик пачки истекших таймеров: список пар (chat_id, index)
+ExpiryHandler = Callable[[List[Tuple[int, int]]], Awaitable[None]]
+
+
+class DeadlineScheduler:
+    """Единый планировщик тайм-аутов сравнений на основе кучи дедлайнов
+
+    Вместо отдельной задачи asyncio на каждое открытое сравнение одна фоновая задача
+    ждет ближайший дедлайн. В каждом чате активен не больше одного таймера (chat_id, index);
+    отмена выполняется за O(1) удалением из словаря, а устаревшие записи кучи
+    отбрасываются при извлечении. Дедлайны хранятся в SQLite, поэтому переживают
+    перезапуск: просроченные за время простоя таймеры срабатывают сразу после старта.
+
+    schedule и cancel меняют только состояние в памяти и отмечают чат; изменения
+    отмеченных чатов записываются в SQLite одной транзакцией в отдельном потоке не чаще
+    раза в persist_interval секунд, поэтому запись на диск не задерживает event loop.
+    При аварийном завершении теряются изменения таймеров за последний интервал.
+    """
+
+    def __init__(self, path: str, handler: ExpiryHandler, resolution: float = 0.5, persist_interval: float = 1.0):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._handler = handler
+        self.resolution = resolution
+        self.persist_interval = persist_interval
+        # chat_id -> (index, deadline)
+        self._timers: Dict[int, Tuple[int, float]] = {}
+        self._heap: List[Tuple[float, int, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._handler_tasks: Set[asyncio.Task] = set()
+        # Чаты, таймеры которых изменились после последней записи в SQLite
+        self._dirty: Set[int] = set()
+        self._dirty_event: Optional[asyncio.Event] = None
+        self._persist_task: Optional[asyncio.Task] = None
+        self._persist_lock: Optional[asyncio.Lock] = None
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS timers (chat_id INTEGER PRIMARY KEY, idx INTEGER NOT NULL, deadline REAL NOT NULL)")
+
+    def __len__(self) -> int:
+        """Число активных таймеров"""
+        return len(self._timers)
+
+    async def start(self):
+        """Загружает сохраненные дедлайны и запускает фоновую задачу"""
+        for chat_id, index, deadline in self._conn.execute("SELECT chat_id, idx, deadline FROM timers"):
+            self._timers[chat_id] = (index, deadline)
+            self._heap.append((deadline, chat_id, index))
+        heapq.heapify(self._heap)
+        if self._timers:
+            logging.info(f"Restored {len(self._timers)} comparison timers")
+        self._wakeup = asyncio.Event()
+        self._dirty_event = asyncio.Event()
+        self._persist_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        self._persist_task = asyncio.create_task(self._persist_loop())
+
+    async def stop(self):
+        """Останавливает планировщик; сохраненные дедлайны остаются до следующего запуска"""
+        for task in (self._task, self._persist_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._persist_task = None
+        for task in list(self._handler_tasks):
+            task.cancel()
+        await self._persist()
+        self._conn.close()
+
+    def schedule(self, chat_id: int, index: int, delay: float):
+        """Ставит таймер сравнения index в чате; предыдущий таймер чата заменяется
+
+        Дедлайн округляется вверх до resolution секунд, чтобы близкие по времени таймеры
+        истекали одновременно и обрабатывались одной пачкой.
+        """
+        deadline = math.ceil((time.time() + delay) / self.resolution) * self.resolution
+        self._timers[chat_id] = (index, deadline)
+        heapq.heappush(self._heap, (deadline, chat_id, index))
+        self._mark_dirty(chat_id)
+        if self._wakeup and self._heap[0][0] == deadline:
+            self._wakeup.set()
+
+    def cancel(self, chat_id: int, index: Optional[int] = None) -> bool:
+        """Отменяет таймер чата (только если он относится к сравнению index, когда тот указан)"""
+        timer = self._timers.get(chat_id)
+        if timer is None or (index is not None and timer[0] != index):
+            return False
+        del self._timers[chat_id]
+        self._mark_dirty(chat_id)
+        return True
+
+    def _mark_dirty(self, chat_id: int):
+        self._dirty.add(chat_id)
+        if self._dirty_event:
+            self._dirty_event.set()
+
+    async def _persist(self):
+        """Записывает в SQLite текущее состояние таймеров отмеченных чатов"""
+        async with self._persist_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            # Снимок берется в event loop, в потоке только выполняются запросы
+            rows = [(chat_id, *self._timers[chat_id]) for chat_id in dirty if chat_id in self._timers]
+            removed = [(chat_id,) for chat_id in dirty if chat_id not in self._timers]
+            try:
+                await asyncio.to_thread(self._write, rows, removed)
+            except Exception as e:
+                # Чаты остаются отмеченными до следующей записи
+                self._dirty |= dirty
+                logging.error(f"Error saving comparison timers: {e}")
+
+    def _write(self, rows: List[Tuple[int, int, float]], removed: List[Tuple[int]]):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO timers (chat_id, idx, deadline) VALUES (?, ?, ?)", rows)
+            self._conn.executemany("DELETE FROM timers WHERE chat_id = ?", removed)
+
+    async def _persist_loop(self):
+        """Фоновая запись изменений таймеров пачками"""
+        while True:
+            await self._dirty_event.wait()
+            await asyncio.sleep(self.persist_interval)
+            self._dirty_event.clear()
+            # Отмена в stop() не прерывает начатую транзакцию: stop дождется ее по блокировке
+            await asyncio.shield(self._persist())
+
+    def _pop_expired(self, now: float) -> List[Tuple[int, int]]:
+        """Извлекает все истекшие таймеры, пропуская отмененные и замененные записи кучи"""
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, chat_id, index = heapq.heappop(self._heap)
+            if self._timers.get(chat_id) == (index, deadline):
+                del self._timers[chat_id]
+                self._mark_dirty(chat_id)
+                expired.append((chat_id, index))
+        return expired
+
+    async def _run(self):
+        """Фоновый цикл: ждет ближайший дедлайн и передает истекшие таймеры обработчику пачкой"""
+        while True:
+            self._wakeup.clear()
+            expired = self._pop_expired(time.time())
+            if expired:
+                task = asyncio.create_task(self._dispatch(expired))
+                self._handler_tasks.add(task)
+                task.add_done_callback(self._handler_tasks.discard)
+                continue
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            # asyncio.wait вместо wait_for: wait_for теряет отмену задачи (stop), если событие
+            # установлено в том же шаге цикла, и stop зависает до ближайшего дедлайна
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=timeout)
+            finally:
+                waiter.cancel()
+
+    async def _dispatch(self, expired: List[Tuple[int, int]]):
+        try:
+            await self._handler(expired)
+        except Exception as e:
+            logging.error(f"Error handling expired timers: {e}")
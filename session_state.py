@@ -0,0 +1,147 @@
+import base64
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import config
+from experiments import Experiment, ExperimentRegistry, split_key
+
+# Данные сессии в FSM хранятся компактно:
+#   experiment - ID эксперимента сессии
+#   catalog    - поколение нумерации каталога эксперимента (ImageCatalog.generation)
+#   variants   - порядковые номера (ordinal) вариантов сессии в каталоге эксперимента
+#   votes      - битовая маска сравнений с ответом (бит i - сравнение i)
+#   originals  - битовая маска сравнений, где выбран оригинал
+#   shown      - история прошлых сессий: {ID эксперимента: "<поколение>:<битовый массив номеров
+#                показанных вариантов в base64>"}, не больше config.SESSION_HISTORY_MAX_BYTES
+# Поэтому размер данных сессии ограничен независимо от числа пройденных сессий. Номера
+# действительны только в своем поколении каталога (манифест перестроен, сессия перешла
+# в процесс с другим манифестом): сессия другого поколения не продолжается, история
+# другого поколения забывается. Сессии прежнего формата (variable_images, selections
+# и shown_comparisons с ключами изображений) читаются теми же функциями.
+
+
+def encode_bits(numbers: Iterable[int]) -> str:
+    """Множество неотрицательных чисел как битовый массив в base64 (бит n - число n)"""
+    value = 0
+    for number in numbers:
+        value |= 1 << number
+    return base64.b64encode(value.to_bytes((value.bit_length() + 7) // 8, 'little')).decode('ascii')
+
+
+def decode_bits(encoded: str) -> List[int]:
+    """Числа из битового массива encode_bits по возрастанию"""
+    value = int.from_bytes(base64.b64decode(encoded), 'little')
+    numbers = []
+    while value:
+        lowest = value & -value
+        numbers.append(lowest.bit_length() - 1)
+        value ^= lowest
+    return numbers
+
+
+def count_bits(mask: int) -> int:
+    return bin(mask).count('1')
+
+
+def encode_variants(experiment: Experiment, variable_images: List[str]) -> List[int]:
+    """Порядковые номера вариантов сессии по их ключам"""
+    return [experiment.catalog.ordinal(split_key(key)[1]) for key in variable_images]
+
+
+def session_experiment(data: Dict, experiments: ExperimentRegistry) -> Optional[Experiment]:
+    """Эксперимент сессии; None, если его нет или номера вариантов сессии из другого поколения каталога"""
+    experiment = experiments.get(data.get("experiment"))
+    if experiment is None and data.get("variable_images"):
+        # Сессии, начатые до появления экспериментов, относятся к эксперименту первого варианта
+        experiment = experiments.experiment_for_key(data["variable_images"][0])
+    if experiment is not None and "variants" in data and data.get("catalog") != experiment.catalog.generation:
+        logging.warning(f"Session catalog generation {data.get('catalog')} of experiment {experiment.id!r} "
+                        f"does not match {experiment.catalog.generation}, dropping the session")
+        return None
+    return experiment
+
+
+def session_variants(data: Dict, experiment: Experiment) -> List[str]:
+    """Ключи вариантов сессии в порядке показа"""
+    if "variants" not in data:
+        return data.get("variable_images", [])
+    keys = []
+    for ordinal in data["variants"]:
+        name = experiment.catalog.name_for_ordinal(ordinal)
+        # Номер неизвестен, если каталог проиндексирован заново: вариант будет пропущен как отсутствующий
+        keys.append(experiment.key(name if name is not None else f"#{ordinal}"))
+    return keys
+
+
+def session_length(data: Dict) -> int:
+    """Число сравнений сессии"""
+    return len(data["variants"]) if "variants" in data else len(data.get("variable_images", []))
+
+
+def record_vote(data: Dict, index: int, selected_original: bool) -> Dict[str, int]:
+    """Поля данных сессии после ответа на сравнение index"""
+    bit = 1 << index
+    originals = data.get("originals", 0)
+    return {
+        "votes": data.get("votes", 0) | bit,
+        "originals": originals | bit if selected_original else originals & ~bit
+    }
+
+
+def vote_counts(data: Dict) -> Tuple[int, int]:
+    """Число выборов оригинала и число ответов за сессию"""
+    legacy = data.get("selections", {})
+    original_count = count_bits(data.get("originals", 0)) + sum(1 for selected in legacy.values() if selected)
+    return original_count, count_bits(data.get("votes", 0)) + len(legacy)
+
+
+def _history_ordinals(history: Dict[str, str], experiment: Experiment) -> Optional[List[int]]:
+    """Номера показанных вариантов эксперимента; None, если истории нет или она другого поколения"""
+    generation, _, bits = history.get(experiment.id, '').rpartition(':')
+    if not bits or generation != experiment.catalog.generation:
+        return None
+    return decode_bits(bits)
+
+
+def add_shown(history: Dict[str, str], experiment: Experiment, names: Iterable[str]) -> Dict[str, str]:
+    """История показов с добавленными вариантами эксперимента
+
+    Эксперимент переносится в конец истории; если история больше
+    config.SESSION_HISTORY_MAX_BYTES, забываются эксперименты из ее начала,
+    но не сам эксперимент.
+    """
+    ordinals = _history_ordinals(history, experiment) or []
+    ordinals.extend(ordinal for ordinal in map(experiment.catalog.ordinal, names) if ordinal is not None)
+    history = {experiment_id: bits for experiment_id, bits in history.items() if experiment_id != experiment.id}
+    history[experiment.id] = f"{experiment.catalog.generation}:{encode_bits(ordinals)}"
+    while len(history) > 1 and sum(len(experiment_id) + len(bits) for experiment_id, bits in history.items()) > config.SESSION_HISTORY_MAX_BYTES:
+        del history[next(iter(history))]
+    return history
+
+
+def session_history(data: Dict, experiments: ExperimentRegistry) -> Dict[str, str]:
+    """История показов сессии (история прежнего формата переводится в битовые массивы)"""
+    history = data.get("shown", {})
+    legacy: Dict[str, List[str]] = {}
+    for _, variable_key in data.get("shown_comparisons", ()):
+        experiment_id, name = split_key(variable_key)
+        legacy.setdefault(experiment_id, []).append(name)
+    for experiment_id, names in legacy.items():
+        experiment = experiments.get(experiment_id)
+        if experiment is not None:
+            history = add_shown(history, experiment, names)
+    return history
+
+
+def shown_variants(history: Dict[str, str], experiments: ExperimentRegistry) -> Set[str]:
+    """Ключи вариантов из истории показов"""
+    keys = set()
+    for experiment_id in history:
+        experiment = experiments.get(experiment_id)
+        if experiment is None:
+            continue
+        for ordinal in _history_ordinals(history, experiment) or ():
+            name = experiment.catalog.name_for_ordinal(ordinal)
+            if name is not None:
+                keys.add(experiment.key(name))
+    return keys
@@ -0,0 +1,365 @@
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from database import BaseDatabase, wilson_lower_bound
+from experiments import ExperimentRegistry, split_key
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS users ("
+    "user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, created_at REAL NOT NULL, "
+    "total_comparisons INTEGER NOT NULL DEFAULT 0, original_selected INTEGER NOT NULL DEFAULT 0, "
+    "variant_selected INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS images ("
+    "id INTEGER PRIMARY KEY, filename TEXT NOT NULL UNIQUE, experiment TEXT NOT NULL, upload_date REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS comparisons ("
+    "id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, fixed_image_id INTEGER NOT NULL, "
+    "variable_image_id INTEGER NOT NULL, selected_original INTEGER NOT NULL, created_at REAL NOT NULL, written_at REAL)",
+    "CREATE INDEX IF NOT EXISTS comparisons_user_id ON comparisons (user_id)",
+    "CREATE INDEX IF NOT EXISTS comparisons_created_at ON comparisons (created_at, id)",
+    # Варианты, показанные пользователю; первичный ключ служит индексом по user_id
+    "CREATE TABLE IF NOT EXISTS seen_images ("
+    "user_id INTEGER NOT NULL, image_id INTEGER NOT NULL, PRIMARY KEY (user_id, image_id)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS variant_stats ("
+    "fixed_image_id INTEGER NOT NULL, variable_image_id INTEGER NOT NULL, wins INTEGER NOT NULL DEFAULT 0, "
+    "losses INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (fixed_image_id, variable_image_id)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS experiments ("
+    "experiment TEXT PRIMARY KEY, total_comparisons INTEGER NOT NULL DEFAULT 0, "
+    "original_selected INTEGER NOT NULL DEFAULT 0, variant_selected INTEGER NOT NULL DEFAULT 0)",
+)
+
+# Запросы - постоянные строки с параметрами: sqlite3 кэширует подготовленные выражения
+# соединения по тексту запроса, поэтому каждый запрос компилируется один раз
+SAVE_USER = (
+    "INSERT INTO users (user_id, username, first_name, last_name, created_at) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name, "
+    "last_name = excluded.last_name"
+)
+INSERT_IMAGE = "INSERT OR IGNORE INTO images (filename, experiment, upload_date) VALUES (?, ?, ?)"
+SELECT_IMAGES = "SELECT id, filename FROM images"
+SELECT_IMAGE_ID = "SELECT id FROM images WHERE filename = ?"
+SELECT_SEEN = "SELECT image_id FROM seen_images WHERE user_id = ?"
+INSERT_COMPARISON = (
+    "INSERT OR IGNORE INTO comparisons (id, user_id, fixed_image_id, variable_image_id, selected_original, created_at, "
+    "written_at) VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+INSERT_SEEN = "INSERT OR IGNORE INTO seen_images (user_id, image_id) VALUES (?, ?)"
+UPDATE_USER_COUNTERS = (
+    "INSERT INTO users (user_id, created_at, total_comparisons, original_selected, variant_selected) "
+    "VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET "
+    "total_comparisons = total_comparisons + excluded.total_comparisons, "
+    "original_selected = original_selected + excluded.original_selected, "
+    "variant_selected = variant_selected + excluded.variant_selected"
+)
+UPDATE_VARIANT_COUNTERS = (
+    "INSERT INTO variant_stats (fixed_image_id, variable_image_id, wins, losses) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(fixed_image_id, variable_image_id) DO UPDATE SET "
+    "wins = wins + excluded.wins, losses = losses + excluded.losses"
+)
+UPDATE_EXPERIMENT_COUNTERS = (
+    "INSERT INTO experiments (experiment, total_comparisons, original_selected, variant_selected) "
+    "VALUES (?, ?, ?, ?) ON CONFLICT(experiment) DO UPDATE SET "
+    "total_comparisons = total_comparisons + excluded.total_comparisons, "
+    "original_selected = original_selected + excluded.original_selected, "
+    "variant_selected = variant_selected + excluded.variant_selected"
+)
+# Страница сравнений по времени голоса (created_at) или времени записи (written_at)
+SELECT_COMPARISON_PAGE = {
+    field: (
+        f"SELECT c.id, c.user_id, f.filename, v.filename, c.selected_original, c.created_at, c.written_at, c.{field} "
+        "FROM comparisons c "
+        "JOIN images f ON f.id = c.fixed_image_id JOIN images v ON v.id = c.variable_image_id "
+        f"WHERE c.{field} >= ? AND c.{field} < ? AND (c.{field}, c.id) > (?, ?) "
+        f"ORDER BY c.{field}, c.id LIMIT ?"
+    )
+    for field in ('created_at', 'written_at')
+}
+
+
+class SQLiteDatabase(BaseDatabase):
+    """Хранилище данных бота во встроенной базе SQLite в режиме WAL
+
+    Для локальной разработки, нагрузочных тестов и небольших установок без Firestore.
+    Пачка голосов записывается одной транзакцией: сравнения, показанные варианты и счетчики
+    пользователей, вариантов и экспериментов. Сравнение с уже записанным id пропускается
+    вместе со своими счетчиками, поэтому повтор пачки ничего не засчитывает дважды.
+
+    Запросы выполняются в отдельном потоке, по одному в порядке вызова: ожидание
+    блокировки файла другим процессом (до busy_timeout) не останавливает event loop.
+    """
+
+    def __init__(self, path: str, experiments: Optional[ExperimentRegistry] = None):
+        super().__init__(experiments)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Несколько процессов могут писать в один файл: ждем освобождения блокировки
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self._migrate()
+        # Единственный поток соединения: транзакции не перемежаются, даже если вызвавшая
+        # корутина отменена, пока ее запрос выполняется
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-db')
+        # Ключ изображения <-> ID строки
+        self._image_ids: Dict[str, int] = {}
+        self._image_filenames: Dict[int, str] = {}
+
+    async def _call(self, func: Callable, *args):
+        """Выполняет func(*args) в потоке соединения"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _fetchall(self, query: str, params: Tuple = ()) -> List[Tuple]:
+        return await self._call(lambda: self._conn.execute(query, params).fetchall())
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _migrate(self):
+        """Добавляет в базы, созданные прежними версиями, столбцы, которых в них нет"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(comparisons)")}
+        if 'written_at' not in columns:
+            with self._transaction():
+                self._conn.execute("ALTER TABLE comparisons ADD COLUMN written_at REAL")
+                # Время записи прежних сравнений неизвестно: берется время голоса
+                self._conn.execute("UPDATE comparisons SET written_at = created_at")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS comparisons_written_at ON comparisons (written_at, id)")
+
+    async def _load_images(self):
+        for image_id, filename in await self._fetchall(SELECT_IMAGES):
+            self._image_ids[filename] = image_id
+            self._image_filenames[image_id] = filename
+
+    async def connect(self):
+        """Загружает индекс изображений"""
+        await self._load_images()
+        logging.info(f"SQLite database opened: {self.path}, {len(self._image_ids)} images")
+        return True
+
+    async def close(self):
+        await self._call(self._conn.close)
+        self._executor.shutdown()
+        return True
+
+    async def save_user(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
+        try:
+            await self._call(self._conn.execute, SAVE_USER, (user_id, username, first_name, last_name, time.time()))
+            logging.info(f"User saved/updated: {user_id}, {username}")
+            return True
+        except Exception as e:
+            logging.error(f"Error saving user: {e}")
+            return False
+
+    def _insert_images(self, keys: List[str], now: float) -> List[Tuple[str, int]]:
+        with self._transaction():
+            self._conn.executemany(INSERT_IMAGE, [(key, split_key(key)[0], now) for key in keys])
+        # Другой процесс мог добавить часть изображений раньше: ID берутся из базы
+        return [(key, self._conn.execute(SELECT_IMAGE_ID, (key,)).fetchone()[0]) for key in keys]
+
+    async def add_images(self, image_keys: List[str]):
+        try:
+            new_keys = [key for key in dict.fromkeys(image_keys) if key not in self._image_ids]
+            if not new_keys:
+                return True
+            for key, image_id in await self._call(self._insert_images, new_keys, time.time()):
+                self._image_ids[key] = image_id
+                self._image_filenames[image_id] = key
+            logging.info(f"Added {len(new_keys)} new images to database")
+            return True
+        except Exception as e:
+            logging.error(f"Error adding images: {e}")
+            return False
+
+    async def get_image_id(self, filename: str) -> Optional[str]:
+        image_id = self._image_ids.get(filename)
+        return str(image_id) if image_id is not None else None
+
+    async def get_seen_images(self, user_id: int) -> Set[str]:
+        image_ids = [image_id for (image_id,) in await self._fetchall(SELECT_SEEN, (user_id,))]
+        if any(image_id not in self._image_filenames for image_id in image_ids):
+            # Изображения, добавленные другим процессом
+            await self._load_images()
+        return {self._image_filenames[image_id] for image_id in image_ids if image_id in self._image_filenames}
+
+    def _write_comparisons(self, comparisons: List[Tuple[Dict, int, int]], now: float) -> Tuple[Dict, Dict]:
+        """Записывает сравнения (запись, ID оригинала, ID варианта) и счетчики одной транзакцией
+
+        Возвращает счетчики пользователей и вариантов только по новым сравнениям.
+        """
+        user_counters: Dict[int, List[int]] = {}
+        variant_counters: Dict[Tuple[str, str], List[int]] = {}
+        variant_ids: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        experiment_counters: Dict[str, List[int]] = {}
+        with self._transaction():
+            for record, fixed_image_id, variable_image_id in comparisons:
+                created_at = record.get('created_at')
+                cursor = self._conn.execute(INSERT_COMPARISON, (
+                    record['id'], record['user_id'], fixed_image_id, variable_image_id,
+                    int(record['selected_original']), created_at.timestamp() if created_at else now, now
+                ))
+                if not cursor.rowcount:
+                    # Сравнение уже записано предыдущей попыткой
+                    continue
+                self._conn.execute(INSERT_SEEN, (record['user_id'], variable_image_id))
+                selected_original = 1 if record['selected_original'] else 0
+                for counters in (user_counters.setdefault(record['user_id'], [0, 0]),
+                                 experiment_counters.setdefault(split_key(record['fixed_image'])[0], [0, 0])):
+                    counters[0] += 1
+                    counters[1] += selected_original
+                variant_key = (record['fixed_image'], record['variable_image'])
+                variant = variant_counters.setdefault(variant_key, [0, 0])
+                variant[0 if selected_original else 1] += 1
+                variant_ids[variant_key] = (fixed_image_id, variable_image_id)
+
+            self._conn.executemany(UPDATE_USER_COUNTERS, [
+                (user_id, now, total, original_selected, total - original_selected)
+                for user_id, (total, original_selected) in user_counters.items()
+            ])
+            self._conn.executemany(UPDATE_VARIANT_COUNTERS, [
+                (*variant_ids[variant_key], wins, losses)
+                for variant_key, (losses, wins) in variant_counters.items()
+            ])
+            self._conn.executemany(UPDATE_EXPERIMENT_COUNTERS, [
+                (experiment_id, total, original_selected, total - original_selected)
+                for experiment_id, (total, original_selected) in experiment_counters.items()
+            ])
+        return user_counters, variant_counters
+
+    async def save_comparison_batch(self, records: List[Dict]) -> bool:
+        """Сохраняет пачку результатов сравнений одной транзакцией (формат записей - как у FirestoreDatabase)"""
+        try:
+            filenames = {r['fixed_image'] for r in records} | {r['variable_image'] for r in records}
+            missing = [filename for filename in filenames if filename not in self._image_ids]
+            if missing and not await self.add_images(missing):
+                return False
+
+            comparisons = [(record, self._image_ids[record['fixed_image']], self._image_ids[record['variable_image']])
+                           for record in records]
+            user_counters, variant_counters = await self._call(self._write_comparisons, comparisons, time.time())
+            logging.debug(f"Saved {len(records)} comparisons for {len(user_counters)} users")
+            self._observe_votes(variant_counters)
+            return True
+        except Exception as e:
+            logging.error(f"Error saving comparison batch: {e}")
+            return False
+
+    async def iter_comparison_pages(self, page_size: int = 1000, since: Optional[datetime.datetime] = None,
+                                    until: Optional[datetime.datetime] = None, time_field: str = 'created_at'):
+        """Перебирает сравнения страницами по индексу (time_field, id), как FirestoreDatabase"""
+        query = SELECT_COMPARISON_PAGE[time_field]
+        since_ts = since.timestamp() if since is not None else float('-inf')
+        until_ts = until.timestamp() if until is not None else float('inf')
+        last = (float('-inf'), '')
+        while True:
+            rows = await self._fetchall(query, (since_ts, until_ts, *last, page_size))
+            if not rows:
+                return
+            yield [{
+                'id': comparison_id,
+                'user_id': user_id,
+                'fixed_image': fixed_image,
+                'variable_image': variable_image,
+                'selected_original': bool(selected_original),
+                'created_at': datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc),
+                'written_at': datetime.datetime.fromtimestamp(written_at, datetime.timezone.utc)
+            } for comparison_id, user_id, fixed_image, variable_image, selected_original, created_at, written_at, _ in rows]
+            if len(rows) < page_size:
+                return
+            last = (rows[-1][7], rows[-1][0])
+
+    def _backfill_stats(self) -> int:
+        with self._transaction():
+            self._conn.execute("INSERT OR IGNORE INTO seen_images (user_id, image_id) "
+                               "SELECT user_id, variable_image_id FROM comparisons")
+            self._conn.execute("UPDATE users SET total_comparisons = 0, original_selected = 0, variant_selected = 0")
+            cursor = self._conn.execute(
+                "INSERT INTO users (user_id, created_at, total_comparisons, original_selected, variant_selected) "
+                "SELECT user_id, ?, COUNT(*), SUM(selected_original), COUNT(*) - SUM(selected_original) "
+                "FROM comparisons WHERE true GROUP BY user_id ON CONFLICT(user_id) DO UPDATE SET "
+                "total_comparisons = excluded.total_comparisons, original_selected = excluded.original_selected, "
+                "variant_selected = excluded.variant_selected", (time.time(),))
+            updated = cursor.rowcount
+            self._conn.execute("DELETE FROM variant_stats")
+            self._conn.execute(
+                "INSERT INTO variant_stats (fixed_image_id, variable_image_id, wins, losses) "
+                "SELECT fixed_image_id, variable_image_id, COUNT(*) - SUM(selected_original), SUM(selected_original) "
+                "FROM comparisons GROUP BY fixed_image_id, variable_image_id")
+            self._conn.execute("DELETE FROM experiments")
+            self._conn.execute(
+                "INSERT INTO experiments (experiment, total_comparisons, original_selected, variant_selected) "
+                "SELECT i.experiment, COUNT(*), SUM(c.selected_original), COUNT(*) - SUM(c.selected_original) "
+                "FROM comparisons c JOIN images i ON i.id = c.fixed_image_id GROUP BY i.experiment")
+        return updated
+
+    async def backfill_stats(self) -> int:
+        """Пересчитывает показанные варианты и все счетчики по таблице сравнений"""
+        updated = await self._call(self._backfill_stats)
+        logging.info(f"Backfilled stats for {updated} users")
+        self._leaderboard_updated_at = None
+        return updated
+
+    async def get_experiment_stats(self) -> List[Dict]:
+        try:
+            rows = await self._fetchall(
+                "SELECT experiment, total_comparisons, original_selected, variant_selected FROM experiments "
+                "ORDER BY total_comparisons DESC")
+            return [{
+                'experiment': experiment,
+                'total': total,
+                'original_selected': original_selected,
+                'variant_selected': variant_selected,
+                'original_percentage': (original_selected / total * 100) if total > 0 else 0
+            } for experiment, total, original_selected, variant_selected in rows]
+        except Exception as e:
+            logging.error(f"Error getting experiment stats: {e}")
+            return []
+
+    async def get_variant_stats(self) -> List[Dict]:
+        rows = await self._fetchall(
+            "SELECT f.filename, v.filename, s.wins, s.losses FROM variant_stats s "
+            "JOIN images f ON f.id = s.fixed_image_id JOIN images v ON v.id = s.variable_image_id "
+            "WHERE s.wins + s.losses > 0")
+        stats = [{
+            'experiment': split_key(fixed_image)[0],
+            'fixed_image': fixed_image,
+            'variable_image': variable_image,
+            'wins': wins,
+            'losses': losses,
+            'total': wins + losses,
+            'win_rate': wins / (wins + losses),
+            'score': wilson_lower_bound(wins, wins + losses)
+        } for fixed_image, variable_image, wins, losses in rows]
+        stats.sort(key=lambda item: item['score'], reverse=True)
+        return stats
+
+    async def get_user_stats(self, user_id: int) -> Dict:
+        try:
+            rows = await self._fetchall(
+                "SELECT total_comparisons, original_selected, variant_selected FROM users WHERE user_id = ?",
+                (user_id,))
+            row = rows[0] if rows else None
+        except Exception as e:
+            logging.error(f"Error getting user stats: {e}")
+            row = None
+        total, original_selected, variant_selected = row or (0, 0, 0)
+        return {
+            "total": total,
+            "original_selected": original_selected,
+            "variant_selected": variant_selected,
+            "original_percentage": (original_selected / total * 100) if total > 0 else 0
+        }
@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import hmac
+import logging
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+from aiohttp import web
+
+# Заголовок, в котором Telegram передает secret_token из setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Заголовок обновлений, пересланных другим процессом бота: их не пересылают дальше
+FORWARDED_HEADER = 'X-Bot-Forwarded-From'
+
+
+def update_chat_key(update: Update) -> Optional[int]:
+    """Чат обновления (или пользователь, если чата нет) - ключ упорядочивания и распределения"""
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.chat is not None:
+        return context.chat.id
+    if context.user is not None:
+        return context.user.id
+    return None
+
+
+class ChatOrderedPool:
+    """Пул обработчиков обновлений: до workers одновременно, по порядку внутри чата
+
+    У каждого чата своя очередь, а готовые к обработке чаты стоят в общей очереди ready.
+    Пока обновление чата обрабатывается, следующие обновления того же чата только
+    добавляются в его очередь, поэтому один чат не занимает больше одного обработчика и
+    медленный чат не задерживает остальные. Всего в пуле не больше max_pending обновлений:
+    submit() ждет свободного места, и давление передается отправителю (Telegram).
+    """
+
+    def __init__(self, handler: Callable[[Update], Awaitable[Any]], workers: int = 64, max_pending: int = 1000):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self._chats: Dict[Hashable, Deque[Update]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Обновления, принятые пулом и еще не обработанные"""
+        return self._pending
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Дожидается обработки принятых обновлений (не дольше timeout) и останавливает пул"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logging.warning(f"Stopping update pool with {self._pending} unprocessed updates")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, key: Optional[Hashable], update: Update):
+        """Ставит обновление в очередь чата key (None - без упорядочивания)"""
+        await self._slots.acquire()
+        self._pending += 1
+        if key is None:
+            key = ('update', update.update_id)
+        queue = self._chats.get(key)
+        if queue is None:
+            self._chats[key] = collections.deque((update,))
+            self._ready.put_nowait(key)
+        else:
+            queue.append(update)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            update = queue.popleft()
+            try:
+                await self.handler(update)
+            except Exception as e:
+                logging.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self._pending -= 1
+                self._slots.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+
+class WebhookServer:
+    """Прием обновлений от Telegram по webhook на встроенном aiohttp-сервере
+
+    Запрос проверяется по секретному токену и подтверждается сразу после постановки
+    обновления в ChatOrderedPool. Несколько процессов бота могут стоять за одним
+    обратным прокси: процесс index из peers (базовые адреса всех процессов по порядку)
+    обрабатывает чаты с chat_id % len(peers) == index, а обновления чужих чатов пересылает
+    их владельцу. Так состояние, таймеры и порядок обновлений чата остаются в одном процессе.
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, path: str, secret: str, host: str, port: int,
+                 workers: int = 64, max_pending: int = 1000, index: int = 0, peers: Optional[List[str]] = None):
+        self.bot = bot
+        self.dp = dp
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.index = index
+        self.peers = [peer.rstrip('/') for peer in peers or []]
+        self.pool = ChatOrderedPool(self._process, workers=workers, max_pending=max_pending)
+        self.forwarded = 0
+        self._runner: Optional[web.AppRunner] = None
+        self._client: Optional[aiohttp.ClientSession] = None
+
+    async def _process(self, update: Update):
+        await self.dp.feed_update(self.bot, update)
+
+    def owner(self, key: Optional[int]) -> int:
+        """Номер процесса, который обрабатывает чат key"""
+        if key is None or len(self.peers) < 2:
+            return self.index
+        return key % len(self.peers)
+
+    async def start(self):
+        await self.pool.start()
+        if len(self.peers) > 1:
+            self._client = aiohttp.ClientSession()
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Webhook server listening on http://{self.host}:{self.port}{self.path} "
+                     f"(process {self.index} of {max(1, len(self.peers))})")
+
+    async def stop(self, timeout: float = 10.0):
+        # Сначала перестаем принимать запросы, затем дорабатываем принятые обновления
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        await self.pool.stop(timeout)
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), self.secret.encode()):
+            logging.warning(f"Rejected webhook request with invalid secret token from {request.remote}")
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+            update = Update.model_validate(payload, context={'bot': self.bot})
+        except ValueError as e:
+            logging.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+
+        key = update_chat_key(update)
+        owner = self.owner(key)
+        if owner != self.index and FORWARDED_HEADER not in request.headers:
+            return await self._forward(owner, payload)
+        await self.pool.submit(key, update)
+        return web.Response()
+
+    async def _forward(self, owner: int, payload: Dict) -> web.Response:
+        """Передает обновление процессу-владельцу чата; ошибка возвращается Telegram для повтора"""
+        try:
+            async with self._client.post(
+                    self.peers[owner] + self.path,
+                    json=payload,
+                    headers={SECRET_HEADER: self.secret, FORWARDED_HEADER: str(self.index)}) as response:
+                self.forwarded += 1
+                return web.Response(status=response.status)
+        except aiohttp.ClientError as e:
+            logging.error(f"Failed to forward update to process {owner}: {e}")
+            return web.Response(status=502)
@@ -0,0 +1,213 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import uuid
+from typing import Dict, List, Optional, Set
+
+from metrics import comparisons_dead_lettered
+
+
+class ComparisonWriter:
+    """Буфер отложенной записи результатов сравнений
+
+    Голос сразу дописывается в локальный журнал (append-only JSONL) и ставится в очередь,
+    а в Firestore сравнения уходят пачками - по достижении batch_size записей или раз
+    в flush_interval секунд. После успешной записи в журнал добавляется отметка
+    подтверждения, поэтому при старте воспроизводятся только неподтвержденные голоса.
+
+    После неудачной записи пауза перед следующей попыткой удваивается (до max_backoff).
+    Если самая старая пачка не записывается max_attempts раз подряд, пробуется следующая:
+    когда она записывается, а старая снова нет, старая пачка переносится в файл отложенных
+    голосов dead_letter_path (строки в формате журнала) и больше не задерживает очередь.
+    """
+
+    def __init__(self, db, journal_path: str, batch_size: int = 100, flush_interval: float = 1.0, fsync: bool = True,
+                 max_backoff: float = 60.0, max_attempts: int = 5, dead_letter_path: Optional[str] = None):
+        self.db = db
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path or journal_path + '.dead'
+        # Число неудачных попыток записи подряд
+        self.failures = 0
+        self._pending: List[Dict] = []
+        self._journal = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def pending_count(self) -> int:
+        """Число голосов, еще не записанных в Firestore"""
+        return len(self._pending)
+
+    async def start(self):
+        """Воспроизводит журнал и запускает фоновую запись"""
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._pending = self._read_journal()
+        os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        if self._pending:
+            logging.info(f"Replaying {len(self._pending)} journaled comparisons")
+            await self.flush()
+        self._flush_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает оставшиеся голоса
+
+        Начатая фоновая запись не прерывается (она защищена asyncio.shield): flush ждет
+        ее завершения и отправляет только голоса, которые она не подтвердила.
+        """
+        if self._journal is None:
+            return
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def submit(self, user_id: int, fixed_image: str, variable_image: str, selected_original: bool,
+               vote_id: Optional[str] = None) -> Dict:
+        """Принимает голос: записывает его в журнал и ставит в очередь на отправку
+
+        vote_id - ID сравнения в базе; без него создается случайный.
+        """
+        record = {
+            'id': vote_id or uuid.uuid4().hex,
+            'user_id': user_id,
+            'fixed_image': fixed_image,
+            'variable_image': variable_image,
+            'selected_original': selected_original,
+            'created_at': datetime.datetime.now(datetime.timezone.utc)
+        }
+        self._append({**record, 'created_at': record['created_at'].isoformat()})
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size and self._flush_requested:
+            self._flush_requested.set()
+        return record
+
+    async def flush(self) -> bool:
+        """Записывает накопленные голоса в Firestore"""
+        async with self._flush_lock:
+            while self._pending:
+                records = self._pending[:self.batch_size]
+                if await self.db.save_comparison_batch(records):
+                    self._acknowledge(0, records)
+                    self.failures = 0
+                    continue
+                self.failures += 1
+                if self.failures >= self.max_attempts and await self._skip_failing(records):
+                    continue
+                # Голоса остаются в очереди и журнале до следующей попытки
+                log = logging.error if self.failures >= self.max_attempts else logging.warning
+                log(f"Comparison flush failed {self.failures} times in a row, {len(self._pending)} votes pending, "
+                    f"retrying in {self.retry_delay():.1f}s")
+                return False
+            # Все голоса записаны - журнал можно начать заново
+            self._truncate_journal()
+            return True
+
+    def retry_delay(self) -> float:
+        """Пауза перед следующей фоновой записью"""
+        if not self.failures:
+            return self.flush_interval
+        return min(self.flush_interval * 2 ** self.failures, self.max_backoff)
+
+    async def _skip_failing(self, records: List[Dict]) -> bool:
+        """Записывает следующую за records пачку; если записать удается ее, но не records,
+        records переносятся в файл отложенных голосов. Возвращает True, если очередь продвинулась.
+        """
+        following = self._pending[len(records):len(records) + self.batch_size]
+        if not following or not await self.db.save_comparison_batch(following):
+            # Не записывается ничего - скорее всего, недоступна база, а не плохая пачка
+            return False
+        self._acknowledge(len(records), following)
+        self.failures = 0
+        if await self.db.save_comparison_batch(records):
+            self._acknowledge(0, records)
+        else:
+            self._dead_letter(records)
+        return True
+
+    def _acknowledge(self, start: int, records: List[Dict]):
+        """Убирает записанные голоса (начиная с позиции start в очереди) и отмечает их в журнале
+
+        Пока идет запись, очередь только пополняется с конца, поэтому позиция не меняется.
+        """
+        del self._pending[start:start + len(records)]
+        self._append({'ack': [record['id'] for record in records]})
+
+    def _dead_letter(self, records: List[Dict]):
+        """Переносит голоса из очереди в файл отложенных голосов"""
+        os.makedirs(os.path.dirname(self.dead_letter_path) or '.', exist_ok=True)
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps({**record, 'created_at': record['created_at'].isoformat()}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._acknowledge(0, records)
+        comparisons_dead_lettered.inc(len(records))
+        logging.error(f"Moved {len(records)} votes that could not be written to {self.dead_letter_path}")
+
+    async def _run(self):
+        """Фоновый цикл: запись по размеру пачки или по таймеру, после неудачи - с паузой"""
+        while True:
+            if self.failures:
+                await asyncio.sleep(self.retry_delay())
+            else:
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._flush_requested.clear()
+            if self._pending:
+                # Отмена цикла в stop() не прерывает запись посередине: иначе пачка, которая
+                # уже могла записаться, была бы отправлена повторно без отметки подтверждения
+                await asyncio.shield(self.flush())
+
+    def _append(self, entry: Dict):
+        """Дописывает строку в журнал"""
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _truncate_journal(self):
+        """Очищает журнал, когда в нем не осталось неподтвержденных голосов"""
+        if self._journal and not self._pending:
+            self._journal.seek(0)
+            self._journal.truncate()
+
+    def _read_journal(self) -> List[Dict]:
+        """Читает из журнала голоса, для которых нет отметки подтверждения"""
+        if not os.path.exists(self.journal_path):
+            return []
+        records: Dict[str, Dict] = {}
+        acked: Set[str] = set()
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла быть записана не полностью при аварийном завершении
+                    logging.warning("Skipping corrupted journal line")
+                    continue
+                if 'ack' in entry:
+                    acked.update(entry['ack'])
+                else:
+                    entry['created_at'] = datetime.datetime.fromisoformat(entry['created_at'])
+                    records[entry['id']] = entry
+        return [record for record_id, record in records.items() if record_id not in acked]
+